@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The repository root goes first: pyarrow installs a "benchmarks" package of its own
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.synthetic import generate_networks, network_list_payload, network_payload
+
+# Local stand-in for api.citybik.es. It serves the synthetic networks, answers
+# conditional requests with 304 while the snapshot is unchanged, and can be
+# told to rate limit every Nth request so the retry path is exercised too.
+
+class FakeCityBikesHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            limited = server.rate_limit_every and server.requests % server.rate_limit_every == 0
+        if limited:
+            self.send_json(429, {"error": "rate limited"}, {"Retry-After": "0"})
+            return
+
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path == "/v2/networks":
+            self.send_cached("networks", lambda: network_list_payload(server.networks))
+            return
+        if path == "/v2/snapshot":
+            # Advances every station to its next availability snapshot
+            server.snapshot += 1
+            server.payloads.clear()
+            self.send_json(200, {"snapshot": server.snapshot})
+            return
+
+        network_id = path.rsplit("/", 1)[-1]
+        network = server.by_id.get(network_id)
+        if network is None:
+            self.send_json(404, {"error": f"unknown network {network_id}"})
+            return
+        self.send_cached(network_id, lambda: network_payload(network, server.snapshot))
+
+    def send_cached(self, key, build):
+        etag = f'"{key}-{self.server.snapshot}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = self.server.payloads.get(key)
+        if body is None:
+            body = json.dumps(build()).encode()
+            self.server.payloads[key] = body
+        self.send_body(200, body, {"ETag": etag})
+
+    def send_json(self, status, payload, headers=None):
+        self.send_body(status, json.dumps(payload).encode(), headers)
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(n_stations, port=0, rate_limit_every=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeCityBikesHandler)
+    server.daemon_threads = True
+    server.networks = generate_networks(n_stations)
+    server.by_id = {network["id"]: network for network in server.networks}
+    server.payloads = {}
+    server.snapshot = 0
+    server.requests = 0
+    server.rate_limit_every = rate_limit_every
+    server.lock = threading.Lock()
+    return server
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_fake_api(n_stations, rate_limit_every=0):
+    # Runs in its own process so JSON encoding does not compete with the
+    # client for the GIL and does not count towards the client's memory
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.abspath(__file__),
+        "--stations", str(n_stations), "--port", str(port), "--rate-limit-every", str(rate_limit_every),
+    ])
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise Exception(f"Fake CityBikes API did not start on port {port}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve synthetic CityBikes networks")
+    parser.add_argument("--stations", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--rate-limit-every", type=int, default=0)
+    args = parser.parse_args()
+
+    server = make_server(args.stations, args.port, args.rate_limit_every)
+    print(f"Serving {len(server.networks)} synthetic networks on http://127.0.0.1:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import psycopg2
+from psycopg2 import OperationalError
+from minio import Minio
+
+# The repository root goes first: pyarrow installs a "benchmarks" package of its own
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database_Setup.create_tables import create_schema
+from benchmarks.object_store import MemoryObjectStore
+
+BENCH_DB_HOST = os.getenv("BENCH_DB_HOST")
+BENCH_DB_PORT = os.getenv("BENCH_DB_PORT", "5432")
+BENCH_DB_USER = os.getenv("BENCH_DB_USER", "postgres")
+BENCH_DB_PASSWORD = os.getenv("BENCH_DB_PASSWORD", "postgres")
+BENCH_TIMESCALE_IMAGE = os.getenv("BENCH_TIMESCALE_IMAGE", "timescale/timescaledb:latest-pg16")
+BENCH_MINIO_ENDPOINT = os.getenv("BENCH_MINIO_ENDPOINT")
+
+LAKE_BUCKETS = ["citybikes-bronze-layer", "citybikes-silver-layer", "citybikes-gold-layer"]
+
+def wait_for_postgres(params, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            psycopg2.connect(dbname="postgres", **params).close()
+            return
+        except OperationalError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+
+@contextmanager
+def timescale_server():
+    # An existing server is used when BENCH_DB_HOST is set, otherwise a
+    # throwaway TimescaleDB container is started for the run
+    if BENCH_DB_HOST:
+        yield {"host": BENCH_DB_HOST, "port": BENCH_DB_PORT, "user": BENCH_DB_USER, "password": BENCH_DB_PASSWORD}
+        return
+
+    import docker
+    container = docker.from_env().containers.run(
+        BENCH_TIMESCALE_IMAGE,
+        environment={"POSTGRES_PASSWORD": BENCH_DB_PASSWORD},
+        ports={"5432/tcp": ("127.0.0.1", None)},
+        detach=True,
+        remove=True,
+    )
+    try:
+        container.reload()
+        port = container.attrs["NetworkSettings"]["Ports"]["5432/tcp"][0]["HostPort"]
+        params = {"host": "127.0.0.1", "port": port, "user": BENCH_DB_USER, "password": BENCH_DB_PASSWORD}
+        print(f"Started {BENCH_TIMESCALE_IMAGE} on port {port}")
+        wait_for_postgres(params)
+        yield params
+    finally:
+        container.stop()
+
+@contextmanager
+def warehouse_database(params):
+    # Every benchmark gets an empty database with the pipeline's schema
+    dbname = f"citybikes_bench_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+    admin = psycopg2.connect(dbname="postgres", **params)
+    admin.autocommit = True
+    admin.cursor().execute(f'CREATE DATABASE "{dbname}"')
+
+    conn = psycopg2.connect(dbname=dbname, **params)
+    try:
+        create_schema(conn)
+        conn.autocommit = False
+        yield conn
+    finally:
+        conn.close()
+        admin.cursor().execute(f'DROP DATABASE IF EXISTS "{dbname}"')
+        admin.close()
+
+def object_store():
+    if not BENCH_MINIO_ENDPOINT:
+        store = MemoryObjectStore()
+    else:
+        store = Minio(
+            BENCH_MINIO_ENDPOINT,
+            access_key=os.getenv("MINIO_ACCESS_KEY"),
+            secret_key=os.getenv("MINIO_SECRET_KEY"),
+            secure=False
+        )
+    for bucket_name in LAKE_BUCKETS:
+        if not store.bucket_exists(bucket_name):
+            store.make_bucket(bucket_name)
+    return store
@@ -0,0 +1,86 @@
+import os
+import shutil
+import threading
+from datetime import datetime, timezone
+from io import BytesIO
+from types import SimpleNamespace
+from minio.error import S3Error
+
+# In-memory stand-in for the part of the MinIO client the pipeline uses, so
+# stage benchmarks measure the pipeline and not the network or the disk.
+# Point BENCH_MINIO_ENDPOINT at a real server to include MinIO itself.
+
+class ObjectResponse(BytesIO):
+    def release_conn(self):
+        pass
+
+class MemoryObjectStore:
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def error(self, code, bucket_name, object_name=None):
+        return S3Error(code, f"{code}: {bucket_name}/{object_name or ''}", f"/{bucket_name}/{object_name or ''}", None, None, None, bucket_name, object_name)
+
+    def bucket(self, bucket_name):
+        with self.lock:
+            return self.buckets.setdefault(bucket_name, {})
+
+    def bucket_exists(self, bucket_name):
+        return bucket_name in self.buckets
+
+    def make_bucket(self, bucket_name):
+        self.bucket(bucket_name)
+
+    def put_object(self, bucket_name, object_name, data, length, part_size=0, content_type=None, **kwargs):
+        if length is None or length < 0:
+            # Unknown length: read until the stream is exhausted, like a multipart upload
+            chunks = []
+            while True:
+                chunk = data.read(part_size or 16 * 1024 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            payload = b"".join(chunks)
+        else:
+            payload = data.read(length)
+        stored = SimpleNamespace(object_name=object_name, data=payload, size=len(payload), last_modified=datetime.now(timezone.utc))
+        with self.lock:
+            self.buckets.setdefault(bucket_name, {})[object_name] = stored
+            self.bytes_written += len(payload)
+        return stored
+
+    def fput_object(self, bucket_name, object_name, file_path, **kwargs):
+        with open(file_path, "rb") as file:
+            return self.put_object(bucket_name, object_name, file, os.path.getsize(file_path))
+
+    def stored(self, bucket_name, object_name):
+        stored = self.buckets.get(bucket_name, {}).get(object_name)
+        if stored is None:
+            raise self.error("NoSuchKey", bucket_name, object_name)
+        with self.lock:
+            self.bytes_read += stored.size
+        return stored
+
+    def get_object(self, bucket_name, object_name, **kwargs):
+        return ObjectResponse(self.stored(bucket_name, object_name).data)
+
+    def fget_object(self, bucket_name, object_name, file_path, **kwargs):
+        with open(file_path, "wb") as file:
+            shutil.copyfileobj(BytesIO(self.stored(bucket_name, object_name).data), file)
+
+    def stat_object(self, bucket_name, object_name, **kwargs):
+        return self.stored(bucket_name, object_name)
+
+    def list_objects(self, bucket_name, prefix=None, recursive=False, **kwargs):
+        if bucket_name not in self.buckets:
+            raise self.error("NoSuchBucket", bucket_name)
+        with self.lock:
+            objects = sorted(self.buckets[bucket_name].values(), key=lambda stored: stored.object_name)
+        return [stored for stored in objects if stored.object_name.startswith(prefix or "")]
+
+    def remove_object(self, bucket_name, object_name, **kwargs):
+        with self.lock:
+            self.buckets.get(bucket_name, {}).pop(object_name, None)
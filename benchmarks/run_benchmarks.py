@@ -0,0 +1,241 @@
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+import pandas as pd
+import psutil
+
+# The repository root goes first: pyarrow installs a "benchmarks" package of its own
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_Ingestion import fetch_networks
+from data_Processing import processing
+from data_Loading import load
+from data_Loading.dim_cache import DimensionCache
+from data_Transforming import transform
+from data_Visualization import data_layer
+from data_Lake.lake import to_table
+from data_Lake.catalog import Catalog
+from data_Lake.schemas import BRONZE_SCHEMA
+from benchmarks.synthetic import SIZES, consolidated_stations, generate_networks
+from benchmarks.fake_api import start_fake_api
+from benchmarks.fixtures import object_store, timescale_server, warehouse_database
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+BENCH_REPEATS = int(os.getenv("BENCH_REPEATS", "5"))
+BENCH_SNAPSHOTS = int(os.getenv("BENCH_SNAPSHOTS", "3"))
+BENCH_FETCH_RATE = float(os.getenv("BENCH_FETCH_RATE", "1000"))
+BENCH_TOLERANCE = float(os.getenv("BENCH_TOLERANCE", "0.2"))
+# The row-by-row paths are far too slow for the large sizes
+SEQUENTIAL_MAX_NETWORKS = 20
+ROW_PATH_MAX_ROWS = 10000
+
+STAGES = ["ingest_sequential", "ingest_concurrent", "process_data", "load_bulk", "load_rows", "transform", "dashboard"]
+
+class RssSampler:
+    # Peak resident memory while a stage runs, sampled from a background thread
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            self.stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.process.memory_info().rss
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+def timed(fn, *args, **kwargs):
+    with RssSampler() as sampler:
+        started = time.perf_counter()
+        result = fn(*args, **kwargs)
+        latency = time.perf_counter() - started
+    return result, latency, sampler.peak
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def summarize(stage, size, rows, samples):
+    latencies = [latency for latency, _ in samples]
+    p50 = percentile(latencies, 0.50)
+    result = {
+        "stage": stage,
+        "size": size,
+        "rows": rows,
+        "repeats": len(samples),
+        "rows_per_s": rows / p50 if p50 else None,
+        "p50_s": p50,
+        "p95_s": percentile(latencies, 0.95),
+        "p99_s": percentile(latencies, 0.99),
+        "peak_rss_mb": max(peak for _, peak in samples) / 1024 / 1024,
+    }
+    print(f"{stage}@{size}: {rows} rows, {result['rows_per_s']:.0f} rows/s, p50 {p50:.3f}s, p95 {result['p95_s']:.3f}s, p99 {result['p99_s']:.3f}s, peak RSS {result['peak_rss_mb']:.0f} MiB")
+    return result
+
+def bench_ingestion(size, n_stations, repeats, stages):
+    results = []
+    process, api = start_fake_api(n_stations)
+    fetch_networks.CITYBIKES_API = api
+    try:
+        networks = fetch_networks.fetch_network_data()
+        if "ingest_sequential" in stages and len(networks) <= SEQUENTIAL_MAX_NETWORKS:
+            samples = [timed(fetch_networks.consolidate_station_data, networks)[1:] for _ in range(repeats)]
+            results.append(summarize("ingest_sequential", size, n_stations, samples))
+        if "ingest_concurrent" in stages:
+            samples = [timed(fetch_networks.consolidate_station_data_concurrent, networks, rate=BENCH_FETCH_RATE)[1:] for _ in range(repeats)]
+            results.append(summarize("ingest_concurrent", size, n_stations, samples))
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+def bronze_snapshots(n_stations, snapshots):
+    networks = generate_networks(n_stations)
+    return [
+        to_table(fetch_networks.to_bronze_frame(pd.DataFrame(consolidated_stations(networks, snapshot))), BRONZE_SCHEMA)
+        for snapshot in range(snapshots)
+    ]
+
+def load_snapshots(conn, silver_tables):
+    for silver in silver_tables:
+        load.bulk_load(conn, silver)
+
+def bench_warehouse(size, silver, repeats, stages, server):
+    results = []
+    rows = sum(table.num_rows for table in silver)
+
+    if "load_bulk" in stages:
+        samples = []
+        for _ in range(repeats):
+            with warehouse_database(server) as conn:
+                samples.append(timed(load_snapshots, conn, silver)[1:])
+        results.append(summarize("load_bulk", size, rows, samples))
+
+    if "load_rows" in stages:
+        frame = silver[0].to_pandas().head(ROW_PATH_MAX_ROWS)
+        samples = []
+        for _ in range(repeats):
+            load.dimension_cache = DimensionCache()
+            with warehouse_database(server) as conn:
+                samples.append(timed(load.load_rows, conn, frame)[1:])
+        results.append(summarize("load_rows", size, len(frame), samples))
+
+    if "transform" in stages or "dashboard" in stages:
+        with warehouse_database(server) as conn, tempfile.TemporaryDirectory() as directory:
+            load_snapshots(conn, silver)
+            store = object_store()
+            transform.client = store
+            catalog = Catalog(os.path.join(directory, "catalog.db"))
+
+            samples = [timed(transform.export_full, conn, catalog)[1:] for _ in range(repeats)]
+            if "transform" in stages:
+                results.append(summarize("transform", size, rows, samples))
+
+            if "dashboard" in stages:
+                results.append(bench_dashboard(size, catalog, store, repeats))
+            catalog.close()
+    return results
+
+def bench_dashboard(size, catalog, store, repeats):
+    # The body of visualize.load_data without the Streamlit cache in front
+    city_name = data_layer.lake_cities(catalog, store)[0]
+    start_date, end_date = data_layer.lake_date_bounds(catalog, store, city_name)
+
+    def load_data():
+        series = data_layer.lake_series(catalog, store, city_name, start_date, end_date)
+        return len(series), data_layer.downsample(series)
+
+    samples = []
+    for _ in range(repeats):
+        (rows, _), latency, peak = timed(load_data)
+        samples.append((latency, peak))
+    return summarize("dashboard", size, rows, samples)
+
+def run(sizes, repeats, stages, use_db):
+    results = []
+    store = object_store()
+    for module in (fetch_networks, processing, load, transform):
+        module.client = store
+
+    for size in sizes:
+        n_stations = SIZES[size]
+        print(f"Benchmarking {size} stations...")
+        if any(stage in stages for stage in ("ingest_sequential", "ingest_concurrent")):
+            results.extend(bench_ingestion(size, n_stations, repeats, stages))
+
+        bronze = bronze_snapshots(n_stations, BENCH_SNAPSHOTS)
+        silver = [processing.process_table(table) for table in bronze]
+        if "process_data" in stages:
+            samples = [timed(processing.process_table, bronze[0])[1:] for _ in range(repeats)]
+            results.append(summarize("process_data", size, bronze[0].num_rows, samples))
+
+        if use_db and any(stage in stages for stage in ("load_bulk", "load_rows", "transform", "dashboard")):
+            with timescale_server() as server:
+                results.extend(bench_warehouse(size, silver, repeats, stages, server))
+    return results
+
+def compare(results, baseline, tolerance=BENCH_TOLERANCE):
+    regressions = []
+    for result in results:
+        key = f"{result['stage']}@{result['size']}"
+        previous = baseline.get(key)
+        if previous is None:
+            print(f"{key}: no baseline")
+            continue
+        change = result["rows_per_s"] / previous["rows_per_s"] - 1
+        print(f"{key}: {change:+.1%} rows/s, p95 {previous['p95_s']:.3f}s -> {result['p95_s']:.3f}s")
+        if change < -tolerance:
+            regressions.append(key)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-stage throughput benchmarks on synthetic data")
+    parser.add_argument("--sizes", default="1k", help=f"comma separated, from {', '.join(SIZES)}")
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--repeats", type=int, default=BENCH_REPEATS)
+    parser.add_argument("--no-db", action="store_true", help="skip the stages that need TimescaleDB")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true", help="fail when rows/s dropped more than BENCH_TOLERANCE")
+    args = parser.parse_args()
+
+    results = run(args.sizes.split(","), args.repeats, args.stages.split(","), not args.no_db)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        if not os.path.exists(BASELINE_PATH):
+            print(f"No baseline at {BASELINE_PATH}, run with --save-baseline first")
+            sys.exit(1)
+        with open(BASELINE_PATH) as file:
+            regressions = compare(results, json.load(file))
+        if regressions:
+            print(f"Regressions beyond {BENCH_TOLERANCE:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(BASELINE_PATH):
+            with open(BASELINE_PATH) as file:
+                baseline = json.load(file)
+        baseline.update({f"{result['stage']}@{result['size']}": result for result in results})
+        with open(BASELINE_PATH, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+        print(f"Baseline saved to {BASELINE_PATH}")
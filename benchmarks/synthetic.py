@@ -0,0 +1,97 @@
+import random
+import hashlib
+from datetime import datetime, timedelta, timezone
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_Ingestion.fetch_networks import BELGIAN_CITIES
+
+SIZES = {"1k": 1_000, "100k": 100_000, "1M": 1_000_000}
+STATIONS_PER_NETWORK = int(os.getenv("BENCH_STATIONS_PER_NETWORK", "500"))
+
+CITY_CENTERS = {
+    "Bruxelles": (50.8503, 4.3517),
+    "Antwerpen": (51.2194, 4.4025),
+    "Gent": (51.0543, 3.7174),
+    "Namur": (50.4674, 4.8720),
+}
+
+# Payloads follow the shape of the CityBikes v2 API. Everything is derived
+# from a seed, so the fake server and the benchmarks see the same stations.
+
+def generate_networks(n_stations, stations_per_network=STATIONS_PER_NETWORK, seed=0):
+    n_networks = max(1, -(-n_stations // stations_per_network))
+    networks = []
+    for index in range(n_networks):
+        city = BELGIAN_CITIES[index % len(BELGIAN_CITIES)]
+        latitude, longitude = CITY_CENTERS[city]
+        size = min(stations_per_network, n_stations - index * stations_per_network)
+        networks.append({
+            "id": f"bench-{seed}-{index:05d}",
+            "name": f"Bench Bikes {index}",
+            "location": {"city": city, "country": "BE", "latitude": latitude, "longitude": longitude},
+            "href": f"/v2/networks/bench-{seed}-{index:05d}",
+            "stations": size,
+        })
+    return networks
+
+def generate_stations(network, snapshot=0, started=None):
+    # Station identity and position depend on the network only, availability
+    # and timestamps change with the snapshot number
+    rng = random.Random(f"{network['id']}-layout")
+    state = random.Random(f"{network['id']}-{snapshot}")
+    started = started or datetime(2024, 9, 1, tzinfo=timezone.utc)
+    observed = started + timedelta(minutes=5 * snapshot)
+    latitude, longitude = network["location"]["latitude"], network["location"]["longitude"]
+
+    stations = []
+    for index in range(network["stations"]):
+        slots = rng.randint(10, 40)
+        free_bikes = state.randint(0, slots)
+        ebikes = state.randint(0, free_bikes)
+        timestamp = observed - timedelta(seconds=state.randint(0, 240), microseconds=state.randint(0, 999999))
+        stations.append({
+            "id": hashlib.md5(f"{network['id']}-{index}".encode()).hexdigest(),
+            "name": f"{network['location']['city']} station {index}",
+            "latitude": round(latitude + rng.uniform(-0.05, 0.05), 6),
+            "longitude": round(longitude + rng.uniform(-0.08, 0.08), 6),
+            "timestamp": timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "free_bikes": free_bikes,
+            "empty_slots": slots - free_bikes,
+            "extra": {
+                "uid": str(index),
+                "address": f"Rue de la Station {index}",
+                "slots": slots,
+                "ebikes": ebikes,
+                "normal_bikes": free_bikes - ebikes,
+                "has_ebikes": ebikes > 0,
+                "online": True,
+                "renting": 1,
+                "returning": 1,
+                "last_updated": int(timestamp.timestamp()),
+            },
+        })
+    return stations
+
+def network_list_payload(networks):
+    return {"networks": [{key: value for key, value in network.items() if key != "stations"} for network in networks]}
+
+def network_payload(network, snapshot=0):
+    return {"network": {
+        "id": network["id"],
+        "name": network["name"],
+        "location": network["location"],
+        "href": network["href"],
+        "stations": generate_stations(network, snapshot),
+    }}
+
+def consolidated_stations(networks, snapshot=0):
+    # Same rows consolidate_station_data builds from the API
+    all_stations = []
+    for network in networks:
+        for station in generate_stations(network, snapshot):
+            station["network_name"] = network["name"]
+            station["city_name"] = network["location"]["city"]
+            all_stations.append(station)
+    return all_stations
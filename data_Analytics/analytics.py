@@ -0,0 +1,150 @@
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+import polars as pl
+from minio import Minio
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_Lake.lake import download_objects, filter_partitions, write_partitioned
+from data_Lake.catalog import Catalog
+from data_Lake.schemas import CITY_UTILIZATION_SCHEMA, STATION_UTILIZATION_SCHEMA
+from data_Monitoring import metrics
+from data_Monitoring.metrics import instrument_client
+
+client = instrument_client(Minio(
+    "127.0.0.1:9000",
+    access_key=os.getenv("MINIO_ACCESS_KEY"),
+    secret_key=os.getenv("MINIO_SECRET_KEY"),
+    secure=False
+))
+
+SILVER_BUCKET = "citybikes-silver-layer"
+GOLD_BUCKET = "citybikes-gold-layer"
+SILVER_COLUMNS = ["id", "name", "city_name", "timestamp", "free_bikes", "empty_slots"]
+ANALYTICS_WINDOW = os.getenv("ANALYTICS_WINDOW", "1h")
+CDC_HEARTBEAT_MINUTES = int(os.getenv("CDC_HEARTBEAT_MINUTES", "15"))
+ANALYTICS_MAX_GAP = timedelta(minutes=int(os.getenv("ANALYTICS_MAX_GAP_MINUTES", str(2 * CDC_HEARTBEAT_MINUTES))))
+
+# Station-level utilization per time window, computed from silver history:
+#   occupancy_ratio   free_bikes / (free_bikes + empty_slots), weighted by how
+#                     long each observation stood
+#   empty/full_seconds time a station had no bikes / no free slots
+#   bikes_taken/returned turnover estimated from consecutive free_bikes deltas
+# An observation stands until the next one of its station, for at most
+# ANALYTICS_MAX_GAP, so change-only (CDC) silver gives the same result as
+# dense snapshots. Only windows closed since the last run are computed.
+
+def scan_silver(paths):
+    # One scan per file: older runs store city_name as a string, newer ones as
+    # a dictionary, which a single multi-file scan would refuse to combine
+    return pl.concat([
+        pl.scan_parquet(path).select(SILVER_COLUMNS).with_columns(
+            pl.col("city_name").cast(pl.String),
+            pl.col("name").cast(pl.String),
+        )
+        for path in paths
+    ], how="vertical_relaxed")
+
+def station_utilization(lf, since, until, window=ANALYTICS_WINDOW, max_gap=ANALYTICS_MAX_GAP):
+    # Rows before `since` are only read so the first window has its deltas
+    if since is not None:
+        lf = lf.filter(pl.col("timestamp") >= since - max_gap)
+    lf = lf.filter(pl.col("timestamp") < until)
+
+    # Sorting on time alone is cheap on snapshots that arrive in time order;
+    # the window expressions below keep that order inside every station
+    timestamp, free, empty, held = pl.col("timestamp"), pl.col("free_bikes"), pl.col("empty_slots"), pl.col("held")
+    observations = (
+        lf.sort("timestamp")
+        .with_columns(timestamp.shift(-1).over("id").alias("next_timestamp"))
+        # A station seen twice at the same time keeps its last row
+        .filter(pl.col("next_timestamp").is_null() | (pl.col("next_timestamp") != timestamp))
+        .with_columns(
+            (
+                pl.min_horizontal(pl.col("next_timestamp").fill_null(pl.lit(until)), timestamp + max_gap) - timestamp
+            ).dt.total_seconds().cast(pl.Float64).alias("held"),
+            free.diff().over("id").alias("delta"),
+            pl.when((free + empty) > 0).then(free / (free + empty)).alias("occupancy"),
+        )
+    )
+    if since is not None:
+        observations = observations.filter(timestamp >= since)
+
+    # Fixed, non-overlapping windows: truncating and grouping gives the same
+    # result as group_by_dynamic without its per-station sort requirement
+    weighted = (pl.col("occupancy") * held).sum() / held.filter(pl.col("occupancy").is_not_null()).sum()
+    return (
+        observations.group_by(["id", timestamp.dt.truncate(window).alias("window_start")])
+        .agg(
+            pl.col("name").last().alias("station_name"),
+            pl.col("city_name").last(),
+            # Falls back to the plain mean when every observation held zero seconds
+            pl.when(weighted.is_finite()).then(weighted).otherwise(pl.col("occupancy").mean()).alias("occupancy_ratio"),
+            held.filter(free == 0).sum().alias("empty_seconds"),
+            held.filter(empty == 0).sum().alias("full_seconds"),
+            (-pl.col("delta")).clip(lower_bound=0).sum().alias("bikes_taken"),
+            pl.col("delta").clip(lower_bound=0).sum().alias("bikes_returned"),
+            pl.len().alias("observations"),
+        )
+        .rename({"id": "station_id"})
+    )
+
+def city_utilization(stations):
+    return (
+        stations.group_by(["city_name", "window_start"])
+        .agg(
+            pl.col("occupancy_ratio").mean().alias("avg_occupancy_ratio"),
+            (pl.col("empty_seconds").sum() / 3600).alias("empty_station_hours"),
+            (pl.col("full_seconds").sum() / 3600).alias("full_station_hours"),
+            pl.col("bikes_taken").sum(),
+            pl.col("bikes_returned").sum(),
+            pl.len().alias("stations"),
+        )
+        .sort(["city_name", "window_start"])
+    )
+
+@metrics.timed
+def run_analytics(client, catalog, window=ANALYTICS_WINDOW):
+    since = catalog.watermark("analytics", "silver")
+    since = datetime.fromisoformat(since) if since else None
+
+    object_names = [object_name for object_name, _ in catalog.layer_objects("silver") if object_name.endswith(".parquet")]
+    if since is not None:
+        object_names = filter_partitions(object_names, start_date=(since - ANALYTICS_MAX_GAP).astimezone(timezone.utc).date())
+    if not object_names:
+        print("No silver partitions to analyse.")
+        return []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = download_objects(client, SILVER_BUCKET, object_names, tmp)
+        lf = scan_silver(paths)
+
+        # Only windows that have fully passed are computed, the open one waits for the next run
+        until = lf.select(pl.col("timestamp").max().dt.truncate(window)).collect().item()
+        if until is None or (since is not None and until <= since):
+            print("No closed analytics window since the last run.")
+            return []
+        # Collected in memory on purpose: the shift/diff over() windows per
+        # station are not supported by the streaming engine, which would only
+        # stream the scan and sort and run the rest in memory anyway. The scan
+        # is already limited to the windows closed since the last run
+        stations = station_utilization(lf, since, until, window).collect()
+
+    cities = city_utilization(stations)
+    metrics.rows_out(len(stations) + len(cities))
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    written = write_partitioned(client, stations, STATION_UTILIZATION_SCHEMA, GOLD_BUCKET, "station_utilization", run_id,
+                                time_column="window_start", catalog=catalog, layer="station_utilization", strict=True)
+    written += write_partitioned(client, cities, CITY_UTILIZATION_SCHEMA, GOLD_BUCKET, "city_utilization", run_id,
+                                 time_column="window_start", catalog=catalog, layer="city_utilization", strict=True)
+    catalog.set_watermark("analytics", "silver", until.isoformat())
+    print(f"Analysed {len(stations)} station windows from {since or 'the start'} up to {until}")
+    return written
+
+if __name__ == "__main__":
+    with metrics.stage("analytics"):
+        catalog = Catalog()
+        run_analytics(client, catalog)
+        catalog.close()
+    metrics.write_report("analytics")
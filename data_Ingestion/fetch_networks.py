@@ -1,27 +1,185 @@
 import requests
 import pandas as pd
 import time
-from datetime import datetime
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from minio import Minio
 from minio.error import S3Error
 from io import BytesIO
 import os
+import sys
+import json
 
-client = Minio(
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_Ingestion.http_cache import HttpCache
+from data_Lake.lake import STORAGE_FORMAT, write_partitioned
+from data_Lake.schemas import BRONZE_SCHEMA
+from data_Lake.station_records import BRONZE_FORMAT, raw_line, write_raw_partitioned
+from data_Lake.catalog import Catalog
+from data_Monitoring import metrics
+from data_Monitoring.metrics import instrument_client
+
+client = instrument_client(Minio(
     "127.0.0.1:9000",
     access_key=os.getenv("MINIO_ACCESS_KEY"),
     secret_key=os.getenv("MINIO_SECRET_KEY"),
     secure=False
-)
+))
 
 BELGIAN_CITIES = ["Bruxelles", "Antwerpen", "Gent", "Namur"]
+CITYBIKES_API = os.getenv("CITYBIKES_API", "http://api.citybik.es")
+
+FETCH_MODE = os.getenv("FETCH_MODE", "concurrent")
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "8"))
+FETCH_RATE = float(os.getenv("FETCH_RATE", "5"))
+FETCH_MAX_RETRIES = int(os.getenv("FETCH_MAX_RETRIES", "5"))
+HTTP_CACHE_ENABLED = os.getenv("HTTP_CACHE", "on") != "off"
+NETWORK_LIST_TTL = int(os.getenv("NETWORK_LIST_TTL", "3600"))
+MAX_BACKOFF = 60
+
+# Dropped connections and timeouts; anything else a request raises is not retried
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+class TokenBucket:
+    # Shared by all fetch threads so the whole run stays under one request rate.
+    # A 429 pauses every thread (honouring Retry-After) and halves the rate,
+    # successful requests slowly bring it back up.
+    def __init__(self, rate, capacity=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.blocked_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.blocked_until - now
+            time.sleep(wait)
+
+    def throttle(self, delay):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            self.updated = self.blocked_until
+            self.tokens = 0
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(backoff_time, attempt):
+    # Full jitter keeps concurrent workers from retrying in lockstep
+    return random.uniform(0, min(MAX_BACKOFF, backoff_time * 2 ** attempt))
+
+def create_session(pool_size=FETCH_CONCURRENCY):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-def fetch_network_data():
-    url = "http://api.citybik.es/v2/networks?fields=id,name,location,href"
-    response = requests.get(url)
-    response.raise_for_status()
+def retryable(status_code):
+    return status_code == 429 or status_code >= 500
 
-    networks = response.json().get("networks", [])
+@metrics.timed
+def get_with_retries(http, url, label, headers=None, limiter=None, backoff_time=1, max_retries=FETCH_MAX_RETRIES):
+    # Returns the first 200 or 304. Rate limits, server errors and dropped
+    # connections are retried with capped, jittered backoff (or Retry-After);
+    # any other status raises HTTPError
+    for attempt in range(max_retries + 1):
+        if limiter:
+            limiter.acquire()
+        try:
+            response = http.get(url, headers=headers or {})
+        except TRANSIENT_ERRORS as e:
+            metrics.http_request()
+            if attempt == max_retries:
+                raise
+            delay = backoff_delay(backoff_time, attempt)
+            print(f"Error fetching {label}: {e}. Retrying in {delay:.1f} seconds...")
+            metrics.http_retry()
+            time.sleep(delay)
+            continue
+
+        metrics.http_request(response.status_code)
+        if response.status_code in (200, 304):
+            if limiter:
+                limiter.recover()
+            return response
+        if not retryable(response.status_code) or attempt == max_retries:
+            response.raise_for_status()
+            raise requests.HTTPError(f"Unexpected status {response.status_code} fetching {label}", response=response)
+
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        delay = retry_after if retry_after is not None else backoff_delay(backoff_time, attempt)
+        metrics.http_retry()
+        if response.status_code == 429:
+            print(f"Rate limit hit for {label}. Backing off for {delay:.1f} seconds...")
+            if limiter:
+                limiter.throttle(delay)
+                continue
+        else:
+            print(f"Server error {response.status_code} fetching {label}. Retrying in {delay:.1f} seconds...")
+        time.sleep(delay)
+
+def get_cached(http, url, label, cache=None, cache_key=None, limiter=None, backoff_time=1, max_retries=FETCH_MAX_RETRIES):
+    # Returns (response, None) for a new body, or (None, payload) when a 304
+    # confirmed the cached payload. A 304 whose payload is gone is asked again
+    # without validators, on a retry budget of its own
+    cache_key = cache_key or url
+    headers = cache.conditional_headers(cache_key) if cache else {}
+    response = get_with_retries(http, url, label, headers, limiter, backoff_time, max_retries)
+    if response.status_code == 304 and cache:
+        cache.revalidate(cache_key, response)
+        payload = cache.load(cache_key)
+        if payload is not None:
+            return None, payload
+        print(f"Cached {label} are gone, fetching again...")
+        response = get_with_retries(http, url, label, None, limiter, backoff_time, max_retries)
+    if response.status_code != 200:
+        raise requests.HTTPError(f"Unexpected status {response.status_code} fetching {label}", response=response)
+    return response, None
+
+@metrics.timed
+def fetch_network_data(session=None, cache=None, ttl=NETWORK_LIST_TTL):
+    url = f"{CITYBIKES_API}/v2/networks?fields=id,name,location,href"
+    networks = cache.fresh(url, ttl) if cache else None
+
+    if networks is None:
+        response, networks = get_cached(session or requests, url, "the network list", cache)
+        if response is not None:
+            networks = response.json().get("networks", [])
+            if cache:
+                cache.store(url, response, networks)
     
     filtered_networks = [
         network for network in networks 
@@ -29,31 +187,32 @@ def fetch_network_data():
     ]
     return filtered_networks
 
-def fetch_station_data(network_id, network_name, city_name, backoff_time=1):
-    url = f"http://api.citybik.es/v2/networks/{network_id}"
-    
-    while True:
-        try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                stations = response.json().get("network", {}).get("stations", [])
-
-                for station in stations:
-                    station["network_name"] = network_name
-                    station["city_name"] = city_name  
-                return stations
-            elif response.status_code == 429:
-                print(f"Rate limit hit for {network_name}. Backing off for {backoff_time} seconds...")
-                time.sleep(backoff_time)
-                backoff_time *= 2  
-            else:
-                raise Exception(f"Failed to fetch stations for {network_name}: {response.status_code}")
-        except requests.RequestException as e:
-            print(f"Error fetching stations for {network_name}: {e}")
-            time.sleep(backoff_time)
-            backoff_time *= 2
+@metrics.timed
+def fetch_station_data(network_id, network_name, city_name, backoff_time=1, session=None, limiter=None, max_retries=FETCH_MAX_RETRIES, cache=None, raw=False):
+    # With raw=True the response body is returned as it came, unparsed
+    url = f"{CITYBIKES_API}/v2/networks/{network_id}"
+    cache_key = f"{url}#raw" if raw else url
+    response, cached = get_cached(session or requests, url, f"stations for {network_name}", cache, cache_key, limiter, backoff_time, max_retries)
+    if response is None:
+        return cached
+
+    if raw:
+        if cache:
+            cache.store(cache_key, response, response.content)
+        return response.content
+
+    stations = response.json().get("network", {}).get("stations", [])
+    for station in stations:
+        station["network_name"] = network_name
+        station["city_name"] = city_name  
+    if cache:
+        cache.store(url, response, stations)
+    return stations
 
-def consolidate_station_data(networks):
+@metrics.timed
+def consolidate_station_data(networks, rate=FETCH_RATE, cache=None):
+    # One request at a time, paced by the same limiter as the concurrent fetch
+    limiter = TokenBucket(rate)
     all_stations = []  
 
     for network in networks:
@@ -63,16 +222,77 @@ def consolidate_station_data(networks):
 
         print(f"Fetching stations for {network_name} (ID: {network_id}) in {city_name}")
         
-        stations = fetch_station_data(network_id, network_name, city_name)
+        stations = fetch_station_data(network_id, network_name, city_name, limiter=limiter, cache=cache)
         if stations:
             all_stations.extend(stations)  
         else:
             print(f"No station data found for {network_name}.")
-        
-        time.sleep(1)  
 
     return pd.DataFrame(all_stations)
 
+@metrics.timed
+def consolidate_station_data_concurrent(networks, max_workers=FETCH_CONCURRENCY, rate=FETCH_RATE, session=None, cache=None):
+    limiter = TokenBucket(rate)
+    own_session = session is None
+    session = session or create_session(max_workers)
+    all_stations = []
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for network in networks:
+                print(f"Fetching stations for {network['name']} (ID: {network['id']}) in {network['location']['city']}")
+                futures.append(executor.submit(
+                    fetch_station_data, network["id"], network["name"], network["location"]["city"],
+                    session=session, limiter=limiter, cache=cache
+                ))
+
+            # Results are collected in submission order so the frame matches the sequential one
+            for network, future in zip(networks, futures):
+                stations = future.result()
+                if stations:
+                    all_stations.extend(stations)
+                else:
+                    print(f"No station data found for {network['name']}.")
+    finally:
+        if own_session:
+            session.close()
+
+    metrics.rows_in(len(all_stations))
+    return pd.DataFrame(all_stations)
+
+@metrics.timed
+def capture_station_responses(networks, max_workers=FETCH_CONCURRENCY, rate=FETCH_RATE, session=None, cache=None):
+    # Bronze keeps the response bodies themselves, one NDJSON line per network
+    limiter = TokenBucket(rate)
+    own_session = session is None
+    session = session or create_session(max_workers)
+    fetched_at = datetime.now(timezone.utc).isoformat()
+    lines = []
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for network in networks:
+                print(f"Fetching stations for {network['name']} (ID: {network['id']}) in {network['location']['city']}")
+                futures.append(executor.submit(
+                    fetch_station_data, network["id"], network["name"], network["location"]["city"],
+                    session=session, limiter=limiter, cache=cache, raw=True
+                ))
+
+            for network, future in zip(networks, futures):
+                body = future.result()
+                if body:
+                    lines.append((network["location"]["city"], raw_line(network["name"], network["location"]["city"], fetched_at, body)))
+                else:
+                    print(f"No station data found for {network['name']}.")
+    finally:
+        if own_session:
+            session.close()
+
+    return lines
+
+@metrics.timed
 def upload_to_minio(df, bucket_name, file_name):
     try:
         csv_buffer = BytesIO()
@@ -81,14 +301,60 @@ def upload_to_minio(df, bucket_name, file_name):
         
         client.put_object(bucket_name, file_name, data=csv_buffer, length=csv_buffer.getbuffer().nbytes)
         print(f"Uploaded {file_name} to {bucket_name}")
+        return True
     except S3Error as err:
         print(f"Failed to upload {file_name}: {err}")
+        return False
+
+@metrics.timed
+def to_bronze_frame(df):
+    df = df.copy()
+    if "extra" in df:
+        df["extra"] = df["extra"].map(lambda value: json.dumps(value) if isinstance(value, (dict, list)) else value)
+    if "timestamp" in df:
+        df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True, format="ISO8601", errors="coerce")
+    for column in ("free_bikes", "empty_slots"):
+        if column in df:
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype("Int64")
+    for column in ("latitude", "longitude"):
+        if column in df:
+            df[column] = pd.to_numeric(df[column], errors="coerce")
+    return df
 
 if __name__ == "__main__":
-    networks = fetch_network_data()
-    
-    consolidated_station_data = consolidate_station_data(networks)
-    
-    file_name = f"consolidated_stations_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
-    
-    upload_to_minio(consolidated_station_data, "citybikes-bronze-layer", file_name)
+    with metrics.stage("ingestion"):
+        cache = HttpCache() if HTTP_CACHE_ENABLED else None
+
+        raw = STORAGE_FORMAT == "parquet" and BRONZE_FORMAT == "ndjson"
+        if FETCH_MODE == "sequential":
+            networks = fetch_network_data(cache=cache)
+            if raw:
+                responses = capture_station_responses(networks, max_workers=1, cache=cache)
+            else:
+                consolidated_station_data = consolidate_station_data(networks, cache=cache)
+        else:
+            with create_session() as session:
+                networks = fetch_network_data(session, cache=cache)
+                if raw:
+                    responses = capture_station_responses(networks, session=session, cache=cache)
+                else:
+                    consolidated_station_data = consolidate_station_data_concurrent(networks, session=session, cache=cache)
+
+        run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+        catalog = Catalog()
+
+        if raw:
+            # Rows here are network responses, stations are counted when processing parses them
+            date = datetime.now(timezone.utc).date().isoformat()
+            write_raw_partitioned(client, responses, "citybikes-bronze-layer", "consolidated_stations", run_id, date, catalog=catalog, layer="bronze")
+            metrics.rows_out(len(responses))
+        elif STORAGE_FORMAT == "parquet":
+            write_partitioned(client, to_bronze_frame(consolidated_station_data), BRONZE_SCHEMA, "citybikes-bronze-layer", "consolidated_stations", run_id, catalog=catalog, layer="bronze")
+            metrics.rows_out(len(consolidated_station_data))
+        else:
+            file_name = f"consolidated_stations_{run_id}.csv"
+            if upload_to_minio(consolidated_station_data, "citybikes-bronze-layer", file_name):
+                catalog.register("bronze", "citybikes-bronze-layer", file_name, run_id, consolidated_station_data)
+                metrics.rows_out(len(consolidated_station_data))
+
+    metrics.write_report("ingestion", run_id)
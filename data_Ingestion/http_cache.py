@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import threading
+
+HTTP_CACHE_DIR = os.getenv("HTTP_CACHE_DIR", ".http_cache")
+HTTP_CACHE_MAX_ENTRIES = int(os.getenv("HTTP_CACHE_MAX_ENTRIES", "1024"))
+
+class HttpCache:
+    # On-disk cache for CityBikes responses. Payloads are stored already parsed
+    # (pickled) next to their ETag / Last-Modified validators, so a 304 reuses
+    # the stored object instead of parsing and rebuilding it again.
+    def __init__(self, directory=HTTP_CACHE_DIR, max_entries=HTTP_CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.index_path = os.path.join(directory, "index.json")
+        self.memory = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def _payload_path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest() + ".pkl")
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _evict(self):
+        while len(self.index) > self.max_entries:
+            url = min(self.index, key=lambda key: self.index[key]["used_at"])
+            del self.index[url]
+            self.memory.pop(url, None)
+            try:
+                os.remove(self._payload_path(url))
+            except OSError:
+                pass
+
+    def fresh(self, url, ttl):
+        # Returns the cached payload without any request while it is younger than ttl
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is None or ttl is None or time.time() - entry["fetched_at"] > ttl:
+                return None
+        return self.load(url)
+
+    def conditional_headers(self, url):
+        with self.lock:
+            entry = self.index.get(url)
+        if entry is None:
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def load(self, url):
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return None
+            entry["used_at"] = time.time()
+            if url in self.memory:
+                return self.memory[url]
+        try:
+            with open(self._payload_path(url), "rb") as f:
+                payload = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.invalidate(url)
+            return None
+        with self.lock:
+            self.memory[url] = payload
+        return payload
+
+    def revalidate(self, url, response):
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return
+            entry["fetched_at"] = time.time()
+            entry["etag"] = response.headers.get("ETag", entry.get("etag"))
+            entry["last_modified"] = response.headers.get("Last-Modified", entry.get("last_modified"))
+            self._save_index()
+
+    def store(self, url, response, payload):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        path = self._payload_path(url)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            now = time.time()
+            self.index[url] = {"etag": etag, "last_modified": last_modified, "fetched_at": now, "used_at": now}
+            self.memory[url] = payload
+            self._evict()
+            self._save_index()
+
+    def invalidate(self, url):
+        with self.lock:
+            self.index.pop(url, None)
+            self.memory.pop(url, None)
+            self._save_index()
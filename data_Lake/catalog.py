@@ -0,0 +1,234 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+import polars as pl
+import pyarrow as pa
+from minio.error import S3Error
+from data_Lake.lake import ARCHIVE_PREFIX, run_objects
+
+CATALOG_PATH = os.getenv("CATALOG_PATH", ".catalog/catalog.db")
+
+# Every object written to the lake is registered here per layer and run, so
+# stages look up "the latest run" or "runs not processed yet" through an index
+# instead of listing whole buckets and comparing last_modified.
+
+def frame_stats(df, time_column="timestamp"):
+    if isinstance(df, pa.Table):
+        df = pl.from_arrow(df)
+
+    if isinstance(df, pl.DataFrame):
+        schema = {name: str(dtype) for name, dtype in df.schema.items()}
+    else:
+        schema = {name: str(dtype) for name, dtype in df.dtypes.items()}
+
+    min_timestamp = max_timestamp = None
+    if time_column in df.columns and len(df) > 0:
+        min_timestamp, max_timestamp = df[time_column].min(), df[time_column].max()
+    return (
+        len(df),
+        schema,
+        None if min_timestamp is None or min_timestamp != min_timestamp else str(min_timestamp),
+        None if max_timestamp is None or max_timestamp != max_timestamp else str(max_timestamp),
+    )
+
+def scan_latest_object(client, bucket_name):
+    # Old behaviour, only used to bootstrap a layer the catalog has not seen yet
+    try:
+        latest_file = None
+        for obj in client.list_objects(bucket_name, recursive=True):
+            if obj.object_name.startswith(ARCHIVE_PREFIX):
+                continue
+            if latest_file is None or obj.last_modified > latest_file.last_modified:
+                latest_file = obj
+        return latest_file.object_name if latest_file else None
+    except S3Error as err:
+        print(f"Error listing objects: {err}")
+        return None
+
+class Catalog:
+    def __init__(self, path=CATALOG_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                layer TEXT NOT NULL,
+                run_id TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (layer, run_id)
+            );
+            CREATE TABLE IF NOT EXISTS objects (
+                bucket TEXT NOT NULL,
+                object_name TEXT NOT NULL,
+                layer TEXT NOT NULL,
+                run_id TEXT NOT NULL,
+                row_count INTEGER,
+                schema TEXT,
+                min_timestamp TEXT,
+                max_timestamp TEXT,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (bucket, object_name)
+            );
+            CREATE INDEX IF NOT EXISTS objects_layer_run ON objects (layer, run_id);
+            CREATE TABLE IF NOT EXISTS watermarks (
+                consumer TEXT NOT NULL,
+                layer TEXT NOT NULL,
+                run_id TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (consumer, layer)
+            );
+            CREATE TABLE IF NOT EXISTS backfill_partitions (
+                job TEXT NOT NULL,
+                partition TEXT NOT NULL,
+                object_count INTEGER NOT NULL,
+                rows_loaded INTEGER NOT NULL,
+                finished_at TEXT NOT NULL,
+                PRIMARY KEY (job, partition)
+            );
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def register(self, layer, bucket_name, object_name, run_id, df=None, time_column="timestamp", stats=None):
+        row_count = schema = min_timestamp = max_timestamp = None
+        if df is not None:
+            stats = frame_stats(df, time_column)
+        if stats is not None:
+            row_count, schema, min_timestamp, max_timestamp = stats
+        now = datetime.now(timezone.utc).isoformat()
+
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO runs (layer, run_id, bucket, created_at) VALUES (?, ?, ?, ?)",
+                (layer, run_id, bucket_name, now),
+            )
+            self.conn.execute(
+                """INSERT OR REPLACE INTO objects
+                   (bucket, object_name, layer, run_id, row_count, schema, min_timestamp, max_timestamp, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (bucket_name, object_name, layer, run_id, row_count,
+                 json.dumps(schema) if schema else None, min_timestamp, max_timestamp, now),
+            )
+            self.conn.commit()
+
+    def latest_run(self, layer):
+        row = self.conn.execute(
+            "SELECT run_id FROM runs WHERE layer = ? ORDER BY run_id DESC LIMIT 1", (layer,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def runs_after(self, layer, run_id=None):
+        rows = self.conn.execute(
+            "SELECT run_id FROM runs WHERE layer = ? AND run_id > ? ORDER BY run_id", (layer, run_id or "")
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def objects(self, layer, run_id):
+        rows = self.conn.execute(
+            "SELECT object_name FROM objects WHERE layer = ? AND run_id = ? ORDER BY object_name", (layer, run_id)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def objects_in_runs(self, layer, run_ids):
+        object_names = []
+        for run_id in run_ids:
+            object_names.extend(self.objects(layer, run_id))
+        return object_names
+
+    def layer_objects(self, layer):
+        rows = self.conn.execute(
+            "SELECT object_name, run_id FROM objects WHERE layer = ? ORDER BY object_name", (layer,)
+        ).fetchall()
+        return rows
+
+    def replace_objects(self, layer, bucket_name, object_names, object_name, run_id, df=None, time_column="timestamp"):
+        # Swaps compacted objects for the object that now holds their rows in
+        # one transaction, so readers see either the old files or the new one.
+        # Runs left without objects are dropped, so they are not listed again
+        row_count = schema = min_timestamp = max_timestamp = None
+        if df is not None:
+            row_count, schema, min_timestamp, max_timestamp = frame_stats(df, time_column)
+        now = datetime.now(timezone.utc).isoformat()
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "DELETE FROM objects WHERE bucket = ? AND object_name = ?",
+                    [(bucket_name, name) for name in object_names],
+                )
+                self.conn.execute(
+                    """INSERT OR REPLACE INTO objects
+                       (bucket, object_name, layer, run_id, row_count, schema, min_timestamp, max_timestamp, created_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (bucket_name, object_name, layer, run_id, row_count,
+                     json.dumps(schema) if schema else None, min_timestamp, max_timestamp, now),
+                )
+                self.conn.execute(
+                    """DELETE FROM runs WHERE layer = ?
+                       AND NOT EXISTS (SELECT 1 FROM objects o WHERE o.layer = runs.layer AND o.run_id = runs.run_id)""",
+                    (layer,),
+                )
+
+    def object_info(self, layer, run_id):
+        cursor = self.conn.execute(
+            """SELECT object_name, row_count, schema, min_timestamp, max_timestamp
+               FROM objects WHERE layer = ? AND run_id = ? ORDER BY object_name""",
+            (layer, run_id),
+        )
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def latest_objects(self, layer, client=None, bucket_name=None):
+        run_id = self.latest_run(layer)
+        if run_id:
+            return self.objects(layer, run_id)
+        if client is None:
+            return []
+
+        print(f"No {layer} runs in the catalog yet, scanning {bucket_name}")
+        latest_file = scan_latest_object(client, bucket_name)
+        return run_objects(client, bucket_name, latest_file) if latest_file else []
+
+    def watermark(self, consumer, layer):
+        row = self.conn.execute(
+            "SELECT run_id FROM watermarks WHERE consumer = ? AND layer = ?", (consumer, layer)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, consumer, layer, run_id):
+        with self.lock:
+            self.conn.execute(
+                """INSERT INTO watermarks (consumer, layer, run_id, updated_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (consumer, layer) DO UPDATE SET run_id = excluded.run_id, updated_at = excluded.updated_at""",
+                (consumer, layer, run_id, datetime.now(timezone.utc).isoformat()),
+            )
+            self.conn.commit()
+
+    def unprocessed_runs(self, consumer, layer):
+        return self.runs_after(layer, self.watermark(consumer, layer))
+
+    def finished_partitions(self, job):
+        rows = self.conn.execute("SELECT partition FROM backfill_partitions WHERE job = ?", (job,)).fetchall()
+        return {row[0] for row in rows}
+
+    def finish_partition(self, job, partition, object_count, rows_loaded):
+        with self.lock:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO backfill_partitions (job, partition, object_count, rows_loaded, finished_at)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (job, partition, object_count, rows_loaded, datetime.now(timezone.utc).isoformat()),
+            )
+            self.conn.commit()
+
+    def reset_backfill(self, job):
+        with self.lock:
+            self.conn.execute("DELETE FROM backfill_partitions WHERE job = ?", (job,))
+            self.conn.commit()
@@ -0,0 +1,183 @@
+import os
+import sys
+from datetime import date, timedelta
+from io import BytesIO
+import polars as pl
+import pyarrow as pa
+from minio import Minio
+from minio.commonconfig import ENABLED, CopySource, Filter
+from minio.error import S3Error
+from minio.lifecycleconfig import Expiration, LifecycleConfig, Rule
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_Lake.lake import ARCHIVE_PREFIX, LAKE_EXTENSIONS, RAW_EXTENSION, parse_partition, read_object, read_table, to_table, write_parquet_bytes
+from data_Lake.catalog import Catalog
+from data_Lake.schemas import BRONZE_SCHEMA, CITY_UTILIZATION_SCHEMA, GOLD_SCHEMA, SILVER_SCHEMA, STATION_UTILIZATION_SCHEMA
+from data_Monitoring import metrics
+from data_Monitoring.metrics import instrument_client
+
+client = instrument_client(Minio(
+    "127.0.0.1:9000",
+    access_key=os.getenv("MINIO_ACCESS_KEY"),
+    secret_key=os.getenv("MINIO_SECRET_KEY"),
+    secure=False
+))
+
+COMPACT_AFTER_DAYS = int(os.getenv("COMPACT_AFTER_DAYS", "1"))
+COMPACTION_LAYERS = [layer for layer in os.getenv("COMPACTION_LAYERS", "bronze,silver,gold_append,station_utilization,city_utilization").split(",") if layer]
+COMPACTION_LIFECYCLE = os.getenv("COMPACTION_LIFECYCLE", "archive")
+COMPACTION_ARCHIVE_DAYS = int(os.getenv("COMPACTION_ARCHIVE_DAYS", "30"))
+
+# layer -> (bucket, schema, sort keys)
+LAYERS = {
+    "bronze": ("citybikes-bronze-layer", BRONZE_SCHEMA, ["id", "timestamp"]),
+    "silver": ("citybikes-silver-layer", SILVER_SCHEMA, ["id", "timestamp"]),
+    "gold_append": ("citybikes-gold-layer", GOLD_SCHEMA, ["timestamp"]),
+    "station_utilization": ("citybikes-gold-layer", STATION_UTILIZATION_SCHEMA, ["station_id", "window_start"]),
+    "city_utilization": ("citybikes-gold-layer", CITY_UTILIZATION_SCHEMA, ["window_start"]),
+}
+
+# Incremental gold exports repeat their trailing buckets to pick up late
+# facts; merged partitions keep the row of the newest run per key
+UNIQUE_KEYS = {
+    "gold_append": ["city_name", "timestamp"],
+}
+
+# Every run writes one small object per city and day. Once a day is closed and
+# its runs have been consumed, the objects of each city/day partition are
+# merged into one sorted parquet file, the catalog is pointed at it and the
+# originals are archived or deleted. A day of history is then one object.
+# Raw NDJSON bronze is merged without decoding: gzip members concatenate.
+
+# layer -> (consumer, layer) of the watermark its runs must be behind
+CONSUMED_BY = {
+    "bronze": ("processing", "bronze"),
+    "silver": ("loading", "silver"),
+}
+
+def compactable_runs(catalog, layer):
+    # The newest run is still read as "latest", and bronze and silver runs are
+    # only touched once processing or loading has moved past them
+    latest = catalog.latest_run(layer)
+    if layer in CONSUMED_BY:
+        watermark = catalog.watermark(*CONSUMED_BY[layer])
+        if watermark is None:
+            return lambda run_id: False
+        return lambda run_id: run_id <= watermark and run_id != latest
+    return lambda run_id: run_id != latest
+
+def compaction_groups(catalog, layer, cutoff):
+    allowed = compactable_runs(catalog, layer)
+    groups = {}
+    for object_name, run_id in catalog.layer_objects(layer):
+        if not object_name.endswith(LAKE_EXTENSIONS) or not allowed(run_id):
+            continue
+        day = parse_partition(object_name).get("date")
+        if not day or day == "unknown" or day > cutoff.isoformat():
+            continue
+        # Parquet and raw runs of the same day are merged separately
+        raw = object_name.endswith(RAW_EXTENSION)
+        groups.setdefault((object_name.rsplit("/", 1)[0], raw), []).append((object_name, run_id))
+    return {prefix: objects for prefix, objects in groups.items() if len(objects) > 1}
+
+def ensure_archive_lifecycle(client, bucket_name, days=COMPACTION_ARCHIVE_DAYS):
+    # Setting a configuration replaces every rule, so the bucket's other rules
+    # are kept and only ours is added or updated
+    current = client.get_bucket_lifecycle(bucket_name)
+    rules = [rule for rule in (current.rules if current else []) if rule.rule_id != "expire-compacted-originals"]
+    rules.append(Rule(ENABLED, rule_filter=Filter(prefix=ARCHIVE_PREFIX), rule_id="expire-compacted-originals", expiration=Expiration(days=days)))
+    client.set_bucket_lifecycle(bucket_name, LifecycleConfig(rules))
+
+def retire_objects(client, bucket_name, object_names, lifecycle=COMPACTION_LIFECYCLE):
+    for object_name in object_names:
+        try:
+            if lifecycle == "archive":
+                client.copy_object(bucket_name, f"{ARCHIVE_PREFIX}{object_name}", CopySource(bucket_name, object_name))
+            client.remove_object(bucket_name, object_name)
+        except S3Error as err:
+            # The catalog no longer points here, a leftover only costs space
+            print(f"Failed to retire {object_name}: {err}")
+
+@metrics.timed
+def compact_raw_partition(client, catalog, layer, prefix, objects, lifecycle=COMPACTION_LIFECYCLE):
+    bucket_name = LAYERS[layer][0]
+    object_names = sorted(object_name for object_name, _ in objects)
+    run_id = max(run_id for _, run_id in objects)
+    dataset = prefix.split("/", 1)[0]
+    target = f"{prefix}/{dataset}_{run_id}.compacted{RAW_EXTENSION}"
+
+    members = [read_object(client, bucket_name, object_name) for object_name in object_names]
+    if any(member is None for member in members):
+        print(f"Skipping {prefix}, not every object could be read")
+        return None
+    data = b"".join(members)
+
+    client.put_object(bucket_name, target, data=BytesIO(data), length=len(data))
+    catalog.replace_objects(layer, bucket_name, object_names, target, run_id)
+    retire_objects(client, bucket_name, [object_name for object_name in object_names if object_name != target], lifecycle)
+    print(f"Compacted {len(object_names)} raw objects into {target} ({len(data)} bytes)")
+    return target
+
+@metrics.timed
+def compact_partition(client, catalog, layer, prefix, objects, lifecycle=COMPACTION_LIFECYCLE):
+    bucket_name, schema, sort_keys = LAYERS[layer]
+    object_names = [object_name for object_name, _ in sorted(objects, key=lambda item: item[1])]
+    run_id = max(run_id for _, run_id in objects)
+    dataset = prefix.split("/", 1)[0]
+    target = f"{prefix}/{dataset}_{run_id}.compacted.parquet"
+
+    tables = []
+    for object_name in object_names:
+        # Runs written before a schema change are cast to the current schema
+        table = read_table(client, bucket_name, [object_name])
+        if table is not None:
+            tables.append(to_table(table, schema))
+    if len(tables) < len(object_names):
+        # Never retire originals whose rows did not make it into the merge
+        print(f"Skipping {prefix}, not every object could be read")
+        return None
+    table = pa.concat_tables(tables)
+    if layer in UNIQUE_KEYS:
+        table = to_table(pl.from_arrow(table).unique(subset=UNIQUE_KEYS[layer], keep="last", maintain_order=True), schema)
+    table = table.sort_by([(key, "ascending") for key in sort_keys])
+
+    buffer = write_parquet_bytes(table)
+    client.put_object(bucket_name, target, data=buffer, length=buffer.getbuffer().nbytes)
+    catalog.replace_objects(layer, bucket_name, object_names, target, run_id, table)
+    retire_objects(client, bucket_name, [object_name for object_name in object_names if object_name != target], lifecycle)
+
+    metrics.rows_in(sum(part.num_rows for part in tables))
+    metrics.rows_out(table.num_rows)
+    print(f"Compacted {len(object_names)} objects into {target} ({table.num_rows} rows)")
+    return target
+
+@metrics.timed
+def compact(client, catalog, layers=COMPACTION_LAYERS, after_days=COMPACT_AFTER_DAYS, lifecycle=COMPACTION_LIFECYCLE):
+    cutoff = date.today() - timedelta(days=after_days)
+    compacted = []
+    for layer in layers:
+        bucket_name = LAYERS[layer][0]
+        groups = compaction_groups(catalog, layer, cutoff)
+        print(f"{layer}: {len(groups)} partitions up to {cutoff} to compact")
+        if groups and lifecycle == "archive":
+            ensure_archive_lifecycle(client, bucket_name)
+        for (prefix, raw), objects in sorted(groups.items()):
+            try:
+                if raw:
+                    target = compact_raw_partition(client, catalog, layer, prefix, objects, lifecycle)
+                else:
+                    target = compact_partition(client, catalog, layer, prefix, objects, lifecycle)
+            except S3Error as err:
+                # Nothing was swapped in the catalog, the partition is retried next time
+                print(f"Failed to compact {prefix}: {err}")
+                continue
+            if target:
+                compacted.append(target)
+    return compacted
+
+if __name__ == "__main__":
+    with metrics.stage("compaction"):
+        catalog = Catalog()
+        compact(client, catalog)
+        catalog.close()
+    metrics.write_report("compaction")
@@ -0,0 +1,191 @@
+import os
+import tempfile
+from io import BytesIO
+from urllib.parse import quote, unquote
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from minio.error import S3Error
+
+STORAGE_FORMAT = os.getenv("STORAGE_FORMAT", "parquet")
+PARQUET_COMPRESSION = "zstd"
+
+# Objects are laid out Hive-style so readers can prune on the key alone:
+#   <dataset>/city_name=<city>/date=<YYYY-MM-DD>/<dataset>_<run_id>.parquet
+# Compacted partitions hold one <dataset>_<run_id>.compacted.parquet object
+# named after the newest run merged into it; replaced objects are moved under
+# ARCHIVE_PREFIX until the bucket lifecycle expires them. Raw bronze runs use
+# the same layout with gzip-compressed NDJSON objects (RAW_EXTENSION).
+ARCHIVE_PREFIX = "archive/"
+RAW_EXTENSION = ".ndjson.gz"
+LAKE_EXTENSIONS = (".parquet", RAW_EXTENSION)
+
+def partition_key(dataset, city_name, date, run_id, extension=".parquet"):
+    return f"{dataset}/city_name={quote(city_name, safe='')}/date={date}/{dataset}_{run_id}{extension}"
+
+def parse_partition(object_name):
+    partition = {}
+    for part in object_name.split("/")[:-1]:
+        if "=" in part:
+            key, value = part.split("=", 1)
+            partition[key] = unquote(value)
+    return partition
+
+def run_id_of(object_name):
+    base = object_name.rsplit("/", 1)[-1]
+    return base.rsplit("_", 1)[-1].split(".", 1)[0]
+
+def cast_column(column, data_type):
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    if pa.types.is_dictionary(data_type):
+        return pc.dictionary_encode(pc.cast(column, data_type.value_type, safe=False)).cast(data_type)
+    return pc.cast(column, data_type, safe=False)
+
+def to_table(df, schema):
+    if isinstance(df, pa.Table):
+        table = df
+    elif isinstance(df, pl.DataFrame):
+        table = df.to_arrow()
+    else:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(cast_column(table[field.name], field.type))
+        else:
+            columns.append(pa.nulls(table.num_rows, field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+def write_parquet_bytes(table):
+    buffer = BytesIO()
+    pq.write_table(table, buffer, compression=PARQUET_COMPRESSION)
+    buffer.seek(0)
+    return buffer
+
+def partition_columns(frame, time_column):
+    return frame.with_columns(
+        pl.col("city_name").cast(pl.String).fill_null("unknown").alias("_city"),
+        # Partitions are dated in UTC, whatever zone the frame is in
+        pl.col(time_column).dt.convert_time_zone("UTC").dt.date().cast(pl.String).fill_null("unknown").alias("_date"),
+    )
+
+def upload_partition(client, part, schema, bucket_name, dataset, city_name, date, run_id, time_column="timestamp", catalog=None, layer=None, strict=False):
+    object_name = partition_key(dataset, city_name, date, run_id)
+    part = to_table(part.drop(["_city", "_date"]), schema)
+    buffer = write_parquet_bytes(part)
+    try:
+        client.put_object(bucket_name, object_name, data=buffer, length=buffer.getbuffer().nbytes)
+    except S3Error as err:
+        print(f"Failed to upload {object_name}: {err}")
+        if strict:
+            raise
+        return None
+    if catalog is not None:
+        catalog.register(layer, bucket_name, object_name, run_id, part, time_column)
+    return object_name
+
+def write_partitioned(client, df, schema, bucket_name, dataset, run_id, time_column="timestamp", catalog=None, layer=None, strict=False):
+    frame = partition_columns(pl.from_arrow(to_table(df, schema)), time_column)
+
+    written = []
+    for (city_name, date), part in frame.partition_by(["_city", "_date"], as_dict=True).items():
+        object_name = upload_partition(client, part, schema, bucket_name, dataset, city_name, date, run_id, time_column, catalog, layer, strict)
+        if object_name:
+            written.append(object_name)
+
+    print(f"Uploaded {len(written)} parquet partitions of {dataset} to {bucket_name}")
+    return written
+
+def write_partitioned_lazy(client, lf, schema, bucket_name, dataset, run_id, time_column="timestamp", catalog=None, layer=None, strict=False):
+    # The plan is streamed into a local file first, after which one partition at
+    # a time is collected and uploaded, so memory never holds the whole batch
+    written = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, f"{dataset}_{run_id}.parquet")
+        lf.sink_parquet(path, compression=PARQUET_COMPRESSION)
+
+        scan = partition_columns(pl.scan_parquet(path), time_column)
+        keys = scan.select(["_city", "_date"]).unique().collect(streaming=True)
+        for city_name, date in keys.iter_rows():
+            part = scan.filter((pl.col("_city") == city_name) & (pl.col("_date") == date)).collect(streaming=True)
+            object_name = upload_partition(client, part, schema, bucket_name, dataset, city_name, date, run_id, time_column, catalog, layer, strict)
+            if object_name:
+                written.append(object_name)
+
+    print(f"Uploaded {len(written)} parquet partitions of {dataset} to {bucket_name}")
+    return written
+
+def download_objects(client, bucket_name, object_names, directory):
+    paths = []
+    for index, object_name in enumerate(object_names):
+        path = os.path.join(directory, f"{index:06d}_{object_name.rsplit('/', 1)[-1]}")
+        client.fget_object(bucket_name, object_name, path)
+        paths.append(path)
+    return paths
+
+def filter_partitions(object_names, cities=None, start_date=None, end_date=None):
+    selected = []
+    for object_name in object_names:
+        partition = parse_partition(object_name)
+        if cities and partition.get("city_name") not in cities:
+            continue
+        date = partition.get("date")
+        if start_date and date and date != "unknown" and date < str(start_date):
+            continue
+        if end_date and date and date != "unknown" and date > str(end_date):
+            continue
+        selected.append(object_name)
+    return selected
+
+def list_partition_objects(client, bucket_name, dataset, cities=None, start_date=None, end_date=None):
+    # Partition pruning happens on the object keys, nothing is downloaded here
+    prefixes = [f"{dataset}/city_name={quote(city, safe='')}/" for city in cities] if cities else [f"{dataset}/"]
+    objects = []
+    try:
+        for prefix in prefixes:
+            for obj in client.list_objects(bucket_name, prefix=prefix, recursive=True):
+                if obj.object_name.endswith(LAKE_EXTENSIONS):
+                    objects.append(obj.object_name)
+    except S3Error as err:
+        print(f"Error listing objects: {err}")
+    return filter_partitions(objects, start_date=start_date, end_date=end_date)
+
+def run_objects(client, bucket_name, object_name):
+    # All partitions written by the same run as object_name
+    if not object_name.endswith(LAKE_EXTENSIONS):
+        return [object_name]
+    dataset = object_name.split("/", 1)[0]
+    run_id = run_id_of(object_name)
+    return [name for name in list_partition_objects(client, bucket_name, dataset) if run_id_of(name) == run_id]
+
+def read_object(client, bucket_name, object_name):
+    try:
+        response = client.get_object(bucket_name, object_name)
+        data = response.read()
+        response.close()
+        response.release_conn()
+        return data
+    except S3Error as err:
+        print(f"Failed to download {object_name}: {err}")
+        return None
+
+def read_table(client, bucket_name, object_names, columns=None):
+    tables = []
+    for object_name in object_names:
+        try:
+            response = client.get_object(bucket_name, object_name)
+            data = BytesIO(response.read())
+            response.close()
+            response.release_conn()
+        except S3Error as err:
+            print(f"Failed to download {object_name}: {err}")
+            continue
+        tables.append(pq.read_table(data, columns=columns))
+
+    if not tables:
+        return None
+    print(f"Read {len(tables)} parquet objects from {bucket_name}")
+    return pa.concat_tables(tables)
@@ -0,0 +1,58 @@
+import pyarrow as pa
+
+# Network and city names repeat on every row; silver and gold store them
+# dictionary-encoded
+NAME_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+# A station record as the CityBikes API describes it. Every stage reads these
+# fields with these types; bronze and silver add the network and city names.
+STATION_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("name", pa.string()),
+    ("latitude", pa.float64()),
+    ("longitude", pa.float64()),
+    ("timestamp", pa.timestamp("us", tz="UTC")),
+    ("free_bikes", pa.int64()),
+    ("empty_slots", pa.int64()),
+])
+
+BRONZE_SCHEMA = pa.schema(list(STATION_SCHEMA) + [
+    ("extra", pa.string()),
+    ("network_name", pa.string()),
+    ("city_name", pa.string()),
+])
+
+SILVER_SCHEMA = pa.schema(list(STATION_SCHEMA) + [
+    ("network_name", NAME_TYPE),
+    ("city_name", NAME_TYPE),
+])
+
+GOLD_SCHEMA = pa.schema([
+    ("city_name", NAME_TYPE),
+    ("timestamp", pa.timestamp("us", tz="UTC")),
+    ("total_free_bikes", pa.int64()),
+])
+
+STATION_UTILIZATION_SCHEMA = pa.schema([
+    ("station_id", pa.string()),
+    ("station_name", pa.string()),
+    ("city_name", NAME_TYPE),
+    ("window_start", pa.timestamp("us", tz="UTC")),
+    ("occupancy_ratio", pa.float64()),
+    ("empty_seconds", pa.float64()),
+    ("full_seconds", pa.float64()),
+    ("bikes_taken", pa.int64()),
+    ("bikes_returned", pa.int64()),
+    ("observations", pa.int64()),
+])
+
+CITY_UTILIZATION_SCHEMA = pa.schema([
+    ("city_name", NAME_TYPE),
+    ("window_start", pa.timestamp("us", tz="UTC")),
+    ("avg_occupancy_ratio", pa.float64()),
+    ("empty_station_hours", pa.float64()),
+    ("full_station_hours", pa.float64()),
+    ("bikes_taken", pa.int64()),
+    ("bikes_returned", pa.int64()),
+    ("stations", pa.int64()),
+])
@@ -0,0 +1,174 @@
+import os
+import gzip
+import json
+from io import BytesIO
+import polars as pl
+from minio.error import S3Error
+from data_Lake.lake import RAW_EXTENSION, partition_key
+from data_Lake.schemas import STATION_SCHEMA
+from data_Monitoring import metrics
+
+BRONZE_FORMAT = os.getenv("BRONZE_FORMAT", "ndjson")
+SCHEMA_DRIFT = os.getenv("SCHEMA_DRIFT", "warn")
+RAW_COMPRESSLEVEL = 6
+
+# Bronze keeps every network response byte for byte, one NDJSON line per
+# network, gzip-compressed per city:
+#   {"network_name": ..., "city_name": ..., "fetched_at": ..., "response": <body>}
+# Readers parse the declared STATION_SCHEMA fields as text in one pass without
+# inferring anything and convert them with fixed dtypes. A value that is
+# present but does not fit its type, or a declared field the API stopped
+# sending, is reported as schema drift instead of silently becoming a null.
+
+STATION_TYPES = pl.from_arrow(STATION_SCHEMA.empty_table()).schema
+NAME_COLUMNS = ["network_name", "city_name"]
+# Sent by the API and kept in bronze, but not read by any stage
+IGNORED_FIELDS = {"extra"}
+OFFSET_FORMAT = "%Y-%m-%dT%H:%M:%S%.f%#z"
+NAIVE_FORMATS = ["%Y-%m-%dT%H:%M:%S%.fZ", "%Y-%m-%dT%H:%M:%S%.f"]
+
+RAW_SCHEMA = {
+    "network_name": pl.String,
+    "city_name": pl.String,
+    "response": pl.Struct({"network": pl.Struct({
+        "stations": pl.List(pl.Struct({name: pl.String for name in STATION_TYPES})),
+    })}),
+}
+
+def raw_line(network_name, city_name, fetched_at, body):
+    if b"\n" in body or b"\r" in body:
+        # A pretty-printed response is compacted so it stays on one line
+        body = json.dumps(json.loads(body), separators=(",", ":")).encode()
+    return b"".join([
+        b'{"network_name":', json.dumps(network_name).encode(),
+        b',"city_name":', json.dumps(city_name).encode(),
+        b',"fetched_at":', json.dumps(fetched_at).encode(),
+        b',"response":', body, b"}\n",
+    ])
+
+@metrics.timed
+def write_raw_partitioned(client, lines, bucket_name, dataset, run_id, date, catalog=None, layer=None, strict=False):
+    # lines are (city_name, line) pairs; objects are dated by the fetch
+    by_city = {}
+    for city_name, line in lines:
+        by_city.setdefault(city_name or "unknown", []).append(line)
+
+    written = []
+    for city_name, city_lines in by_city.items():
+        object_name = partition_key(dataset, city_name, date, run_id, RAW_EXTENSION)
+        data = gzip.compress(b"".join(city_lines), compresslevel=RAW_COMPRESSLEVEL)
+        try:
+            client.put_object(bucket_name, object_name, data=BytesIO(data), length=len(data))
+        except S3Error as err:
+            print(f"Failed to upload {object_name}: {err}")
+            if strict:
+                raise
+            continue
+        if catalog is not None:
+            catalog.register(layer, bucket_name, object_name, run_id)
+        written.append(object_name)
+
+    print(f"Uploaded {len(written)} raw NDJSON partitions of {dataset} to {bucket_name}")
+    return written
+
+def report_drift(message, values=1):
+    metrics.count("schema_drift_values", values)
+    if SCHEMA_DRIFT == "fail":
+        raise Exception(f"Schema drift in {message}")
+    print(f"Schema drift in {message}")
+
+def report_added_fields(fields, source):
+    added = sorted(set(fields) - set(STATION_TYPES) - IGNORED_FIELDS - set(NAME_COLUMNS))
+    if added:
+        print(f"{source}: new station fields {added} are kept in bronze but not read")
+
+def check_fields(fields, source):
+    report_added_fields(fields, source)
+    missing = [name for name in STATION_TYPES if name not in fields]
+    if missing:
+        report_drift(f"{source}: declared station fields {missing} are missing")
+
+def check_presence(raw, source):
+    # A declared field a station did not send reads as null, so every station
+    # is checked by counting the nulls of each declared column
+    nulls = raw.select(pl.col(list(STATION_TYPES)).null_count()).row(0, named=True)
+    missing = {name: count for name, count in nulls.items() if count}
+    if missing:
+        report_drift(f"{source}: declared station fields {list(missing)} are missing, in {missing} of {len(raw)} stations", sum(missing.values()))
+
+def convert(name, dtype):
+    column = pl.col(name)
+    if dtype == pl.String:
+        return column
+    if isinstance(dtype, pl.Datetime):
+        return pl.coalesce(
+            column.str.strptime(dtype, OFFSET_FORMAT, strict=False),
+            *[
+                column.str.strptime(pl.Datetime(dtype.time_unit), format, strict=False).dt.replace_time_zone(dtype.time_zone)
+                for format in NAIVE_FORMATS
+            ],
+        )
+    if dtype.is_integer():
+        # Older CSV runs wrote counts as "3.0"; a real fraction is still drift
+        number = column.cast(pl.Float64, strict=False)
+        return pl.when(number == number.floor()).then(number).cast(dtype, strict=False)
+    return column.cast(dtype, strict=False)
+
+def typed_stations(raw, source):
+    # raw holds the declared fields as text; every value that was present
+    # before the conversion and is null after it did not fit its type
+    typed = raw.with_columns([convert(name, dtype).alias(name) for name, dtype in STATION_TYPES.items()])
+    before = raw.select(pl.col(list(STATION_TYPES)).count()).row(0, named=True)
+    after = typed.select(pl.col(list(STATION_TYPES)).count()).row(0, named=True)
+    for name, dtype in STATION_TYPES.items():
+        lost = before[name] - after[name]
+        if lost:
+            samples = raw.filter(raw[name].is_not_null() & typed[name].is_null())[name].head(3).to_list()
+            report_drift(f"{source}: {lost} {name} values do not fit {dtype}, e.g. {samples}", lost)
+    return typed.select(list(STATION_TYPES) + NAME_COLUMNS)
+
+def sample_fields(data):
+    # Only the first station of the first line is decoded in Python. That is
+    # enough to notice fields the API added; missing ones are counted over
+    # every station after the typed read
+    first = data.split(b"\n", 1)[0]
+    if not first.strip():
+        return None
+    stations = (json.loads(first).get("response") or {}).get("network", {}).get("stations") or []
+    return set(stations[0]) if stations else None
+
+@metrics.timed
+def parse_raw(data, source="raw bronze"):
+    fields = sample_fields(data)
+    if fields is not None:
+        report_added_fields(fields, source)
+    try:
+        frame = pl.read_ndjson(BytesIO(data), schema=RAW_SCHEMA)
+    except Exception as err:
+        # A declared scalar that turned into an object cannot be read at all
+        raise Exception(f"Schema drift in {source}: {err}")
+
+    raw = (
+        frame.select(pl.col("response").struct.field("network").struct.field("stations"), *NAME_COLUMNS)
+        .explode("stations")
+        .filter(pl.col("stations").is_not_null())
+        .unnest("stations")
+    )
+    metrics.rows_in(len(raw))
+    check_presence(raw, source)
+    return typed_stations(raw, source)
+
+@metrics.timed
+def parse_csv(data, source="bronze CSV"):
+    # Every column is read as text, there is no inference pass to get wrong
+    raw = pl.read_csv(data, infer_schema_length=0)
+    check_fields(raw.columns, source)
+    raw = raw.with_columns([pl.lit(None, pl.String).alias(name) for name in list(STATION_TYPES) + NAME_COLUMNS if name not in raw.columns])
+    return typed_stations(raw, source)
+
+def read_station_file(path):
+    source = os.path.basename(path)
+    if path.endswith(RAW_EXTENSION):
+        with gzip.open(path, "rb") as f:
+            return parse_raw(f.read(), source)
+    return parse_csv(path, source)
@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import threading
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+
+STATION_STATE_PATH = os.getenv("STATION_STATE_PATH", ".catalog/station_state.db")
+CDC_MODE = os.getenv("CDC_MODE", "off")
+CDC_HEARTBEAT_MINUTES = int(os.getenv("CDC_HEARTBEAT_MINUTES", "15"))
+
+# Last observation of every station, per consumer (processing or load). An
+# observation is emitted when free_bikes or empty_slots differ from the
+# station's previous observation, or when it is the first one in a new
+# heartbeat window, so unchanged stations still produce a row every
+# CDC_HEARTBEAT_MINUTES. The reconstruct_bike_availability function in the
+# warehouse fills the gaps back in for aggregation.
+
+def to_polars(df):
+    if isinstance(df, pa.Table):
+        return pl.from_arrow(df)
+    if isinstance(df, pd.DataFrame):
+        # Silver read back from CSV still holds timestamps as strings
+        return pl.from_pandas(df.assign(timestamp=pd.to_datetime(df["timestamp"], utc=True)))
+    return df
+
+class StationStateStore:
+    def __init__(self, path=STATION_STATE_PATH, heartbeat_minutes=CDC_HEARTBEAT_MINUTES):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.heartbeat = f"{heartbeat_minutes}m"
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS station_state (
+                consumer TEXT NOT NULL,
+                station_id TEXT NOT NULL,
+                free_bikes INTEGER,
+                empty_slots INTEGER,
+                observed_at INTEGER NOT NULL,
+                PRIMARY KEY (consumer, station_id)
+            )
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def previous(self, consumer):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT station_id, free_bikes, empty_slots, observed_at FROM station_state WHERE consumer = ?", (consumer,)
+            ).fetchall()
+        state = pl.DataFrame(
+            rows, schema={"id": pl.String, "_state_free": pl.Int64, "_state_empty": pl.Int64, "_state_at": pl.Int64}, orient="row"
+        )
+        # Observation times are kept as UTC epoch microseconds
+        return state.with_columns(pl.from_epoch("_state_at", time_unit="us").dt.replace_time_zone("UTC"))
+
+    def changed(self, consumer, df):
+        if isinstance(df, pa.Table):
+            return self.changed(consumer, to_polars(df)).to_arrow()
+        if isinstance(df, pd.DataFrame):
+            return self.changed(consumer, to_polars(df)).to_pandas()
+
+        columns = df.collect_schema().names()
+        observed_at = pl.col("_at")
+        previous_free = pl.col("free_bikes").shift(1).over("id").fill_null(pl.col("_state_free"))
+        previous_empty = pl.col("empty_slots").shift(1).over("id").fill_null(pl.col("_state_empty"))
+        previous_at = observed_at.shift(1).over("id").fill_null(pl.col("_state_at"))
+
+        emitted = (
+            df.lazy()
+            .with_columns(pl.col("timestamp").dt.convert_time_zone("UTC").dt.cast_time_unit("us").alias("_at"))
+            .join(self.previous(consumer).lazy(), on="id", how="left")
+            # Observations the store has already seen are replays, not changes
+            .filter(pl.col("_state_at").is_null() | (observed_at > pl.col("_state_at")))
+            .sort(["id", "_at"])
+            .filter(
+                previous_at.is_null()
+                | (pl.col("free_bikes") != previous_free)
+                | (pl.col("empty_slots") != previous_empty)
+                | (observed_at.dt.truncate(self.heartbeat) != previous_at.dt.truncate(self.heartbeat))
+            )
+            .select(columns)
+        )
+        return emitted.collect() if isinstance(df, pl.DataFrame) else emitted
+
+    def update(self, consumer, df):
+        # Called with every observation of the batch, emitted or not, once the
+        # emitted rows are safely written
+        latest = (
+            to_polars(df).lazy()
+            .with_columns(pl.col("timestamp").dt.convert_time_zone("UTC").dt.cast_time_unit("us").dt.epoch("us").alias("_at"))
+            .sort("_at")
+            .group_by("id")
+            .agg(pl.col("free_bikes").last(), pl.col("empty_slots").last(), pl.col("_at").last())
+            .collect()
+        )
+        with self.lock:
+            self.conn.executemany(
+                """INSERT INTO station_state (consumer, station_id, free_bikes, empty_slots, observed_at)
+                   VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (consumer, station_id) DO UPDATE SET
+                       free_bikes = excluded.free_bikes,
+                       empty_slots = excluded.empty_slots,
+                       observed_at = excluded.observed_at
+                   WHERE excluded.observed_at > station_state.observed_at""",
+                [(consumer, *row) for row in latest.iter_rows()],
+            )
+            self.conn.commit()
+        return len(latest)
@@ -0,0 +1,162 @@
+import io
+import csv
+from datetime import timezone
+from itertools import chain, groupby, islice
+import pyarrow as pa
+import pyarrow.parquet as pq
+from data_Lake.lake import PARQUET_COMPRESSION, partition_key
+
+EXPORT_PART_SIZE = 16 * 1024 * 1024
+
+# Helpers to move query results into the lake without ever holding them in
+# full: rows are pulled from a cursor in fixed-size batches, encoded, and fed
+# to put_object as an unknown-length stream so MinIO does a multipart upload.
+
+class ChunkStream(io.RawIOBase):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+        self.exhausted = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while not self.exhausted and (size < 0 or len(self.buffer) < size):
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                self.exhausted = True
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+class ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def iter_batches(cur, batch_rows):
+    while True:
+        rows = cur.fetchmany(batch_rows)
+        if not rows:
+            break
+        yield rows
+
+def rows_to_table(rows, schema):
+    return pa.Table.from_pydict(
+        {field.name: [row[index] for row in rows] for index, field in enumerate(schema)},
+        schema=schema,
+    )
+
+def parquet_chunks(batches, schema, stats=None):
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression=PARQUET_COMPRESSION)
+    for rows in batches:
+        if stats is not None:
+            stats.update(rows)
+        writer.write_table(rows_to_table(rows, schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def csv_chunks(batches, columns, stats=None):
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    for rows in batches:
+        if stats is not None:
+            stats.update(rows)
+        writer.writerows(rows)
+        yield text.getvalue().encode()
+        text.seek(0)
+        text.truncate()
+
+class RowStats:
+    def __init__(self, time_index):
+        self.time_index = time_index
+        self.row_count = 0
+        self.min_timestamp = None
+        self.max_timestamp = None
+
+    def update(self, rows):
+        self.row_count += len(rows)
+        for row in rows:
+            value = row[self.time_index]
+            if value is None:
+                continue
+            if self.min_timestamp is None or value < self.min_timestamp:
+                self.min_timestamp = value
+            if self.max_timestamp is None or value > self.max_timestamp:
+                self.max_timestamp = value
+
+    def as_tuple(self, schema):
+        return (
+            self.row_count,
+            {field.name: str(field.type) for field in schema},
+            None if self.min_timestamp is None else str(self.min_timestamp),
+            None if self.max_timestamp is None else str(self.max_timestamp),
+        )
+
+def batched(rows, batch_rows):
+    while True:
+        batch = list(islice(rows, batch_rows))
+        if not batch:
+            break
+        yield batch
+
+def stream_object(client, bucket_name, object_name, chunks):
+    client.put_object(bucket_name, object_name, data=ChunkStream(chunks), length=-1, part_size=EXPORT_PART_SIZE)
+    print(f"Streamed {object_name} to {bucket_name}")
+
+def stream_partitioned(client, cur, schema, bucket_name, dataset, run_id, batch_rows, catalog=None, layer=None, time_column="timestamp"):
+    # Rows must arrive ordered by city_name and time, each (city, date) run of
+    # rows becomes one parquet object uploaded while the cursor is read
+    city_index = schema.names.index("city_name")
+    time_index = schema.names.index(time_column)
+
+    def partition_of(row):
+        timestamp = row[time_index]
+        date = timestamp.astimezone(timezone.utc).date() if timestamp is not None else "unknown"
+        return row[city_index] or "unknown", str(date)
+
+    rows = (row for batch in iter_batches(cur, batch_rows) for row in batch)
+    written = []
+    for (city_name, date), group in groupby(rows, key=partition_of):
+        object_name = partition_key(dataset, city_name, date, run_id)
+        stats = RowStats(time_index)
+        stream_object(client, bucket_name, object_name, parquet_chunks(batched(group, batch_rows), schema, stats))
+        written.append(object_name)
+        if catalog is not None:
+            catalog.register(layer, bucket_name, object_name, run_id, stats=stats.as_tuple(schema))
+    return written
+
+def stream_csv(client, cur, schema, bucket_name, object_name, batch_rows, catalog=None, layer=None, run_id=None, time_column="timestamp"):
+    batches = iter_batches(cur, batch_rows)
+    first = next(batches, None)
+    if first is None:
+        return []
+
+    stats = RowStats(schema.names.index(time_column))
+    stream_object(client, bucket_name, object_name, csv_chunks(chain([first], batches), schema.names, stats))
+    if catalog is not None:
+        catalog.register(layer, bucket_name, object_name, run_id, stats=stats.as_tuple(schema))
+    return [object_name]
@@ -0,0 +1,156 @@
+import os
+import sys
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from io import BytesIO
+import pyarrow as pa
+from minio.error import S3Error
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_Lake.lake import download_objects, list_partition_objects, parse_partition, read_object, read_table, run_id_of, to_table
+from data_Lake.station_records import parse_csv
+from data_Lake.catalog import Catalog
+from data_Lake.schemas import SILVER_SCHEMA
+from data_Loading.load import LOAD_COLUMNS, bulk_load, client
+from database_Setup.warehouse import connection, run_transaction
+from data_Processing.processing import BRONZE_BUCKET, SILVER_BUCKET, limit_polars_threads, process_data, scan_bronze_files
+from data_Monitoring import metrics
+
+BACKFILL_SOURCE = os.getenv("BACKFILL_SOURCE", "silver")
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", str(max(1, (os.cpu_count() or 1) // 2))))
+BACKFILL_RETRIES = int(os.getenv("BACKFILL_RETRIES", "3"))
+SCHEMA_MODE = os.getenv("SCHEMA_MODE", "star")
+
+SOURCES = {
+    "bronze": (BRONZE_BUCKET, "consolidated_stations"),
+    "silver": (SILVER_BUCKET, "cleaned_stations"),
+}
+
+# Rebuilds the warehouse from the lake. Objects in the date range are grouped
+# into one partition per day and every day is loaded by its own worker process
+# over its own connection, in its own transaction. Finished days are recorded
+# in the catalog, so running the same command again resumes an interrupted
+# backfill. Loads are plain upserts, so the live pipeline keeps loading while
+# a backfill runs and a day that is loaded twice does not duplicate facts.
+
+def csv_run_date(object_name):
+    run_id = run_id_of(object_name)
+    return datetime.strptime(run_id[:8], "%Y%m%d").date().isoformat()
+
+def list_csv_objects(bucket_name, dataset):
+    # Runs written before the lake was partitioned live at the top of the bucket
+    try:
+        return [
+            obj.object_name for obj in client.list_objects(bucket_name, prefix=f"{dataset}_")
+            if obj.object_name.endswith(".csv")
+        ]
+    except S3Error as err:
+        print(f"Error listing objects: {err}")
+        return []
+
+def plan_partitions(source, start_date, end_date):
+    bucket_name, dataset = SOURCES[source]
+    partitions = {}
+    for object_name in list_partition_objects(client, bucket_name, dataset, start_date=start_date, end_date=end_date):
+        day = parse_partition(object_name).get("date")
+        if day and day != "unknown":
+            partitions.setdefault(day, []).append(object_name)
+    for object_name in list_csv_objects(bucket_name, dataset):
+        day = csv_run_date(object_name)
+        if str(start_date) <= day <= str(end_date):
+            partitions.setdefault(day, []).append(object_name)
+    return dict(sorted(partitions.items()))
+
+def read_bronze(object_names):
+    # Bronze is cleaned exactly like the processing stage does it
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = download_objects(client, BRONZE_BUCKET, object_names, tmp)
+        return process_data(scan_bronze_files(paths)).collect().to_arrow()
+
+def read_silver(object_names):
+    tables = []
+    for object_name in object_names:
+        if object_name.endswith(".parquet"):
+            # Older runs hold plain strings, newer ones dictionaries; both are
+            # cast to the current schema before they are combined
+            table = read_table(client, SILVER_BUCKET, [object_name], columns=LOAD_COLUMNS)
+            if table is not None:
+                tables.append(to_table(table, SILVER_SCHEMA).select(LOAD_COLUMNS))
+            continue
+        data = read_object(client, SILVER_BUCKET, object_name)
+        if data is not None:
+            tables.append(to_table(parse_csv(BytesIO(data), object_name), SILVER_SCHEMA).select(LOAD_COLUMNS))
+    return pa.concat_tables(tables) if tables else None
+
+def backfill_partition(source, partition, object_names):
+    # Runs in a worker process with its own MinIO client and DB connection
+    table = read_bronze(object_names) if source == "bronze" else read_silver(object_names)
+    if table is None or table.num_rows == 0:
+        return partition, 0, 0
+
+    # Parallel days can race on the same new station or city, a deadlocked
+    # day is rolled back and loaded again
+    inserted, skipped = run_transaction(bulk_load, table, retries=BACKFILL_RETRIES)
+    return partition, inserted, skipped
+
+def refresh_aggregates(start_date, end_date):
+    # Refresh policies only look back a few hours, older buckets are filled here
+    with connection() as conn:
+        conn.autocommit = True
+        cur = conn.cursor()
+        for view in ("agg_city_minute", "agg_city_hour", "agg_station_day"):
+            cur.execute(
+                f"CALL refresh_continuous_aggregate('{view}', %s::TIMESTAMPTZ, %s::TIMESTAMPTZ)",
+                (start_date.isoformat(), (end_date + timedelta(days=1)).isoformat()),
+            )
+            print(f"Refreshed {view} from {start_date} to {end_date}")
+        cur.close()
+
+@metrics.timed
+def backfill(catalog, source, start_date, end_date, workers=BACKFILL_WORKERS, job=None, restart=False):
+    job = job or f"{source}:{start_date}:{end_date}"
+    if restart:
+        catalog.reset_backfill(job)
+
+    partitions = plan_partitions(source, start_date, end_date)
+    finished = catalog.finished_partitions(job)
+    pending = {partition: objects for partition, objects in partitions.items() if partition not in finished}
+    print(f"Backfill {job}: {len(partitions)} days found, {len(partitions) - len(pending)} already done, {len(pending)} to load on {workers} workers")
+
+    # Spawned, not forked, and sharing the cores like the partitioned processing stage
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    total_inserted = total_skipped = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=limit_polars_threads, initargs=(threads,)) as executor:
+        futures = {executor.submit(backfill_partition, source, partition, objects): partition for partition, objects in pending.items()}
+        for done, future in enumerate(as_completed(futures), start=1):
+            partition, inserted, skipped = future.result()
+            # Checkpointed only after the day's transaction has committed
+            catalog.finish_partition(job, partition, len(pending[partition]), inserted)
+            total_inserted += inserted
+            total_skipped += skipped
+            print(f"[{done}/{len(pending)}] {partition}: {inserted} facts inserted, {skipped} skipped")
+
+    metrics.rows_out(total_inserted)
+    if pending and SCHEMA_MODE == "hypertable":
+        refresh_aggregates(start_date, end_date)
+    print(f"Backfill {job} finished: {total_inserted} facts inserted, {total_skipped} skipped")
+    return total_inserted, total_skipped
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reload the warehouse from the data lake for a range of days.")
+    parser.add_argument("--start", required=True, type=date.fromisoformat, help="first day to load (YYYY-MM-DD)")
+    parser.add_argument("--end", required=True, type=date.fromisoformat, help="last day to load, inclusive (YYYY-MM-DD)")
+    parser.add_argument("--source", choices=sorted(SOURCES), default=BACKFILL_SOURCE, help="layer to replay")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS, help="days loaded in parallel")
+    parser.add_argument("--job", help="checkpoint name, defaults to source:start:end")
+    parser.add_argument("--restart", action="store_true", help="forget finished days and load the whole range again")
+    args = parser.parse_args()
+
+    with metrics.stage("backfill"):
+        catalog = Catalog()
+        backfill(catalog, args.source, args.start, args.end, args.workers, args.job, args.restart)
+        catalog.close()
+    metrics.write_report("backfill")
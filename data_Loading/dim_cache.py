@@ -0,0 +1,133 @@
+import os
+from collections import OrderedDict
+from datetime import datetime, timezone
+from psycopg2.extras import execute_values
+from database_Setup.warehouse import DB_PAGE_SIZE, execute_prepared
+
+DIM_CACHE_MAX_TIMESTAMPS = int(os.getenv("DIM_CACHE_MAX_TIMESTAMPS", "100000"))
+DIM_CACHE_MAX_STATIONS = int(os.getenv("DIM_CACHE_MAX_STATIONS", "200000"))
+
+def normalize_timestamp(timestamp):
+    if isinstance(timestamp, str):
+        dt = datetime.fromisoformat(timestamp)
+    elif hasattr(timestamp, "to_pydatetime"):
+        dt = timestamp.to_pydatetime()
+    else:
+        dt = timestamp
+    return dt.replace(microsecond=0)
+
+def timestamp_key(dt):
+    # Naive silver timestamps come from the API's UTC "Z" strings
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+class DimensionCache:
+    # Keeps timestamp -> time_id and station_id -> station_key in memory so a
+    # snapshot costs one round trip per batch of new keys instead of one per row.
+    # Both maps are LRU-bounded.
+    def __init__(self, max_timestamps=DIM_CACHE_MAX_TIMESTAMPS, max_stations=DIM_CACHE_MAX_STATIONS):
+        self.max_timestamps = max_timestamps
+        self.max_stations = max_stations
+        self.time_ids = OrderedDict()
+        self.stations = OrderedDict()
+        self.warmed = False
+
+    def _remember_time(self, key, time_id):
+        self.time_ids[key] = time_id
+        self.time_ids.move_to_end(key)
+        while len(self.time_ids) > self.max_timestamps:
+            self.time_ids.popitem(last=False)
+
+    def _remember_station(self, station_id, station_key):
+        self.stations[station_id] = station_key
+        self.stations.move_to_end(station_id)
+        while len(self.stations) > self.max_stations:
+            self.stations.popitem(last=False)
+
+    def warm(self, cur):
+        cur.execute("""
+            SELECT 'time', time_id, timestamp, NULL FROM (
+                SELECT time_id, timestamp FROM dim_time ORDER BY timestamp DESC LIMIT %s
+            ) recent_times
+            UNION ALL
+            SELECT 'station', station_key, NULL, station_id FROM (
+                SELECT station_key, station_id FROM dim_station LIMIT %s
+            ) known_stations
+        """, (self.max_timestamps, self.max_stations))
+
+        for kind, key, timestamp, station_id in cur.fetchall():
+            if kind == "time":
+                self._remember_time(timestamp_key(timestamp), key)
+            else:
+                self._remember_station(station_id, key)
+        self.warmed = True
+        print(f"Dimension cache warmed with {len(self.time_ids)} timestamps and {len(self.stations)} stations")
+
+    def resolve_times(self, cur, timestamps):
+        time_ids = {}
+        missing = {}
+        for timestamp in timestamps:
+            dt = normalize_timestamp(timestamp)
+            key = timestamp_key(dt)
+            if key in self.time_ids:
+                self.time_ids.move_to_end(key)
+                time_ids[timestamp] = self.time_ids[key]
+            else:
+                missing.setdefault(key, (dt, []))[1].append(timestamp)
+
+        if missing:
+            rows = execute_values(cur, """
+                INSERT INTO dim_time (timestamp, day, hour) VALUES %s
+                ON CONFLICT (timestamp) DO UPDATE SET timestamp = EXCLUDED.timestamp
+                RETURNING timestamp, time_id
+            """, [(key, key.date(), key.hour) for key in missing], page_size=DB_PAGE_SIZE, fetch=True)
+
+            for timestamp, time_id in rows:
+                key = timestamp_key(timestamp)
+                self._remember_time(key, time_id)
+                for original in missing[key][1]:
+                    time_ids[original] = time_id
+
+        return time_ids
+
+    def new_stations(self, df):
+        return df[~df["id"].isin(self.stations.keys())].drop_duplicates(subset=["id"])
+
+    def add_stations(self, cur, df):
+        stations = self.new_stations(df)
+        if not stations.empty:
+            execute_values(cur, """
+                INSERT INTO dim_city (city_name) VALUES %s
+                ON CONFLICT (city_name) DO NOTHING
+            """, [(city_name,) for city_name in stations["city_name"].astype(str).unique()], page_size=DB_PAGE_SIZE)
+            rows = execute_values(cur, """
+                INSERT INTO dim_station (station_id, station_name, latitude, longitude, city_id)
+                SELECT v.station_id, v.station_name, v.latitude, v.longitude, dc.city_id
+                FROM (VALUES %s) v (station_id, station_name, latitude, longitude, city_name)
+                JOIN dim_city dc ON dc.city_name = v.city_name
+                ON CONFLICT (station_id) DO UPDATE SET station_id = EXCLUDED.station_id
+                RETURNING station_id, station_key
+            """, list(stations[["id", "name", "latitude", "longitude", "city_name"]].astype({"city_name": str}).itertuples(index=False, name=None)), page_size=DB_PAGE_SIZE, fetch=True)
+            for station_id, station_key in rows:
+                self._remember_station(station_id, station_key)
+        return len(stations)
+
+    def station_keys(self, cur, df):
+        # Stations evicted from the cache are looked up again in one query. The
+        # keys are collected as they are found, since a batch with more stations
+        # than the cache holds evicts some of its own keys again
+        station_keys = {}
+        missing = []
+        for station_id in df["id"].unique():
+            if station_id in self.stations:
+                self.stations.move_to_end(station_id)
+                station_keys[station_id] = self.stations[station_id]
+            else:
+                missing.append(station_id)
+        if missing:
+            execute_prepared(cur, "station_keys", "SELECT station_id, station_key FROM dim_station WHERE station_id = ANY($1)", (missing,))
+            for station_id, station_key in cur.fetchall():
+                station_keys[station_id] = station_key
+                self._remember_station(station_id, station_key)
+        return station_keys
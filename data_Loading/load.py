@@ -1,40 +1,41 @@
 import os
-import psycopg2
-import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from datetime import datetime, timedelta, timezone
 from minio import Minio
 from minio.error import S3Error
-from io import BytesIO
+from io import BytesIO, StringIO
+import sys
 
-client = Minio(
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_Lake.lake import read_table
+from data_Lake.catalog import Catalog
+from data_Lake.station_state import CDC_MODE, StationStateStore
+from data_Lake.station_records import parse_csv
+from data_Loading.dim_cache import DimensionCache, normalize_timestamp, timestamp_key
+from database_Setup.warehouse import DB_COMMIT_ROWS, connection, copy_rows, execute_prepared, run_transaction
+from data_Monitoring import metrics
+from data_Monitoring.metrics import instrument_client
+
+client = instrument_client(Minio(
     "127.0.0.1:9000",
     access_key=os.getenv("MINIO_ACCESS_KEY"),
     secret_key=os.getenv("MINIO_SECRET_KEY"),
     secure=False
-)
+))
 
-def get_latest_silver_file(bucket_name):
-    try:
-        objects = client.list_objects(bucket_name, recursive=True)
-        latest_file = None
-        for obj in objects:
-            if latest_file is None or obj.last_modified > latest_file.last_modified:
-                latest_file = obj
-
-        if latest_file:
-            print(f"Latest file found: {latest_file.object_name}")
-            return latest_file.object_name
-        else:
-            print("No files found in the silver layer.")
-            return None
-    except S3Error as err:
-        print(f"Error listing objects: {err}")
-        return None
+SILVER_BUCKET = "citybikes-silver-layer"
+LOAD_COLUMNS = ["id", "name", "latitude", "longitude", "city_name", "timestamp", "free_bikes", "empty_slots"]
+LOAD_MODE = os.getenv("LOAD_MODE", "bulk")
+SCHEMA_MODE = os.getenv("SCHEMA_MODE", "star")
+
+dimension_cache = DimensionCache()
 
+@metrics.timed
 def fetch_csv_from_minio(bucket_name, object_name):
     try:
         response = client.get_object(bucket_name, object_name)
-        data = BytesIO(response.read()) 
+        data = BytesIO(response.read())
         response.close()
         response.release_conn()
         print(f"Downloaded {object_name} from {bucket_name}")
@@ -43,71 +44,217 @@ def fetch_csv_from_minio(bucket_name, object_name):
         print(f"Failed to download {object_name}: {err}")
         return None
 
-conn = psycopg2.connect(
-    dbname=os.getenv("DB_NAME"), user=os.getenv("DB_USER"), password=os.getenv("DB_PASSWORD"), host=os.getenv("DB_HOST"), port=os.getenv("DB_PORT")
-)
-cur = conn.cursor()
-
-bucket_name = "citybikes-silver-layer"
-latest_file = get_latest_silver_file(bucket_name)
-
-if latest_file:
-    csv_data = fetch_csv_from_minio(bucket_name, latest_file)
-    
-    if csv_data:
-        df = pd.read_csv(csv_data)
-
-        def insert_station_data():
-            for index, row in df.iterrows():
-                cur.execute("""
-                    INSERT INTO dim_station (station_id, station_name, latitude, longitude, city_name)
-                    VALUES (%s, %s, %s, %s, %s) ON CONFLICT (station_id) DO NOTHING
-                """, (row['id'], row['name'], row['latitude'], row['longitude'], row['city_name']))
-            conn.commit()
-            print("Station data inserted into dim_station")
-
-        def insert_time_data(timestamp):
-            dt = datetime.fromisoformat(timestamp).replace(microsecond=0)
-            
-            cur.execute("""
-                SELECT time_id FROM dim_time
-                WHERE timestamp = %s
-            """, (dt,))
-            
-            result = cur.fetchone()
-            if result:
-                return result[0]  
+@metrics.timed
+def read_silver(bucket_name, object_names):
+    if not object_names:
+        return None
+    if object_names[0].endswith(".parquet"):
+        table = read_table(client, bucket_name, object_names, columns=LOAD_COLUMNS)
+        return table.to_pandas() if table is not None else None
+    csv_data = fetch_csv_from_minio(bucket_name, object_names[0])
+    return parse_csv(csv_data, object_names[0]).select(LOAD_COLUMNS).to_pandas() if csv_data else None
+
+@metrics.timed
+def insert_station_data(conn, cur, df):
+    if not dimension_cache.warmed:
+        dimension_cache.warm(cur)
+    new_stations = dimension_cache.add_stations(cur, df)
+    conn.commit()
+    print(f"Station data inserted into dim_station ({new_stations} new)")
+
+@metrics.timed
+def insert_fact_data(conn, cur, df, commit_rows=DB_COMMIT_ROWS):
+    # All distinct timestamps of the snapshot are resolved in one batched upsert
+    time_ids = dimension_cache.resolve_times(cur, df['timestamp'].drop_duplicates())
+    station_keys = dimension_cache.station_keys(cur, df)
+    conn.commit()
+
+    # The per-row statements are prepared once per connection and the inserts
+    # are committed every commit_rows rows instead of one by one
+    pending = 0
+    for index, row in df.iterrows():
+        time_id = time_ids[row['timestamp']]
+        station_key = station_keys[row['id']]
+
+        if SCHEMA_MODE == "hypertable":
+            # The hypertable is keyed on (station_key, observed_at), which also
+            # lets the lookup skip every chunk but one
+            observed_at = timestamp_key(normalize_timestamp(row['timestamp']))
+            execute_prepared(cur, "fact_exists_observed", """
+                SELECT 1 FROM fact_bike_availability
+                WHERE station_key = $1 AND observed_at = $2
+            """, (station_key, observed_at))
+        else:
+            execute_prepared(cur, "fact_exists", """
+                SELECT 1 FROM fact_bike_availability
+                WHERE station_key = $1 AND time_id = $2
+            """, (station_key, time_id))
+
+        if cur.fetchone() is None:
+            if SCHEMA_MODE == "hypertable":
+                execute_prepared(cur, "fact_insert_observed", """
+                    INSERT INTO fact_bike_availability (station_key, time_id, observed_at, free_bikes, empty_slots)
+                    VALUES ($1, $2, $3, $4, $5)
+                """, (station_key, time_id, observed_at, row['free_bikes'], row['empty_slots']))
             else:
-                cur.execute("""
-                    INSERT INTO dim_time (timestamp, day, hour)
-                    VALUES (%s, %s, %s) RETURNING time_id
-                """, (dt, dt.date(), dt.hour))
-                time_id = cur.fetchone()[0]
+                execute_prepared(cur, "fact_insert", """
+                    INSERT INTO fact_bike_availability (station_key, time_id, free_bikes, empty_slots)
+                    VALUES ($1, $2, $3, $4)
+                """, (station_key, time_id, row['free_bikes'], row['empty_slots']))
+            pending += 1
+            if pending >= commit_rows:
                 conn.commit()
-                return time_id
-
-
-        def insert_fact_data():
-            for index, row in df.iterrows():
-                time_id = insert_time_data(row['timestamp'])
-                
-                cur.execute("""
-                    SELECT 1 FROM fact_bike_availability
-                    WHERE station_id = %s AND time_id = %s
-                """, (row['id'], time_id))
-                
-                if cur.fetchone() is None:
-                    cur.execute("""
-                        INSERT INTO fact_bike_availability (station_id, time_id, free_bikes, empty_slots)
-                        VALUES (%s, %s, %s, %s)
-                    """, (row['id'], time_id, row['free_bikes'], row['empty_slots']))
-                    conn.commit()
-                else:
-                    print(f"Data already exists for station {row['id']} at time {time_id}.")
-
-
-        insert_station_data()
-        insert_fact_data()
+                pending = 0
+            metrics.rows_out(1)
+        else:
+            print(f"Data already exists for station {row['id']} at time {time_id}.")
+    conn.commit()
+
+@metrics.timed
+def copy_to_staging(cur, df):
+    # Temporary tables are never WAL-logged and are private to this session,
+    # so parallel loaders each get their own staging area
+    cur.execute("""
+        CREATE TEMP TABLE staging_bike_availability (
+            station_id VARCHAR,
+            station_name VARCHAR,
+            latitude FLOAT,
+            longitude FLOAT,
+            city_name VARCHAR,
+            timestamp TIMESTAMPTZ,
+            free_bikes INTEGER,
+            empty_slots INTEGER
+        ) ON COMMIT DROP
+    """)
+
+    if isinstance(df, pa.Table):
+        # Dictionary-encoded names are written out as plain strings
+        staging = df.select(LOAD_COLUMNS)
+        for index, field in enumerate(staging.schema):
+            if pa.types.is_dictionary(field.type):
+                staging = staging.set_column(index, field.name, staging.column(index).cast(field.type.value_type))
+        buffer = BytesIO()
+        pa_csv.write_csv(staging, buffer, pa_csv.WriteOptions(include_header=False))
+    else:
+        staging = df[LOAD_COLUMNS].copy()
+        staging["free_bikes"] = staging["free_bikes"].astype("Int64")
+        staging["empty_slots"] = staging["empty_slots"].astype("Int64")
+        buffer = StringIO()
+        staging.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    copy_rows(cur, "staging_bike_availability", ["station_id", "station_name", "latitude", "longitude", "city_name", "timestamp", "free_bikes", "empty_slots"], buffer)
+    return len(staging)
 
+@metrics.timed
+def bulk_load(conn, df):
+    # COPY the whole frame once, then resolve dimensions and merge facts with
+    # set-based statements in a single transaction
+    cur = conn.cursor()
+    try:
+        staged = copy_to_staging(cur, df)
+
+        # Rows parsed with a lenient SCHEMA_DRIFT can miss required values; they
+        # are counted as skipped instead of aborting the whole batch
+        cur.execute("""
+            DELETE FROM staging_bike_availability
+            WHERE station_id IS NULL OR city_name IS NULL OR timestamp IS NULL OR free_bikes IS NULL OR empty_slots IS NULL
+        """)
+        incomplete = cur.rowcount
+
+        # Only unseen keys reach the INSERTs so conflicts do not burn sequence values
+        cur.execute("""
+            INSERT INTO dim_city (city_name)
+            SELECT DISTINCT s.city_name
+            FROM staging_bike_availability s
+            WHERE NOT EXISTS (SELECT 1 FROM dim_city dc WHERE dc.city_name = s.city_name)
+            ON CONFLICT (city_name) DO NOTHING
+        """)
+
+        cur.execute("""
+            INSERT INTO dim_station (station_id, station_name, latitude, longitude, city_id)
+            SELECT DISTINCT ON (s.station_id) s.station_id, s.station_name, s.latitude, s.longitude, dc.city_id
+            FROM staging_bike_availability s
+            JOIN dim_city dc ON dc.city_name = s.city_name
+            WHERE NOT EXISTS (SELECT 1 FROM dim_station ds WHERE ds.station_id = s.station_id)
+              -- A new station needs its name and location; its facts wait until they are known
+              AND s.station_name IS NOT NULL AND s.latitude IS NOT NULL AND s.longitude IS NOT NULL
+            ORDER BY s.station_id, s.timestamp DESC
+            ON CONFLICT (station_id) DO NOTHING
+        """)
+        new_stations = cur.rowcount
+
+        # day and hour are the UTC ones, as in DimensionCache.resolve_times,
+        # whatever the session time zone is
+        cur.execute("""
+            INSERT INTO dim_time (timestamp, day, hour)
+            SELECT ts, (ts AT TIME ZONE 'UTC')::date, EXTRACT(HOUR FROM ts AT TIME ZONE 'UTC')::INTEGER
+            FROM (SELECT DISTINCT date_trunc('second', timestamp) AS ts FROM staging_bike_availability) s
+            ON CONFLICT (timestamp) DO NOTHING
+        """)
+        new_times = cur.rowcount
+
+        if SCHEMA_MODE == "hypertable":
+            cur.execute("""
+                INSERT INTO fact_bike_availability (station_key, time_id, observed_at, free_bikes, empty_slots)
+                SELECT ds.station_key, dt.time_id, dt.timestamp, s.free_bikes, s.empty_slots
+                FROM staging_bike_availability s
+                JOIN dim_station ds ON ds.station_id = s.station_id
+                JOIN dim_time dt ON dt.timestamp = date_trunc('second', s.timestamp)
+                ON CONFLICT DO NOTHING
+            """)
+        else:
+            cur.execute("""
+                INSERT INTO fact_bike_availability (station_key, time_id, free_bikes, empty_slots)
+                SELECT ds.station_key, dt.time_id, s.free_bikes, s.empty_slots
+                FROM staging_bike_availability s
+                JOIN dim_station ds ON ds.station_id = s.station_id
+                JOIN dim_time dt ON dt.timestamp = date_trunc('second', s.timestamp)
+                ON CONFLICT DO NOTHING
+            """)
+        inserted = cur.rowcount
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    skipped = staged - inserted
+    metrics.rows_in(staged)
+    metrics.rows_out(inserted)
+    print(f"Bulk load: {staged} rows staged, {new_stations} new stations, {new_times} new timestamps, {inserted} facts inserted, {skipped} skipped ({incomplete} incomplete)")
+    return inserted, skipped
+
+@metrics.timed
+def load_rows(conn, df):
+    metrics.rows_in(len(df))
+    cur = conn.cursor()
+    insert_station_data(conn, cur, df)
+    insert_fact_data(conn, cur, df)
     cur.close()
-    conn.close()
+
+if __name__ == "__main__":
+    with metrics.stage("loading"):
+        catalog = Catalog()
+        silver_run = catalog.latest_run("silver")
+        latest_files = catalog.latest_objects("silver", client, SILVER_BUCKET)
+        df = read_silver(SILVER_BUCKET, latest_files)
+
+        if df is not None:
+            store = StationStateStore() if CDC_MODE == "load" else None
+            changes = store.changed("load", df) if store else df
+            if LOAD_MODE == "rows":
+                with connection() as conn:
+                    load_rows(conn, changes)
+            else:
+                run_transaction(bulk_load, changes)
+            if store:
+                store.update("load", df)
+                store.close()
+            if silver_run:
+                # Compaction only merges the silver runs loading has moved past
+                catalog.set_watermark("loading", "silver", silver_run)
+        else:
+            print("No files found in the silver layer.")
+    metrics.write_report("loading")
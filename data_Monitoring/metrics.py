@@ -0,0 +1,332 @@
+import os
+import io
+import json
+import time
+import threading
+import functools
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import psycopg2.extensions
+
+METRICS_DIR = os.getenv("METRICS_DIR", ".metrics")
+METRICS_PREFIX = "citybikes"
+PROFILE_STAGES = {stage for stage in os.getenv("PROFILE_STAGES", "").split(",") if stage}
+PROFILER = os.getenv("PROFILER", "cprofile")
+
+# Counters shared by every stage. Each value is keyed by metric name and
+# labels; the stage label comes from the innermost stage() the calling thread
+# is in, or from the last stage entered when the thread is a worker pool thread.
+
+class MetricsRegistry:
+    def __init__(self):
+        self.values = {}
+        self.maxima = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.started_at = datetime.now(timezone.utc)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe_max(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.maxima[key] = max(self.maxima.get(key, 0), value)
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values), dict(self.maxima), dict(self.gauges)
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+            self.maxima.clear()
+            self.gauges.clear()
+            self.started_at = datetime.now(timezone.utc)
+
+registry = MetricsRegistry()
+local = threading.local()
+last_stage = ["pipeline"]
+
+def current_stage():
+    stages = getattr(local, "stages", None)
+    return stages[-1] if stages else last_stage[0]
+
+def count(name, value=1, stage=None):
+    registry.inc(name, value, stage=stage or current_stage())
+
+def gauge(name, value, stage=None):
+    # The last value wins, for readings such as freshness that must not be summed
+    registry.set(name, value, stage=stage or current_stage())
+
+def rows_in(value, stage=None):
+    count("rows_in", value, stage)
+
+def rows_out(value, stage=None):
+    count("rows_out", value, stage)
+
+def http_request(status=None):
+    count("http_requests")
+    if status == 429:
+        count("http_rate_limited")
+
+def http_retry():
+    count("http_retries")
+
+def start_profiler(name):
+    if PROFILER == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("pyinstrument is not installed, falling back to cProfile")
+        else:
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stop_profiler(name, profiler):
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        path = os.path.join(METRICS_DIR, f"profile_{name}_{stamp}.prof")
+        profiler.dump_stats(path)
+    else:
+        profiler.stop()
+        path = os.path.join(METRICS_DIR, f"profile_{name}_{stamp}.html")
+        with open(path, "w") as file:
+            file.write(profiler.output_html())
+    print(f"Profile of {name} written to {path}")
+
+@contextmanager
+def stage(name):
+    stages = getattr(local, "stages", None)
+    if stages is None:
+        stages = local.stages = []
+    stages.append(name)
+    previous, last_stage[0] = last_stage[0], name
+    profiler = start_profiler(name) if name in PROFILE_STAGES else None
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if profiler is not None:
+            stop_profiler(name, profiler)
+        registry.inc("stage_seconds", elapsed, stage=name)
+        registry.inc("stage_runs", 1, stage=name)
+        stages.pop()
+        last_stage[0] = previous
+
+def timed(fn):
+    # Wall time, calls and the slowest call per function and stage
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            labels = {"stage": current_stage(), "function": fn.__qualname__}
+            registry.inc("function_seconds", elapsed, **labels)
+            registry.inc("function_calls", 1, **labels)
+            registry.observe_max("function_max_seconds", elapsed, **labels)
+    return wrapper
+
+class CountingResponse:
+    def __init__(self, response):
+        self.response = response
+
+    def read(self, *args, **kwargs):
+        data = self.response.read(*args, **kwargs)
+        count("minio_bytes_read", len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+class CountingStream(io.RawIOBase):
+    def __init__(self, stream):
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        count("minio_bytes_written", len(data))
+        return data
+
+class InstrumentedMinio:
+    # Wraps a Minio client and counts requests and bytes moved per stage;
+    # everything else is passed through untouched
+    def __init__(self, client):
+        self.client = client
+
+    def put_object(self, bucket_name, object_name, data, length, *args, **kwargs):
+        count("minio_requests")
+        if length is not None and length >= 0:
+            count("minio_bytes_written", length)
+        else:
+            data = CountingStream(data)
+        return self.client.put_object(bucket_name, object_name, data, length, *args, **kwargs)
+
+    def get_object(self, *args, **kwargs):
+        count("minio_requests")
+        return CountingResponse(self.client.get_object(*args, **kwargs))
+
+    def fput_object(self, bucket_name, object_name, file_path, *args, **kwargs):
+        count("minio_requests")
+        count("minio_bytes_written", os.path.getsize(file_path))
+        return self.client.fput_object(bucket_name, object_name, file_path, *args, **kwargs)
+
+    def fget_object(self, bucket_name, object_name, file_path, *args, **kwargs):
+        count("minio_requests")
+        result = self.client.fget_object(bucket_name, object_name, file_path, *args, **kwargs)
+        count("minio_bytes_read", os.path.getsize(file_path))
+        return result
+
+    def list_objects(self, *args, **kwargs):
+        count("minio_requests")
+        return self.client.list_objects(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+def instrument_client(client):
+    return client if isinstance(client, InstrumentedMinio) else InstrumentedMinio(client)
+
+class MetricsCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        count("db_round_trips")
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        count("db_round_trips", len(vars_list))
+        return super().executemany(query, vars_list)
+
+    def callproc(self, procname, parameters=None):
+        count("db_round_trips")
+        return super().callproc(procname, parameters)
+
+    def copy_expert(self, sql, file, size=8192):
+        count("db_round_trips")
+        return super().copy_expert(sql, file, size)
+
+    def fetchmany(self, size=None):
+        # Named cursors go back to the server for every batch
+        if self.name:
+            count("db_round_trips")
+        return super().fetchmany(size) if size is not None else super().fetchmany()
+
+class MetricsConnection(psycopg2.extensions.connection):
+    # Pass as connection_factory to psycopg2.connect or a pool
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", MetricsCursor)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        count("db_commits")
+        count("db_round_trips")
+        return super().commit()
+
+    def rollback(self):
+        count("db_round_trips")
+        return super().rollback()
+
+def format_labels(labels):
+    return ",".join(f'{name}="{value}"' for name, value in labels)
+
+def prometheus_text():
+    values, maxima, gauges = registry.snapshot()
+    lines = []
+    for metrics, kind in ((values, "counter"), (maxima, "gauge"), (gauges, "gauge")):
+        names = sorted({name for name, _ in metrics})
+        for name in names:
+            metric = f"{METRICS_PREFIX}_{name}" + ("_total" if kind == "counter" else "")
+            lines.append(f"# TYPE {metric} {kind}")
+            for (key, labels), value in sorted(metrics.items()):
+                if key == name:
+                    lines.append(f"{metric}{{{format_labels(labels)}}} {value}")
+    return "\n".join(lines) + "\n"
+
+def report(run_id=None):
+    values, maxima, gauges = registry.snapshot()
+    stages = {}
+    for (name, labels), value in list(values.items()) + list(gauges.items()):
+        labels = dict(labels)
+        entry = stages.setdefault(labels.pop("stage", "pipeline"), {"functions": {}})
+        if "function" in labels:
+            function = entry["functions"].setdefault(labels["function"], {})
+            function[name.replace("function_", "")] = value
+        else:
+            entry[name] = value
+    for (name, labels), value in maxima.items():
+        labels = dict(labels)
+        stages.setdefault(labels["stage"], {"functions": {}})["functions"].setdefault(labels["function"], {})["max_seconds"] = value
+    return {
+        "run_id": run_id or datetime.now().strftime('%Y%m%d%H%M%S'),
+        "started_at": registry.started_at.isoformat(),
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        "stages": stages,
+    }
+
+def write_prometheus(name):
+    # One file per job, in the format of the node_exporter textfile collector
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{name}.prom")
+    with open(f"{path}.tmp", "w") as file:
+        file.write(prometheus_text())
+    os.replace(f"{path}.tmp", path)
+    return path
+
+def write_report(name, run_id=None):
+    run_report = report(run_id)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"report_{name}_{run_report['run_id']}.json")
+    with open(path, "w") as file:
+        json.dump(run_report, file, indent=2, default=str)
+    write_prometheus(name)
+    print(f"Metrics report written to {path}")
+    return run_report
+
+def reports_since(started_at):
+    if not os.path.isdir(METRICS_DIR):
+        return []
+    reports = []
+    for file_name in sorted(os.listdir(METRICS_DIR)):
+        path = os.path.join(METRICS_DIR, file_name)
+        if file_name.startswith("report_") and file_name.endswith(".json") and os.path.getmtime(path) >= started_at:
+            with open(path) as file:
+                reports.append(json.load(file))
+    return reports
+
+def attach_to_prefect(reports, key="pipeline-metrics"):
+    # Stage summary as a table artifact on the current flow run, the full
+    # reports as a markdown artifact
+    from prefect.artifacts import create_markdown_artifact, create_table_artifact
+    from prefect.context import FlowRunContext
+
+    if FlowRunContext.get() is None:
+        return
+    rows = []
+    for run_report in reports:
+        for name, entry in sorted(run_report["stages"].items()):
+            rows.append({"stage": name, **{metric: value for metric, value in entry.items() if metric != "functions"}})
+    create_table_artifact(key=key, table=rows, description="Rows, bytes, requests and round trips per stage")
+    create_markdown_artifact(
+        key=f"{key}-report",
+        markdown="\n\n".join(f"```json\n{json.dumps(run_report, indent=2, default=str)}\n```" for run_report in reports),
+    )
@@ -4,33 +4,37 @@ from minio import Minio
 from minio.error import S3Error
 from io import BytesIO
 import os
+import sys
+import tempfile
+import zlib
+import gzip
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-client = Minio(
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_Lake.lake import RAW_EXTENSION, STORAGE_FORMAT, download_objects, parse_partition, read_object, read_table, write_partitioned, write_partitioned_lazy
+from data_Lake.catalog import Catalog
+from data_Lake.schemas import SILVER_SCHEMA
+from data_Lake.station_state import CDC_MODE, StationStateStore
+from data_Lake.station_records import parse_csv, parse_raw, read_station_file
+from data_Monitoring import metrics
+from data_Monitoring.metrics import instrument_client
+
+client = instrument_client(Minio(
     "127.0.0.1:9000",
     access_key=os.getenv("MINIO_ACCESS_KEY"),
     secret_key=os.getenv("MINIO_SECRET_KEY"),
     secure=False
-)
-
+))
 
-def get_latest_bronze_file(bucket_name):
-    try:
-        objects = client.list_objects(bucket_name, recursive=True)
-        latest_file = None
-        for obj in objects:
-            if latest_file is None or obj.last_modified > latest_file.last_modified:
-                latest_file = obj
-
-        if latest_file:
-            print(f"Latest file found: {latest_file.object_name}")
-            return latest_file.object_name
-        else:
-            print("No files found in the bronze layer.")
-            return None
-    except S3Error as err:
-        print(f"Error listing objects: {err}")
-        return None
+BRONZE_BUCKET = "citybikes-bronze-layer"
+SILVER_BUCKET = "citybikes-silver-layer"
+PROCESSING_MODE = os.getenv("PROCESSING_MODE", "incremental")
+PROCESSING_MAX_RUNS = int(os.getenv("PROCESSING_MAX_RUNS", "0"))
+PROCESSING_WORKERS = int(os.getenv("PROCESSING_WORKERS", str(os.cpu_count() or 1)))
+PROCESSING_PARTITIONS = int(os.getenv("PROCESSING_PARTITIONS", "0"))
 
+@metrics.timed
 def fetch_bronze_data(bucket_name, file_name):
     try:
         response = client.get_object(bucket_name, file_name)
@@ -43,17 +47,14 @@ def fetch_bronze_data(bucket_name, file_name):
         print(f"Failed to fetch {file_name}: {err}")
         return None
 
+@metrics.timed
 def load_data(data):
     try:
-        df = pl.read_csv(data)
+        df = parse_csv(data)
         print(f"Data loaded from memory")
 
         df = df.with_columns([
-            pl.col("timestamp")
-            .str.replace("Z$", "") 
-            .str.strptime(pl.Datetime) 
-            .dt.replace_time_zone("UTC") 
-            .dt.convert_time_zone("Europe/Brussels") 
+            pl.col("timestamp").dt.convert_time_zone("Europe/Brussels")
         ])
 
         return df
@@ -62,15 +63,60 @@ def load_data(data):
         return None
 
 
-def process_data(df):
-    df = df.with_columns([
-        pl.col("timestamp").str.replace("Z$", "").alias("timestamp"),  
-        pl.col("free_bikes").cast(pl.Int64, strict=False),  
-        pl.col("empty_slots").cast(pl.Int64, strict=False), 
-        pl.col("latitude").cast(pl.Float64, strict=False),  
-        pl.col("longitude").cast(pl.Float64, strict=False)  
+@metrics.timed
+def load_raw_data(bucket_name, object_names):
+    frames = []
+    for object_name in object_names:
+        data = read_object(client, bucket_name, object_name)
+        if data is not None:
+            frames.append(parse_raw(gzip.decompress(data), object_name))
+    if not frames:
+        return None
+
+    df = pl.concat(frames).with_columns([
+        pl.col("timestamp").dt.convert_time_zone("Europe/Brussels")
     ])
+    print(f"Data loaded from {len(frames)} raw NDJSON partitions")
+    return df
+
+@metrics.timed
+def load_parquet_data(bucket_name, object_names):
+    # Only the columns that survive into silver are read, "extra" is pruned
+    table = read_table(client, bucket_name, object_names, columns=SILVER_SCHEMA.names)
+    if table is None:
+        return None
 
+    df = pl.from_arrow(table).with_columns([
+        pl.col("timestamp").dt.convert_time_zone("Europe/Brussels")
+    ])
+    print(f"Data loaded from {len(object_names)} parquet partitions")
+    return df
+
+def scan_bronze_files(paths):
+    # Lazy plan over every downloaded bronze file. Raw NDJSON and CSV runs are
+    # parsed once with the declared dtypes into a typed parquet file next to
+    # the download, so the plan still streams and nothing is inferred
+    frames = []
+    parquet_paths = [path for path in paths if path.endswith(".parquet")]
+    if parquet_paths:
+        frames.append(pl.scan_parquet(parquet_paths).select(SILVER_SCHEMA.names))
+
+    typed_paths = []
+    for path in paths:
+        if path.endswith((RAW_EXTENSION, ".csv")):
+            typed_path = f"{path}.parquet"
+            read_station_file(path).write_parquet(typed_path)
+            typed_paths.append(typed_path)
+    if typed_paths:
+        frames.append(pl.scan_parquet(typed_paths).select(SILVER_SCHEMA.names))
+
+    return pl.concat(frames, how="vertical_relaxed").with_columns([
+        pl.col("timestamp").dt.convert_time_zone("Europe/Brussels")
+    ])
+
+@metrics.timed
+def process_data(df):
+    # Every reader already produces the declared dtypes, nothing is cast here
     df = df.sort(by="timestamp", descending=True).unique(subset=["id", "timestamp"])
     df = df.drop_nulls(subset=["free_bikes", "empty_slots", "timestamp", "city_name"])
     df = df.filter(
@@ -82,6 +128,19 @@ def process_data(df):
     print("Data processed: deduplicated and validated")
     return df
 
+@metrics.timed
+def process_table(table):
+    # Arrow in, Arrow out: pl.from_arrow and to_arrow share the buffers, so the
+    # in-process runner hands data between stages without copying it
+    df = pl.from_arrow(table.select(SILVER_SCHEMA.names)).with_columns([
+        pl.col("timestamp").dt.convert_time_zone("Europe/Brussels")
+    ])
+    silver = process_data(df).to_arrow()
+    metrics.rows_in(table.num_rows)
+    metrics.rows_out(silver.num_rows)
+    return silver
+
+@metrics.timed
 def save_and_upload(df, bucket_name, file_name):
     csv_buffer = BytesIO()  
     df.write_csv(csv_buffer)
@@ -90,22 +149,186 @@ def save_and_upload(df, bucket_name, file_name):
     try:
         client.put_object(bucket_name, file_name, data=csv_buffer, length=csv_buffer.getbuffer().nbytes)
         print(f"Uploaded {file_name} to {bucket_name}")
+        return True
     except S3Error as err:
         print(f"Failed to upload {file_name}: {err}")
+        return False
 
-if __name__ == "__main__":
-    bronze_bucket = "citybikes-bronze-layer"
-    bronze_file = get_latest_bronze_file(bronze_bucket)
+@metrics.timed
+def process_latest(catalog):
+    bronze_files = catalog.latest_objects("bronze", client, BRONZE_BUCKET)
 
-    if bronze_file:
-        bronze_data = fetch_bronze_data(bronze_bucket, bronze_file)
+    if bronze_files:
+        df = None
+        if bronze_files[0].endswith(RAW_EXTENSION):
+            df = load_raw_data(BRONZE_BUCKET, bronze_files)
+        elif bronze_files[0].endswith(".parquet"):
+            df = load_parquet_data(BRONZE_BUCKET, bronze_files)
+        else:
+            bronze_data = fetch_bronze_data(BRONZE_BUCKET, bronze_files[0])
+            if bronze_data:
+                df = load_data(bronze_data)
+
+        if df is not None:
+            cleaned_df = process_data(df)
+            store = StationStateStore() if CDC_MODE == "processing" else None
+            emitted_df = store.changed("processing", cleaned_df) if store else cleaned_df
+            metrics.rows_in(len(df))
+            metrics.rows_out(len(emitted_df))
+
+            run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+            if STORAGE_FORMAT == "parquet":
+                write_partitioned(client, emitted_df, SILVER_SCHEMA, SILVER_BUCKET, "cleaned_stations", run_id, catalog=catalog, layer="silver")
+            else:
+                silver_file = f"cleaned_stations_{run_id}.csv"
+                if save_and_upload(emitted_df, SILVER_BUCKET, silver_file):
+                    catalog.register("silver", SILVER_BUCKET, silver_file, run_id, emitted_df)
+            if store:
+                store.update("processing", cleaned_df)
+                store.close()
+    else:
+        print("No files found in the bronze layer.")
+
+def emit_changes(store, cleaned):
+    # Change detection compares every observation with the previous one of its
+    # station in over() windows, which the streaming engine cannot run, so with
+    # CDC the emitted rows are collected instead of sunk
+    if store is None:
+        return cleaned
+    return store.changed("processing", cleaned).collect()
+
+def write_silver(emitted, run_id, catalog):
+    if isinstance(emitted, pl.LazyFrame):
+        return write_partitioned_lazy(client, emitted, SILVER_SCHEMA, SILVER_BUCKET, "cleaned_stations", run_id, catalog=catalog, layer="silver", strict=True)
+    return write_partitioned(client, emitted, SILVER_SCHEMA, SILVER_BUCKET, "cleaned_stations", run_id, catalog=catalog, layer="silver", strict=True)
+
+@metrics.timed
+def process_incremental(catalog, max_runs=PROCESSING_MAX_RUNS):
+    # Every bronze run after the processing watermark goes into one batch, the
+    # watermark only moves once the silver output of that batch is uploaded
+    runs = catalog.unprocessed_runs("processing", "bronze")
+    if max_runs:
+        runs = runs[:max_runs]
+    if not runs:
+        print("No unprocessed bronze runs found.")
+        return []
+
+    bronze_files = catalog.objects_in_runs("bronze", runs)
+    print(f"Processing {len(bronze_files)} bronze objects from {len(runs)} runs")
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    store = StationStateStore() if CDC_MODE == "processing" else None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = download_objects(client, BRONZE_BUCKET, bronze_files, tmp)
+        cleaned = process_data(scan_bronze_files(paths))
+        emitted = emit_changes(store, cleaned)
+
+        if STORAGE_FORMAT == "parquet":
+            written = write_silver(emitted, run_id, catalog)
+        else:
+            silver_file = f"cleaned_stations_{run_id}.csv"
+            silver_path = os.path.join(tmp, silver_file)
+            if isinstance(emitted, pl.LazyFrame):
+                emitted.sink_csv(silver_path)
+            else:
+                emitted.write_csv(silver_path)
+            client.fput_object(SILVER_BUCKET, silver_file, silver_path)
+            print(f"Uploaded {silver_file} to {SILVER_BUCKET}")
+            catalog.register("silver", SILVER_BUCKET, silver_file, run_id)
+            written = [silver_file]
+
+        if store:
+            store.update("processing", cleaned)
+            store.close()
 
-        if bronze_data:
-            df = load_data(bronze_data)
+    # Lazy frames are never counted in memory, the catalog already holds the row counts
+    metrics.rows_in(sum(info["row_count"] or 0 for run in runs for info in catalog.object_info("bronze", run)))
+    metrics.rows_out(sum(info["row_count"] or 0 for info in catalog.object_info("silver", run_id)))
+    catalog.set_watermark("processing", "bronze", runs[-1])
+    return written
 
-            if df is not None:
-                cleaned_df = process_data(df)
+def partition_of(city_name, partitions):
+    # crc32 rather than hash() so every worker process agrees on the partition
+    return zlib.crc32(city_name.encode()) % partitions
 
-                silver_bucket = "citybikes-silver-layer"
-                silver_file = f"cleaned_stations_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
-                save_and_upload(cleaned_df, silver_bucket, silver_file)
+def hash_partitions(object_names, partitions):
+    # Bronze objects are already split per city, and a station never changes
+    # city, so deduplicating each group on its own gives the same result as
+    # one global pass
+    groups = {}
+    for object_name in object_names:
+        city_name = parse_partition(object_name).get("city_name", "")
+        groups.setdefault(partition_of(city_name, partitions), []).append(object_name)
+    return [groups[key] for key in sorted(groups)]
+
+def process_partition(object_names, run_id, catalog_path):
+    # Runs in a worker process with its own MinIO client and catalog connection;
+    # memory is bounded by the largest partition, not by the whole batch
+    catalog = Catalog(catalog_path)
+    store = StationStateStore() if CDC_MODE == "processing" else None
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = download_objects(client, BRONZE_BUCKET, object_names, tmp)
+            cleaned = process_data(scan_bronze_files(paths))
+            written = write_silver(emit_changes(store, cleaned), run_id, catalog)
+            # Partitions hold disjoint stations, so workers never update the same state rows
+            if store:
+                store.update("processing", cleaned)
+            return written
+    finally:
+        catalog.close()
+        if store:
+            store.close()
+
+def limit_polars_threads(threads):
+    # Pool initializer: runs in each worker before Polars starts its thread pool,
+    # so the parent process keeps its own pool size
+    os.environ.setdefault("POLARS_MAX_THREADS", str(threads))
+
+@metrics.timed
+def process_partitioned(catalog, workers=PROCESSING_WORKERS, partitions=PROCESSING_PARTITIONS, max_runs=PROCESSING_MAX_RUNS):
+    runs = catalog.unprocessed_runs("processing", "bronze")
+    if max_runs:
+        runs = runs[:max_runs]
+    if not runs:
+        print("No unprocessed bronze runs found.")
+        return []
+
+    bronze_files = catalog.objects_in_runs("bronze", runs)
+    if not bronze_files:
+        # Nothing will ever be added to these runs, the watermark moves past them
+        print(f"No bronze objects in the {len(runs)} unprocessed runs.")
+        catalog.set_watermark("processing", "bronze", runs[-1])
+        return []
+    if bronze_files[0].endswith(".csv"):
+        print("CSV bronze runs are not partitioned by city, processing them in a single pass")
+        return process_incremental(catalog, max_runs)
+
+    groups = hash_partitions(bronze_files, partitions or workers * 4)
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    print(f"Processing {len(bronze_files)} bronze objects from {len(runs)} runs in {len(groups)} partitions on {workers} workers")
+
+    # Workers share the cores instead of each starting a Polars pool of cpu_count threads.
+    # Spawned, not forked: forking a process that already runs Polars threads can deadlock
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    written = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=limit_polars_threads, initargs=(threads,)) as executor:
+        futures = [executor.submit(process_partition, group, run_id, catalog.path) for group in groups]
+        for future in futures:
+            written.extend(future.result())
+
+    metrics.rows_in(sum(info["row_count"] or 0 for run in runs for info in catalog.object_info("bronze", run)))
+    metrics.rows_out(sum(info["row_count"] or 0 for info in catalog.object_info("silver", run_id)))
+    catalog.set_watermark("processing", "bronze", runs[-1])
+    return written
+
+if __name__ == "__main__":
+    with metrics.stage("processing"):
+        catalog = Catalog()
+        if PROCESSING_MODE == "latest":
+            process_latest(catalog)
+        elif PROCESSING_MODE == "partitioned":
+            process_partitioned(catalog)
+        else:
+            process_incremental(catalog)
+    metrics.write_report("processing")
@@ -1,55 +1,230 @@
 import os
-import psycopg2
 import pandas as pd
 from minio import Minio
 from minio.error import S3Error
 from io import BytesIO
-from datetime import datetime
+from datetime import datetime, timedelta
+import sys
 
-client = Minio(
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_Lake.lake import STORAGE_FORMAT, write_partitioned
+from data_Lake.schemas import GOLD_SCHEMA
+from data_Lake.catalog import Catalog
+from data_Lake.streaming import stream_csv, stream_partitioned
+from database_Setup.warehouse import connection
+from data_Monitoring import metrics
+from data_Monitoring.metrics import instrument_client
+
+client = instrument_client(Minio(
     "127.0.0.1:9000",
     access_key=os.getenv("MINIO_ACCESS_KEY"),
     secret_key=os.getenv("MINIO_SECRET_KEY"),
     secure=False
-)
+))
 
-conn = psycopg2.connect(
-    dbname=os.getenv("DB_NAME"), user=os.getenv("DB_USER"), password=os.getenv("DB_PASSWORD"), host=os.getenv("DB_HOST"), port=os.getenv("DB_PORT")
-)
-cur = conn.cursor()
+GOLD_BUCKET = "citybikes-gold-layer"
+GOLD_DATASET = "aggregated_free_bikes"
+TRANSFORM_MODE = os.getenv("TRANSFORM_MODE", "full")
+EXPORT_MODE = os.getenv("EXPORT_MODE", "stream")
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "50000"))
+CDC_MODE = os.getenv("CDC_MODE", "off")
+SCHEMA_MODE = os.getenv("SCHEMA_MODE", "star")
+CDC_HEARTBEAT_MINUTES = int(os.getenv("CDC_HEARTBEAT_MINUTES", "15"))
+RECONSTRUCT_STEP = os.getenv("RECONSTRUCT_STEP", "5 minutes")
+EXPORT_LATENESS = timedelta(minutes=int(os.getenv("EXPORT_LATENESS_MINUTES", "15")))
 
+# Facts are grouped on the integer keys; the city name is only joined onto
+# the aggregated rows
 query = """
-    SELECT 
-        ds.city_name,
-        dt.timestamp,
-        SUM(fb.free_bikes) AS total_free_bikes
-    FROM fact_bike_availability fb
-    JOIN dim_station ds ON fb.station_id = ds.station_id
-    JOIN dim_time dt ON fb.time_id = dt.time_id
-    GROUP BY ds.city_name, dt.timestamp
-    ORDER BY ds.city_name, dt.timestamp;
+    SELECT
+        dc.city_name,
+        agg.timestamp,
+        agg.total_free_bikes
+    FROM (
+        SELECT ds.city_id, dt.timestamp, SUM(fb.free_bikes) AS total_free_bikes
+        FROM fact_bike_availability fb
+        JOIN dim_station ds ON fb.station_key = ds.station_key
+        JOIN dim_time dt ON fb.time_id = dt.time_id
+        GROUP BY ds.city_id, dt.timestamp
+    ) agg
+    JOIN dim_city dc ON agg.city_id = dc.city_id
+    ORDER BY dc.city_name, agg.timestamp;
 """
 
-cur.execute(query)
-rows = cur.fetchall()
+# Only buckets of the agg_city_minute continuous aggregate after the last
+# export are read; the export is appended to the gold layer
+incremental_query = """
+    SELECT dc.city_name, agg.bucket AS timestamp, agg.total_free_bikes
+    FROM agg_city_minute agg
+    JOIN dim_city dc ON agg.city_id = dc.city_id
+    WHERE agg.bucket >= COALESCE(%(since)s, '-infinity'::TIMESTAMPTZ) AND agg.bucket < %(until)s
+    ORDER BY dc.city_name, agg.bucket;
+"""
 
-df = pd.DataFrame(rows, columns=["city_name", "timestamp", "total_free_bikes"])
+# The star schema has no continuous aggregate; the same minute buckets are
+# summed from the facts of the export window, found through dim_time
+star_incremental_query = """
+    SELECT dc.city_name, agg.bucket AS timestamp, agg.total_free_bikes
+    FROM (
+        SELECT ds.city_id, date_trunc('minute', dt.timestamp) AS bucket, SUM(fb.free_bikes) AS total_free_bikes
+        FROM fact_bike_availability fb
+        JOIN dim_station ds ON fb.station_key = ds.station_key
+        JOIN dim_time dt ON fb.time_id = dt.time_id
+        WHERE dt.timestamp >= COALESCE(%(since)s, '-infinity'::TIMESTAMPTZ) AND dt.timestamp < %(until)s
+        GROUP BY ds.city_id, date_trunc('minute', dt.timestamp)
+    ) agg
+    JOIN dim_city dc ON agg.city_id = dc.city_id
+    ORDER BY dc.city_name, agg.bucket;
+"""
+
+# With CDC the fact table only holds changes and heartbeats; the series is
+# rebuilt on a fixed grid before it is aggregated. A station that has not
+# reported for two heartbeats is left out rather than carried forward
+reconstructed_query = """
+    SELECT dc.city_name, r.observed_at AS timestamp, SUM(r.free_bikes) AS total_free_bikes
+    FROM reconstruct_bike_availability(
+        COALESCE(%(since)s, (SELECT MIN(timestamp) FROM dim_time)),
+        COALESCE(%(until)s, (SELECT MAX(timestamp) FROM dim_time) + %(step)s::INTERVAL),
+        %(step)s::INTERVAL,
+        %(horizon)s::INTERVAL
+    ) r
+    JOIN dim_station ds ON r.station_key = ds.station_key
+    JOIN dim_city dc ON ds.city_id = dc.city_id
+    GROUP BY dc.city_name, r.observed_at
+    ORDER BY dc.city_name, r.observed_at;
+"""
 
-cur.close()
-conn.close()
+def reconstruction_params(since=None, until=None):
+    return {"since": since, "until": until, "step": RECONSTRUCT_STEP, "horizon": f"{2 * CDC_HEARTBEAT_MINUTES} minutes"}
 
+@metrics.timed
 def upload_to_minio_in_memory(df, bucket_name, file_name):
     csv_buffer = BytesIO()
-    df.to_csv(csv_buffer, index=False) 
-    csv_buffer.seek(0) 
+    df.to_csv(csv_buffer, index=False)
+    csv_buffer.seek(0)
 
     try:
         client.put_object(bucket_name, file_name, data=csv_buffer, length=csv_buffer.getbuffer().nbytes)
         print(f"Uploaded {file_name} to {bucket_name}")
+        return True
     except S3Error as err:
         print(f"Failed to upload {file_name}: {err}")
+        return False
+
+@metrics.timed
+def upload_gold(df, catalog, layer, run_id, strict=False):
+    metrics.rows_out(len(df))
+    if STORAGE_FORMAT == "parquet":
+        df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)
+        return write_partitioned(client, df, GOLD_SCHEMA, GOLD_BUCKET, GOLD_DATASET, run_id, catalog=catalog, layer=layer, strict=strict)
+
+    file_name = f"{GOLD_DATASET}_{run_id}.csv"
+    if upload_to_minio_in_memory(df, GOLD_BUCKET, file_name):
+        catalog.register(layer, GOLD_BUCKET, file_name, run_id, df)
+        return [file_name]
+    if strict:
+        raise Exception(f"Failed to upload {file_name}")
+    return []
+
+@metrics.timed
+def stream_gold(conn, sql, params, catalog, layer):
+    # A named cursor keeps the result on the server; batches of rows are
+    # encoded and pushed into multipart uploads as they arrive, so memory stays
+    # flat regardless of how much history is exported
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    cur = conn.cursor(name=f"gold_export_{run_id}")
+    cur.itersize = EXPORT_BATCH_ROWS
+    try:
+        cur.execute(sql, params)
+        if STORAGE_FORMAT == "parquet":
+            written = stream_partitioned(client, cur, GOLD_SCHEMA, GOLD_BUCKET, GOLD_DATASET, run_id, EXPORT_BATCH_ROWS, catalog=catalog, layer=layer)
+        else:
+            written = stream_csv(client, cur, GOLD_SCHEMA, GOLD_BUCKET, f"{GOLD_DATASET}_{run_id}.csv", EXPORT_BATCH_ROWS, catalog=catalog, layer=layer, run_id=run_id)
+    finally:
+        cur.close()
+        conn.commit()
+
+    metrics.rows_out(sum(info["row_count"] or 0 for info in catalog.object_info(layer, run_id)))
+    print(f"Streamed {len(written)} gold objects to {GOLD_BUCKET}")
+    return written
+
+@metrics.timed
+def export_full(conn, catalog):
+    sql, params = (reconstructed_query, reconstruction_params()) if CDC_MODE != "off" else (query, None)
+    if EXPORT_MODE == "stream":
+        return stream_gold(conn, sql, params, catalog, "gold")
+
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    cur.close()
+
+    df = pd.DataFrame(rows, columns=["city_name", "timestamp", "total_free_bikes"])
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    return upload_gold(df, catalog, "gold", run_id)
+
+def export_window(since, loaded_until, lateness=EXPORT_LATENESS):
+    # Buckets are closed by load progress, not by the clock: everything before
+    # the minute of the newest loaded observation. Facts that arrive late for
+    # a bucket that was already exported are picked up because every run
+    # exports the trailing lateness window again; gold readers keep the row of
+    # the newest run for every bucket.
+    if loaded_until is None:
+        return None, None
+    until = max(loaded_until, since) if since is not None else loaded_until
+    start = since - lateness if since is not None else None
+    return start, until
+
+@metrics.timed
+def export_incremental(conn, catalog):
+    since = catalog.watermark("transform", "agg_city_minute")
+    since = datetime.fromisoformat(since) if since else None
+
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT date_trunc('minute', MAX(timestamp)) FROM dim_time")
+    start, until = export_window(since, cur.fetchone()[0])
+    if until is None:
+        cur.close()
+        conn.autocommit = False
+        print("Nothing loaded yet, no aggregates to export.")
+        return []
+
+    sql, params = incremental_query, {"since": start, "until": until}
+    if CDC_MODE != "off":
+        # The series is rebuilt from the facts, the continuous aggregate is not read
+        sql, params = reconstructed_query, reconstruction_params(start, until)
+    elif SCHEMA_MODE == "hypertable":
+        cur.execute("CALL refresh_continuous_aggregate('agg_city_minute', %s::TIMESTAMPTZ, %s::TIMESTAMPTZ)", (start, until))
+    else:
+        sql = star_incremental_query
+
+    if EXPORT_MODE == "stream":
+        cur.close()
+        conn.autocommit = False
+        written = stream_gold(conn, sql, params, catalog, "gold_append")
+    else:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        cur.close()
+        conn.autocommit = False
+
+        df = pd.DataFrame(rows, columns=["city_name", "timestamp", "total_free_bikes"])
+        written = []
+        if not df.empty:
+            run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+            written = upload_gold(df, catalog, "gold_append", run_id, strict=True)
+        print(f"Exported {len(df)} aggregate rows from {start or 'the start'} up to {until}")
 
-file_name = f"aggregated_free_bikes_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
+    catalog.set_watermark("transform", "agg_city_minute", until.isoformat())
+    return written
 
-gold_bucket = "citybikes-gold-layer"
-upload_to_minio_in_memory(df, gold_bucket, file_name)
+if __name__ == "__main__":
+    with metrics.stage("transform"):
+        catalog = Catalog()
+        with connection() as conn:
+            if TRANSFORM_MODE == "incremental":
+                export_incremental(conn, catalog)
+            else:
+                export_full(conn, catalog)
+    metrics.write_report("transform")
@@ -0,0 +1,383 @@
+import os
+import threading
+import time as clock
+from datetime import datetime, time, timedelta, timezone
+from io import BytesIO
+import numpy as np
+import pandas as pd
+from minio.error import S3Error
+from data_Lake.lake import filter_partitions, parse_partition, read_table
+from data_Monitoring import metrics
+
+DASHBOARD_SOURCE = os.getenv("DASHBOARD_SOURCE", "lake")
+DASHBOARD_MAX_POINTS = int(os.getenv("DASHBOARD_MAX_POINTS", "1500"))
+DASHBOARD_DOWNSAMPLE = os.getenv("DASHBOARD_DOWNSAMPLE", "lttb")
+DASHBOARD_CACHE_ENTRIES = int(os.getenv("DASHBOARD_CACHE_ENTRIES", "64"))
+DASHBOARD_REFRESH = os.getenv("DASHBOARD_REFRESH", "incremental")
+DASHBOARD_REFRESH_SECONDS = int(os.getenv("DASHBOARD_REFRESH_SECONDS", "60"))
+DASHBOARD_INITIAL_DAYS = int(os.getenv("DASHBOARD_INITIAL_DAYS", "7"))
+# The trailing buckets an incremental export may still rewrite
+DASHBOARD_LATENESS = timedelta(minutes=int(os.getenv("EXPORT_LATENESS_MINUTES", "15")))
+SCHEMA_MODE = os.getenv("SCHEMA_MODE", "star")
+CDC_MODE = os.getenv("CDC_MODE", "off")
+CDC_HEARTBEAT_MINUTES = int(os.getenv("CDC_HEARTBEAT_MINUTES", "15"))
+RECONSTRUCT_STEP = os.getenv("RECONSTRUCT_STEP", "5 minutes")
+
+GOLD_BUCKET = "citybikes-gold-layer"
+GOLD_COLUMNS = ["city_name", "timestamp", "total_free_bikes"]
+HOURLY_AFTER = timedelta(days=14)
+
+# Filters are pushed down to where the data lives (gold partitions or the
+# warehouse) and the result is reduced to the chart's point budget, so the
+# cost of a widget change depends on the selected range, not on all history.
+
+def newest_buckets(df):
+    # Incremental exports repeat their trailing buckets to pick up late facts.
+    # Objects are read in run order, so the last row of a bucket is the newest
+    return df.drop_duplicates(subset="datetime", keep="last")
+
+def gold_files(catalog, client):
+    latest_full = catalog.latest_run("gold")
+    latest_append = catalog.latest_run("gold_append")
+    if latest_append and (latest_full is None or latest_append > latest_full):
+        # Incremental exports only hold new buckets, together they form the series
+        return catalog.objects_in_runs("gold_append", catalog.runs_after("gold_append"))
+    return catalog.latest_objects("gold", client, GOLD_BUCKET)
+
+@metrics.timed
+def read_gold_csv(client, object_names):
+    frames = []
+    for object_name in object_names:
+        try:
+            response = client.get_object(GOLD_BUCKET, object_name)
+            frames.append(pd.read_csv(BytesIO(response.read())))
+            response.close()
+            response.release_conn()
+        except S3Error as err:
+            print(f"Failed to download {object_name}: {err}")
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=GOLD_COLUMNS)
+
+def lake_cities(catalog, client):
+    object_names = gold_files(catalog, client)
+    if object_names and not object_names[0].endswith(".parquet"):
+        return sorted(read_gold_csv(client, object_names)["city_name"].dropna().unique())
+    return sorted({parse_partition(name).get("city_name") for name in object_names} - {None})
+
+def lake_date_bounds(catalog, client, city_name):
+    object_names = gold_files(catalog, client)
+    if object_names and not object_names[0].endswith(".parquet"):
+        df = read_gold_csv(client, object_names)
+        timestamps = pd.to_datetime(df.loc[df["city_name"] == city_name, "timestamp"], utc=True)
+        return (timestamps.min().date(), timestamps.max().date()) if not timestamps.empty else (None, None)
+    dates = sorted(
+        parse_partition(name).get("date") for name in filter_partitions(object_names, cities=[city_name])
+    )
+    dates = [date for date in dates if date and date != "unknown"]
+    if not dates:
+        return None, None
+    return datetime.fromisoformat(dates[0]).date(), datetime.fromisoformat(dates[-1]).date()
+
+@metrics.timed
+def lake_series(catalog, client, city_name, start_date, end_date):
+    object_names = gold_files(catalog, client)
+    if object_names and object_names[0].endswith(".parquet"):
+        # Only partitions of this city inside the date range are downloaded
+        objects = filter_partitions(object_names, cities=[city_name], start_date=start_date, end_date=end_date)
+        table = read_table(client, GOLD_BUCKET, objects, columns=["timestamp", "total_free_bikes"])
+        df = table.to_pandas() if table is not None else pd.DataFrame(columns=["timestamp", "total_free_bikes"])
+    else:
+        df = read_gold_csv(client, object_names)
+        df = df[df["city_name"] == city_name][["timestamp", "total_free_bikes"]]
+
+    df["datetime"] = pd.to_datetime(df["timestamp"], utc=True)
+    start, end = range_bounds(start_date, end_date)
+    df = newest_buckets(df[(df["datetime"] >= start) & (df["datetime"] < end)])
+    return df[["datetime", "total_free_bikes"]].sort_values("datetime").reset_index(drop=True)
+
+@metrics.timed
+def lake_series_since(catalog, client, city_name, since):
+    object_names = gold_files(catalog, client)
+    if object_names and object_names[0].endswith(".parquet"):
+        # Partitions dated before since cannot hold any of the rows
+        objects = filter_partitions(object_names, cities=[city_name], start_date=since.date() if since is not None else None)
+        table = read_table(client, GOLD_BUCKET, objects, columns=["timestamp", "total_free_bikes"])
+        df = table.to_pandas() if table is not None else pd.DataFrame(columns=["timestamp", "total_free_bikes"])
+    else:
+        df = read_gold_csv(client, object_names)
+        df = df[df["city_name"] == city_name][["timestamp", "total_free_bikes"]]
+
+    df["datetime"] = pd.to_datetime(df["timestamp"], utc=True)
+    if since is not None:
+        df = df[df["datetime"] >= since]
+    df = newest_buckets(df)
+    return df[["datetime", "total_free_bikes"]].sort_values("datetime").reset_index(drop=True)
+
+def utilization_files(catalog, layer):
+    # Every analytics run appends the windows closed since the previous one
+    return catalog.objects_in_runs(layer, catalog.runs_after(layer))
+
+@metrics.timed
+def lake_city_utilization(catalog, client, city_name, start_date, end_date):
+    objects = filter_partitions(utilization_files(catalog, "city_utilization"), cities=[city_name], start_date=start_date, end_date=end_date)
+    columns = ["window_start", "avg_occupancy_ratio", "empty_station_hours", "full_station_hours", "bikes_taken", "bikes_returned"]
+    table = read_table(client, GOLD_BUCKET, objects, columns=columns)
+    df = table.to_pandas() if table is not None else pd.DataFrame(columns=columns)
+    df["window_start"] = pd.to_datetime(df["window_start"], utc=True)
+    start, end = range_bounds(start_date, end_date)
+    df = df[(df["window_start"] >= start) & (df["window_start"] < end)]
+    return df.sort_values("window_start").reset_index(drop=True)
+
+@metrics.timed
+def lake_station_utilization(catalog, client, city_name, start_date, end_date):
+    # One row per station over the whole range, busiest stations first
+    objects = filter_partitions(utilization_files(catalog, "station_utilization"), cities=[city_name], start_date=start_date, end_date=end_date)
+    columns = ["station_id", "station_name", "window_start", "occupancy_ratio", "empty_seconds", "full_seconds", "bikes_taken", "bikes_returned"]
+    table = read_table(client, GOLD_BUCKET, objects, columns=columns)
+    df = table.to_pandas() if table is not None else pd.DataFrame(columns=columns)
+    df["window_start"] = pd.to_datetime(df["window_start"], utc=True)
+    start, end = range_bounds(start_date, end_date)
+    df = df[(df["window_start"] >= start) & (df["window_start"] < end)]
+    stations = df.groupby("station_id").agg(
+        station_name=("station_name", "last"),
+        occupancy_ratio=("occupancy_ratio", "mean"),
+        empty_hours=("empty_seconds", lambda seconds: seconds.sum() / 3600),
+        full_hours=("full_seconds", lambda seconds: seconds.sum() / 3600),
+        bikes_taken=("bikes_taken", "sum"),
+        bikes_returned=("bikes_returned", "sum"),
+    )
+    stations["turnover"] = stations["bikes_taken"] + stations["bikes_returned"]
+    return stations.sort_values("turnover", ascending=False).reset_index()
+
+def warehouse_cities(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT city_name FROM dim_city ORDER BY city_name")
+        return [row[0] for row in cur.fetchall()]
+
+def warehouse_date_bounds(conn, city_name):
+    with conn.cursor() as cur:
+        if SCHEMA_MODE == "hypertable":
+            cur.execute("SELECT MIN(bucket), MAX(bucket) FROM agg_city_minute WHERE city_id = (SELECT city_id FROM dim_city WHERE city_name = %s)", (city_name,))
+        else:
+            cur.execute("""
+                SELECT MIN(dt.timestamp), MAX(dt.timestamp)
+                FROM fact_bike_availability fb
+                JOIN dim_station ds ON fb.station_key = ds.station_key
+                JOIN dim_time dt ON fb.time_id = dt.time_id
+                WHERE ds.city_id = (SELECT city_id FROM dim_city WHERE city_name = %s)
+            """, (city_name,))
+        low, high = cur.fetchone()
+    return (low.date(), high.date()) if low else (None, None)
+
+@metrics.timed
+def reconstructed_series(cur, city_name, since, until):
+    # Only changes are stored with CDC, the series is rebuilt on a fixed grid
+    cur.execute("""
+        SELECT r.observed_at, SUM(r.free_bikes)
+        FROM reconstruct_bike_availability(
+            COALESCE(%(since)s, (SELECT MIN(timestamp) FROM dim_time)),
+            COALESCE(%(until)s, (SELECT MAX(timestamp) FROM dim_time) + %(step)s::INTERVAL),
+            %(step)s::INTERVAL, %(horizon)s::INTERVAL
+        ) r
+        JOIN dim_station ds ON r.station_key = ds.station_key
+        WHERE ds.city_id = (SELECT city_id FROM dim_city WHERE city_name = %(city)s)
+        GROUP BY r.observed_at
+        ORDER BY r.observed_at
+    """, {"city": city_name, "since": since, "until": until, "step": RECONSTRUCT_STEP, "horizon": f"{2 * CDC_HEARTBEAT_MINUTES} minutes"})
+
+def warehouse_series(conn, city_name, start_date, end_date):
+    start, end = range_bounds(start_date, end_date)
+    with conn.cursor() as cur:
+        if CDC_MODE != "off":
+            reconstructed_series(cur, city_name, start, end)
+        elif SCHEMA_MODE == "hypertable":
+            # Long ranges read the hourly rollup instead of minute buckets
+            if end - start > HOURLY_AFTER:
+                cur.execute("""
+                    SELECT bucket, avg_free_bikes FROM agg_city_hour
+                    WHERE city_id = (SELECT city_id FROM dim_city WHERE city_name = %s) AND bucket >= %s AND bucket < %s ORDER BY bucket
+                """, (city_name, start, end))
+            else:
+                cur.execute("""
+                    SELECT bucket, total_free_bikes FROM agg_city_minute
+                    WHERE city_id = (SELECT city_id FROM dim_city WHERE city_name = %s) AND bucket >= %s AND bucket < %s ORDER BY bucket
+                """, (city_name, start, end))
+        else:
+            cur.execute("""
+                SELECT dt.timestamp, SUM(fb.free_bikes)
+                FROM fact_bike_availability fb
+                JOIN dim_station ds ON fb.station_key = ds.station_key
+                JOIN dim_time dt ON fb.time_id = dt.time_id
+                WHERE ds.city_id = (SELECT city_id FROM dim_city WHERE city_name = %s) AND dt.timestamp >= %s AND dt.timestamp < %s
+                GROUP BY dt.timestamp
+                ORDER BY dt.timestamp
+            """, (city_name, start, end))
+        rows = cur.fetchall()
+    conn.rollback()
+
+    df = pd.DataFrame(rows, columns=["datetime", "total_free_bikes"])
+    df["datetime"] = pd.to_datetime(df["datetime"], utc=True)
+    df["total_free_bikes"] = df["total_free_bikes"].astype(float)
+    return df
+
+@metrics.timed
+def warehouse_series_since(conn, city_name, since):
+    since = since.to_pydatetime() if since is not None else None
+    with conn.cursor() as cur:
+        if CDC_MODE != "off":
+            reconstructed_series(cur, city_name, since, None)
+        elif SCHEMA_MODE == "hypertable":
+            cur.execute("""
+                SELECT bucket, total_free_bikes FROM agg_city_minute
+                WHERE city_id = (SELECT city_id FROM dim_city WHERE city_name = %s) AND bucket >= COALESCE(%s, '-infinity'::TIMESTAMPTZ) ORDER BY bucket
+            """, (city_name, since))
+        else:
+            cur.execute("""
+                SELECT dt.timestamp, SUM(fb.free_bikes)
+                FROM fact_bike_availability fb
+                JOIN dim_station ds ON fb.station_key = ds.station_key
+                JOIN dim_time dt ON fb.time_id = dt.time_id
+                WHERE ds.city_id = (SELECT city_id FROM dim_city WHERE city_name = %s) AND dt.timestamp >= COALESCE(%s, '-infinity'::TIMESTAMPTZ)
+                GROUP BY dt.timestamp
+                ORDER BY dt.timestamp
+            """, (city_name, since))
+        rows = cur.fetchall()
+    conn.rollback()
+
+    df = pd.DataFrame(rows, columns=["datetime", "total_free_bikes"])
+    df["datetime"] = pd.to_datetime(df["datetime"], utc=True)
+    df["total_free_bikes"] = df["total_free_bikes"].astype(float)
+    return df
+
+class SeriesStore:
+    # Process-wide store shared by every dashboard session. Each city keeps its
+    # series as one frame covering the visible range up to a high-water bucket.
+    # The first refresh only fetches from the start of the visible range, older
+    # days are fetched when they become visible. Later refreshes fetch again
+    # from lateness before the high-water bucket, so a partially filled last
+    # bucket and late buckets are replaced. Sessions refreshing within
+    # min_interval of each other reuse the same fetch.
+    def __init__(self, fetch_since, fetch_range, min_interval=DASHBOARD_REFRESH_SECONDS, lateness=DASHBOARD_LATENESS):
+        self.fetch_since = fetch_since
+        self.fetch_range = fetch_range
+        self.min_interval = min_interval
+        self.lateness = lateness
+        self.frames = {}
+        self.loaded_from = {}
+        self.high_water = {}
+        self.versions = {}
+        self.refreshed_at = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def city_lock(self, city_name):
+        with self.lock:
+            return self.locks.setdefault(city_name, threading.Lock())
+
+    def merge(self, city_name, rows, cutoff=None):
+        # Rows at or after the cutoff are replaced by the fetched ones
+        frame = self.frames.get(city_name)
+        if frame is not None and cutoff is not None:
+            frame = frame[frame["datetime"] < cutoff]
+        if frame is not None and not frame.empty:
+            rows = pd.concat([frame, rows], ignore_index=True)
+        self.frames[city_name] = newest_buckets(rows.sort_values("datetime", kind="stable")).reset_index(drop=True)
+        if not self.frames[city_name].empty:
+            self.high_water[city_name] = self.frames[city_name]["datetime"].iloc[-1]
+        self.versions[city_name] = self.versions.get(city_name, 0) + 1
+
+    def refresh(self, city_name, start_date, force=False):
+        # Returns a version that changes whenever the city's series does
+        start, _ = range_bounds(start_date, start_date)
+        with self.city_lock(city_name):
+            loaded_from = self.loaded_from.get(city_name)
+            if loaded_from is not None and start < loaded_from:
+                older = self.fetch_range(city_name, start_date, (loaded_from - timedelta(days=1)).date())
+                self.loaded_from[city_name] = start
+                self.merge(city_name, older)
+                print(f"Fetched {len(older)} rows for {city_name} from {start_date}")
+
+            last = self.refreshed_at.get(city_name)
+            if last is not None and not force and clock.monotonic() - last < self.min_interval:
+                return self.versions.get(city_name, 0)
+
+            if loaded_from is None:
+                since = start
+                self.loaded_from[city_name] = start
+            else:
+                high_water = self.high_water.get(city_name)
+                since = max(high_water - self.lateness, self.loaded_from[city_name]) if high_water is not None else self.loaded_from[city_name]
+            rows = self.fetch_since(city_name, since)
+            self.refreshed_at[city_name] = clock.monotonic()
+            self.merge(city_name, rows, cutoff=since)
+            print(f"Fetched {len(rows)} rows for {city_name} from {since}")
+            return self.versions[city_name]
+
+    def date_bounds(self, city_name):
+        frame = self.frames.get(city_name)
+        if frame is None or frame.empty:
+            return None, None
+        return frame["datetime"].iloc[0].date(), self.high_water[city_name].date()
+
+    def series(self, city_name, start_date, end_date):
+        start, end = range_bounds(start_date, end_date)
+        frame = self.frames.get(city_name)
+        if frame is None:
+            return pd.DataFrame(columns=["datetime", "total_free_bikes"])
+        # The frame is sorted, the range is two binary searches
+        low, high = frame["datetime"].searchsorted([start, end])
+        return frame.iloc[low:high].reset_index(drop=True)
+
+def range_bounds(start_date, end_date):
+    start = datetime.combine(start_date, time.min, tzinfo=timezone.utc)
+    end = datetime.combine(end_date, time.min, tzinfo=timezone.utc) + timedelta(days=1)
+    return pd.Timestamp(start), pd.Timestamp(end)
+
+def lttb_indices(x, y, threshold):
+    # Largest-Triangle-Three-Buckets: keeps the points that shape the line
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    every = (n - 2) / (threshold - 2)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    a = 0
+    for i in range(threshold - 2):
+        range_start = int(np.floor(i * every)) + 1
+        range_end = int(np.floor((i + 1) * every)) + 1
+        next_start = range_end
+        next_end = min(int(np.floor((i + 2) * every)) + 1, n)
+
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        xs = x[range_start:range_end]
+        ys = y[range_start:range_end]
+        areas = np.abs((x[a] - avg_x) * (ys - y[a]) - (x[a] - xs) * (avg_y - y[a]))
+
+        a = range_start + int(areas.argmax())
+        selected[i + 1] = a
+    selected[-1] = n - 1
+    return selected
+
+def minmax_indices(y, threshold):
+    n = len(y)
+    if threshold >= n or threshold < 2:
+        return np.arange(n)
+
+    selected = []
+    for bucket in np.array_split(np.arange(n), threshold // 2):
+        values = y[bucket]
+        selected.extend((bucket[values.argmin()], bucket[values.argmax()]))
+    return np.unique(selected)
+
+@metrics.timed
+def downsample(df, max_points=DASHBOARD_MAX_POINTS, method=DASHBOARD_DOWNSAMPLE):
+    metrics.rows_in(len(df))
+    if len(df) <= max_points:
+        metrics.rows_out(len(df))
+        return df
+    x = df["datetime"].astype("int64").to_numpy(dtype=np.float64)
+    y = df["total_free_bikes"].to_numpy(dtype=np.float64)
+    indices = minmax_indices(y, max_points) if method == "minmax" else lttb_indices(x, y, max_points)
+    metrics.rows_out(len(indices))
+    return df.iloc[indices].reset_index(drop=True)
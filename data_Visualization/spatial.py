@@ -0,0 +1,240 @@
+import math
+import os
+from datetime import datetime, timedelta
+from io import BytesIO
+import numpy as np
+import pandas as pd
+from minio.error import S3Error
+from data_Lake.lake import read_table
+from data_Monitoring import metrics
+
+SPATIAL_CELL_DEGREES = float(os.getenv("SPATIAL_CELL_DEGREES", "0.01"))
+MAP_MAX_STATIONS = int(os.getenv("MAP_MAX_STATIONS", "5000"))
+SCHEMA_MODE = os.getenv("SCHEMA_MODE", "star")
+CDC_MODE = os.getenv("CDC_MODE", "off")
+CDC_HEARTBEAT_MINUTES = int(os.getenv("CDC_HEARTBEAT_MINUTES", "15"))
+
+SILVER_BUCKET = "citybikes-silver-layer"
+SILVER_COLUMNS = ["id", "name", "latitude", "longitude", "city_name", "timestamp", "free_bikes", "empty_slots"]
+STATION_COLUMNS = ["station_id", "station_name", "latitude", "longitude", "city_name", "observed_at", "free_bikes", "empty_slots"]
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = 111320.0
+HALF_EARTH_M = math.pi * EARTH_RADIUS_M
+# Boxes spanning more rows of cells than this are filtered with one vectorized pass
+GRID_MAX_ROWS = 256
+
+# Stations are looked up by location either through a GiST index on
+# point(longitude, latitude) in the warehouse or through an in-memory grid
+# built from the latest silver snapshot. Both serve the same two queries: the
+# stations inside a map viewport and the N nearest stations to a point.
+
+def haversine_m(longitude, latitude, longitudes, latitudes):
+    lon1, lat1 = math.radians(longitude), math.radians(latitude)
+    lon2, lat2 = np.radians(longitudes), np.radians(latitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def radius_box(longitude, latitude, radius_m):
+    # Smallest (west, south, east, north) box containing the circle
+    lat_delta = radius_m / METERS_PER_DEGREE
+    lon_delta = radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 1e-6))
+    if lon_delta >= 180 or abs(latitude) + lat_delta >= 90:
+        return -180.0, max(latitude - lat_delta, -90.0), 180.0, min(latitude + lat_delta, 90.0)
+    return longitude - lon_delta, max(latitude - lat_delta, -90.0), longitude + lon_delta, min(latitude + lat_delta, 90.0)
+
+def viewport_box(longitude, latitude, zoom, width_px, height_px):
+    # Web Mercator: at zoom 0 one 256 px tile spans 360 degrees of longitude
+    degrees_per_px = 360 / (256 * 2 ** zoom)
+    lon_delta = width_px / 2 * degrees_per_px
+    lat_delta = height_px / 2 * degrees_per_px * math.cos(math.radians(latitude))
+    return (
+        max(longitude - lon_delta, -180.0), max(latitude - lat_delta, -90.0),
+        min(longitude + lon_delta, 180.0), min(latitude + lat_delta, 90.0),
+    )
+
+def rank_by_distance(stations, longitude, latitude, n, radius_m=None):
+    stations = stations.assign(distance_m=haversine_m(longitude, latitude, stations["longitude"].to_numpy(), stations["latitude"].to_numpy()))
+    if radius_m is not None:
+        stations = stations[stations["distance_m"] <= radius_m]
+    return stations.nsmallest(n, "distance_m").reset_index(drop=True)
+
+def thin(stations, limit):
+    # Evenly spaced rows keep the spread of a zoomed-out view within the budget
+    if len(stations) <= limit:
+        return stations
+    return stations.iloc[np.linspace(0, len(stations) - 1, limit).astype(np.int64)].reset_index(drop=True)
+
+class StationGrid:
+    # Stations are bucketed into square cells and sorted by (row, column), so
+    # a box touches one contiguous slice of the sorted arrays per row of cells
+    def __init__(self, stations, cell_degrees=SPATIAL_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        rows = np.floor(stations["latitude"].to_numpy() / cell_degrees).astype(np.int64)
+        columns = np.floor(stations["longitude"].to_numpy() / cell_degrees).astype(np.int64)
+        order = np.lexsort((columns, rows))
+        self.stations = stations.iloc[order].reset_index(drop=True)
+        self.keys = self.cell_key(rows[order], columns[order])
+        self.latitudes = self.stations["latitude"].to_numpy()
+        self.longitudes = self.stations["longitude"].to_numpy()
+
+    def __len__(self):
+        return len(self.stations)
+
+    @staticmethod
+    def cell_key(rows, columns):
+        return rows * (1 << 32) + (columns + (1 << 31))
+
+    def box_indices(self, west, south, east, north):
+        first_row, last_row = math.floor(south / self.cell_degrees), math.floor(north / self.cell_degrees)
+        if last_row - first_row > GRID_MAX_ROWS:
+            candidates = np.arange(len(self.stations))
+        else:
+            rows = np.arange(first_row, last_row + 1, dtype=np.int64)
+            starts = np.searchsorted(self.keys, self.cell_key(rows, math.floor(west / self.cell_degrees)), side="left")
+            ends = np.searchsorted(self.keys, self.cell_key(rows, math.floor(east / self.cell_degrees)), side="right")
+            slices = [np.arange(start, end) for start, end in zip(starts, ends) if end > start]
+            candidates = np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+        # Cells on the border are only partly inside the box
+        latitudes, longitudes = self.latitudes[candidates], self.longitudes[candidates]
+        inside = (latitudes >= south) & (latitudes <= north) & (longitudes >= west) & (longitudes <= east)
+        return candidates[inside]
+
+    @metrics.timed
+    def in_box(self, west, south, east, north, limit=MAP_MAX_STATIONS):
+        return thin(self.stations.iloc[self.box_indices(west, south, east, north)].reset_index(drop=True), limit)
+
+    @metrics.timed
+    def nearest(self, longitude, latitude, n, radius_m=None):
+        if radius_m is not None:
+            indices = self.box_indices(*radius_box(longitude, latitude, radius_m))
+            return rank_by_distance(self.stations.iloc[indices], longitude, latitude, n, radius_m)
+
+        # Grow the search box until it holds n stations, then widen it once to
+        # the n-th distance found so nothing closer is missed near its corners
+        radius = self.cell_degrees * METERS_PER_DEGREE
+        indices = self.box_indices(*radius_box(longitude, latitude, radius))
+        while len(indices) < n and radius < HALF_EARTH_M:
+            radius *= 2
+            indices = self.box_indices(*radius_box(longitude, latitude, radius))
+        ranked = rank_by_distance(self.stations.iloc[indices], longitude, latitude, n)
+        if len(ranked) == n and ranked["distance_m"].iloc[-1] > radius:
+            indices = self.box_indices(*radius_box(longitude, latitude, ranked["distance_m"].iloc[-1]))
+            ranked = rank_by_distance(self.stations.iloc[indices], longitude, latitude, n)
+        return ranked
+
+    def city_center(self, city_name):
+        stations = self.stations[self.stations["city_name"] == city_name]
+        if stations.empty:
+            return None
+        return stations["longitude"].mean(), stations["latitude"].mean()
+
+def station_objects(catalog, client):
+    latest = catalog.latest_run("silver")
+    if CDC_MODE != "processing" or latest is None:
+        return catalog.latest_objects("silver", client, SILVER_BUCKET)
+    # With CDC a silver run only holds the stations that changed. Every station
+    # is written at least once per heartbeat window, so the runs of the last two
+    # windows hold every station that is still reporting
+    since = (datetime.strptime(latest, "%Y%m%d%H%M%S") - timedelta(minutes=2 * CDC_HEARTBEAT_MINUTES)).strftime("%Y%m%d%H%M%S")
+    return catalog.objects_in_runs("silver", catalog.runs_after("silver", since))
+
+@metrics.timed
+def lake_stations(catalog, client):
+    # Latest known state of every station from the newest silver runs
+    object_names = station_objects(catalog, client)
+    if object_names and object_names[0].endswith(".parquet"):
+        table = read_table(client, SILVER_BUCKET, object_names, columns=SILVER_COLUMNS)
+        df = table.to_pandas() if table is not None else pd.DataFrame(columns=SILVER_COLUMNS)
+    else:
+        frames = []
+        for object_name in object_names:
+            try:
+                response = client.get_object(SILVER_BUCKET, object_name)
+                frames.append(pd.read_csv(BytesIO(response.read()), usecols=SILVER_COLUMNS))
+                response.close()
+                response.release_conn()
+            except S3Error as err:
+                print(f"Failed to download {object_name}: {err}")
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=SILVER_COLUMNS)
+
+    df = df.dropna(subset=["latitude", "longitude"]).sort_values("timestamp").drop_duplicates(subset=["id"], keep="last")
+    df = df.rename(columns={"id": "station_id", "name": "station_name", "timestamp": "observed_at"})
+    df["city_name"] = df["city_name"].astype(str)
+    return df[STATION_COLUMNS]
+
+def latest_availability():
+    # Newest fact of each station through the primary key index
+    if SCHEMA_MODE == "hypertable":
+        return """
+            SELECT fb.observed_at, fb.free_bikes, fb.empty_slots
+            FROM fact_bike_availability fb
+            WHERE fb.station_key = ds.station_key
+            ORDER BY fb.observed_at DESC LIMIT 1
+        """
+    # time_id follows load order, which is time order outside of backfills
+    return """
+        SELECT dt.timestamp AS observed_at, fb.free_bikes, fb.empty_slots
+        FROM fact_bike_availability fb
+        JOIN dim_time dt ON fb.time_id = dt.time_id
+        WHERE fb.station_key = ds.station_key
+        ORDER BY fb.time_id DESC LIMIT 1
+    """
+
+def station_query(where, order=""):
+    # The location expression must match dim_station_location_idx to use it
+    return f"""
+        SELECT ds.station_id, ds.station_name, ds.latitude, ds.longitude, dc.city_name,
+               latest.observed_at, latest.free_bikes, latest.empty_slots
+        FROM dim_station ds
+        JOIN dim_city dc ON ds.city_id = dc.city_id
+        LEFT JOIN LATERAL ({latest_availability()}) latest ON true
+        WHERE {where}
+        {order}
+        LIMIT %(limit)s
+    """
+
+def fetch_stations(conn, sql, params):
+    with conn.cursor() as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+    conn.rollback()
+    df = pd.DataFrame(rows, columns=STATION_COLUMNS)
+    # Stations without any fact yet come back with NULL availability
+    df[["free_bikes", "empty_slots"]] = df[["free_bikes", "empty_slots"]].astype(float)
+    return df
+
+@metrics.timed
+def warehouse_stations_in_box(conn, west, south, east, north, limit=MAP_MAX_STATIONS):
+    return fetch_stations(conn, station_query(
+        "point(ds.longitude, ds.latitude) <@ box(point(%(west)s, %(south)s), point(%(east)s, %(north)s))"
+    ), {"west": west, "south": south, "east": east, "north": north, "limit": limit})
+
+@metrics.timed
+def warehouse_nearest(conn, longitude, latitude, n, radius_m=None):
+    if radius_m is None:
+        # GiST orders by planar distance in degrees; the n-th true distance
+        # then bounds a box that is guaranteed to hold the real n nearest
+        candidates = fetch_stations(conn, station_query(
+            "true", "ORDER BY point(ds.longitude, ds.latitude) <-> point(%(longitude)s, %(latitude)s)"
+        ), {"longitude": longitude, "latitude": latitude, "limit": n})
+        if len(candidates) < n:
+            return rank_by_distance(candidates, longitude, latitude, n)
+        radius_m = rank_by_distance(candidates, longitude, latitude, n)["distance_m"].iloc[-1]
+
+    west, south, east, north = radius_box(longitude, latitude, radius_m)
+    stations = fetch_stations(conn, station_query(
+        "point(ds.longitude, ds.latitude) <@ box(point(%(west)s, %(south)s), point(%(east)s, %(north)s))"
+    ), {"west": west, "south": south, "east": east, "north": north, "limit": None})
+    return rank_by_distance(stations, longitude, latitude, n, radius_m)
+
+def warehouse_city_center(conn, city_name):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT AVG(ds.longitude), AVG(ds.latitude)
+            FROM dim_station ds
+            WHERE ds.city_id = (SELECT city_id FROM dim_city WHERE city_name = %s)
+        """, (city_name,))
+        longitude, latitude = cur.fetchone()
+    conn.rollback()
+    return (longitude, latitude) if longitude is not None else None
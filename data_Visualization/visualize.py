@@ -1,103 +1,272 @@
+import math
 import os
 import streamlit as st
 import pandas as pd
+from datetime import timedelta
 import plotly.express as px
 from minio import Minio
-from io import BytesIO
-from minio.error import S3Error
+import sys
 
-client = Minio(
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_Lake.catalog import Catalog
+from data_Visualization import data_layer, spatial
+from database_Setup.warehouse import connection
+from data_Monitoring import metrics
+from data_Monitoring.metrics import instrument_client
+from data_Visualization.data_layer import DASHBOARD_CACHE_ENTRIES, DASHBOARD_INITIAL_DAYS, DASHBOARD_MAX_POINTS, DASHBOARD_REFRESH, DASHBOARD_REFRESH_SECONDS, DASHBOARD_SOURCE
+from data_Visualization.spatial import SPATIAL_CELL_DEGREES, viewport_box
+
+client = instrument_client(Minio(
     "127.0.0.1:9000",
     access_key=os.getenv("MINIO_ACCESS_KEY"),
     secret_key=os.getenv("MINIO_SECRET_KEY"),
     secure=False
-)
-
-def get_latest_gold_file(bucket_name):
-    try:
-        objects = client.list_objects(bucket_name, recursive=True)
-        latest_file = None
-        for obj in objects:
-            if latest_file is None or obj.last_modified > latest_file.last_modified:
-                latest_file = obj
-        return latest_file.object_name if latest_file else None
-    except S3Error as err:
-        st.error(f"Error listing objects: {err}")
-        return None
-
-def fetch_csv_from_minio_to_memory(bucket_name, object_name):
-    try:
-        response = client.get_object(bucket_name, object_name)
-        data = BytesIO(response.read())
-        response.close()
-        response.release_conn()
-        return pd.read_csv(data) 
-    except S3Error as err:
-        st.error(f"Failed to download {object_name}: {err}")
-        return pd.DataFrame()  
-
-@st.cache_data
-def load_data():
-    bucket_name = "citybikes-gold-layer" 
-    latest_file = get_latest_gold_file(bucket_name)
-
-    if latest_file:
-        return fetch_csv_from_minio_to_memory(bucket_name, latest_file)
+))
+
+GOLD_BUCKET = "citybikes-gold-layer"
+MAP_WIDTH_PX = 1200
+MAP_HEIGHT_PX = 650
+NEAREST_STATIONS = 10
+
+@st.cache_resource
+def get_catalog():
+    return Catalog()
+
+# Results are cached per (city, range, resolution); the LRU bound keeps memory
+# flat no matter how many combinations users click through
+@st.cache_data(max_entries=DASHBOARD_CACHE_ENTRIES)
+def load_cities():
+    if DASHBOARD_SOURCE == "warehouse":
+        with connection() as conn:
+            return data_layer.warehouse_cities(conn)
+    return data_layer.lake_cities(get_catalog(), client)
+
+@st.cache_data(max_entries=DASHBOARD_CACHE_ENTRIES)
+def load_date_bounds(city_name):
+    if DASHBOARD_SOURCE == "warehouse":
+        with connection() as conn:
+            return data_layer.warehouse_date_bounds(conn, city_name)
+    return data_layer.lake_date_bounds(get_catalog(), client, city_name)
+
+def fetch_range(city_name, start_date, end_date):
+    if DASHBOARD_SOURCE == "warehouse":
+        with connection() as conn:
+            return data_layer.warehouse_series(conn, city_name, start_date, end_date)
+    return data_layer.lake_series(get_catalog(), client, city_name, start_date, end_date)
+
+@st.cache_data(max_entries=DASHBOARD_CACHE_ENTRIES)
+def load_data(city_name, start_date, end_date, max_points):
+    return data_layer.downsample(fetch_range(city_name, start_date, end_date), max_points)
+
+def fetch_since(city_name, since):
+    if DASHBOARD_SOURCE == "warehouse":
+        with connection() as conn:
+            return data_layer.warehouse_series_since(conn, city_name, since)
+    return data_layer.lake_series_since(get_catalog(), client, city_name, since)
+
+@st.cache_resource
+def get_series_store():
+    return data_layer.SeriesStore(fetch_since, fetch_range)
+
+# The store's version is part of the key, so new or replaced rows produce a
+# new entry while unchanged ranges keep hitting the cache
+@st.cache_data(max_entries=DASHBOARD_CACHE_ENTRIES)
+def load_live_data(city_name, start_date, end_date, max_points, version):
+    return data_layer.downsample(get_series_store().series(city_name, start_date, end_date), max_points)
+
+@st.cache_resource(ttl=DASHBOARD_REFRESH_SECONDS)
+def get_station_grid():
+    # Rebuilt from the newest silver run at most once per refresh interval
+    return spatial.StationGrid(spatial.lake_stations(get_catalog(), client))
+
+@st.cache_data(max_entries=DASHBOARD_CACHE_ENTRIES)
+def load_city_center(city_name):
+    if DASHBOARD_SOURCE == "warehouse":
+        with connection() as conn:
+            return spatial.warehouse_city_center(conn, city_name)
+    return get_station_grid().city_center(city_name)
+
+# Viewports are snapped outwards to grid cells so small pans reuse the cache
+def snap_box(west, south, east, north):
+    cell = SPATIAL_CELL_DEGREES
+    return (
+        round(math.floor(west / cell) * cell, 6), round(math.floor(south / cell) * cell, 6),
+        round(math.ceil(east / cell) * cell, 6), round(math.ceil(north / cell) * cell, 6),
+    )
+
+@st.cache_data(max_entries=DASHBOARD_CACHE_ENTRIES, ttl=DASHBOARD_REFRESH_SECONDS)
+def load_viewport(west, south, east, north):
+    if DASHBOARD_SOURCE == "warehouse":
+        with connection() as conn:
+            return spatial.warehouse_stations_in_box(conn, west, south, east, north)
+    return get_station_grid().in_box(west, south, east, north)
+
+@st.cache_data(max_entries=DASHBOARD_CACHE_ENTRIES, ttl=DASHBOARD_REFRESH_SECONDS)
+def load_nearest(longitude, latitude, radius_m):
+    if DASHBOARD_SOURCE == "warehouse":
+        with connection() as conn:
+            return spatial.warehouse_nearest(conn, longitude, latitude, NEAREST_STATIONS, radius_m)
+    return get_station_grid().nearest(longitude, latitude, NEAREST_STATIONS, radius_m)
+
+# Utilization comes from the analytics gold datasets, which only live in the lake
+@st.cache_data(max_entries=DASHBOARD_CACHE_ENTRIES, ttl=DASHBOARD_REFRESH_SECONDS)
+def load_utilization(city_name, start_date, end_date):
+    return (
+        data_layer.lake_city_utilization(get_catalog(), client, city_name, start_date, end_date),
+        data_layer.lake_station_utilization(get_catalog(), client, city_name, start_date, end_date),
+    )
+
+def select_city(city_options):
+    return st.sidebar.selectbox("Select a city to filter by:", city_options, index=list(city_options).index("Bruxelles") if "Bruxelles" in city_options else 0)
+
+def render_chart(data, selected_city):
+    if data.empty:
+        st.warning("No data available for the selected city and date range.")
+        return
+
+    fig = px.line(data, x='datetime', y='total_free_bikes', markers=len(data) <= 200,
+                  title=f"Evolution of Free Bikes in {selected_city} Over Time",
+                  labels={'datetime': 'Time', 'total_free_bikes': 'Number of Free Bikes'})
+
+    fig.update_traces(line=dict(width=4, color='blue'), marker=dict(size=8))
+    fig.update_layout(
+        title={'x': 0.5, 'xanchor': 'center', 'font': {'size': 24, 'color': 'black'}},
+        xaxis_title='Time',
+        yaxis_title='Number of Free Bikes',
+        xaxis=dict(showgrid=True, gridcolor='lightgray', gridwidth=0.5,
+                   tickfont=dict(size=14, color='black'),
+                   title_font=dict(size=18, color='black')),
+        yaxis=dict(showgrid=True, gridcolor='lightgray', gridwidth=0.5,
+                   tickfont=dict(size=14, color='black'),
+                   title_font=dict(size=18, color='black')),
+        margin=dict(l=0, r=0, t=40, b=40),
+        hovermode="x unified",
+        height=600,
+        plot_bgcolor="white",
+        paper_bgcolor="white",
+    )
+
+    st.plotly_chart(fig, use_container_width=True)
+
+def station_map(selected_city):
+    center = load_city_center(selected_city)
+    if center is None:
+        st.warning("No stations available for the selected city.")
+        return
+
+    zoom = st.sidebar.slider("Map zoom:", min_value=10, max_value=18, value=13)
+    longitude = st.sidebar.number_input("Map center longitude:", value=float(center[0]), format="%.5f", key=f"longitude_{selected_city}")
+    latitude = st.sidebar.number_input("Map center latitude:", value=float(center[1]), format="%.5f", key=f"latitude_{selected_city}")
+    radius_m = st.sidebar.number_input("Nearest stations within (m):", min_value=50, value=500, step=50)
+
+    # Only the stations inside the visible viewport are loaded
+    stations = load_viewport(*snap_box(*viewport_box(longitude, latitude, zoom, MAP_WIDTH_PX, MAP_HEIGHT_PX)))
+    if stations.empty:
+        st.warning("No stations in the visible area.")
     else:
-        st.error("No data found in the gold layer.")
-        return pd.DataFrame()
+        fig = px.scatter_mapbox(stations, lat='latitude', lon='longitude', color='free_bikes',
+                                hover_name='station_name',
+                                hover_data={'free_bikes': True, 'empty_slots': True, 'observed_at': True, 'latitude': False, 'longitude': False},
+                                color_continuous_scale='Blues', zoom=zoom, center={'lat': latitude, 'lon': longitude},
+                                labels={'free_bikes': 'Free Bikes', 'empty_slots': 'Empty Slots', 'observed_at': 'Observed At'})
+        fig.update_traces(marker=dict(size=10))
+        fig.update_layout(mapbox_style="open-street-map", margin=dict(l=0, r=0, t=0, b=0), height=MAP_HEIGHT_PX)
+        st.plotly_chart(fig, use_container_width=True)
+        st.caption(f"{len(stations)} stations in view")
+
+    nearest = load_nearest(longitude, latitude, radius_m)
+    st.subheader(f"Nearest stations within {radius_m} m of the map center")
+    if nearest.empty:
+        st.info("No stations within this distance.")
+    else:
+        st.dataframe(nearest[['station_name', 'free_bikes', 'empty_slots', 'distance_m']].round({'distance_m': 0}), hide_index=True)
+
+def utilization_view(selected_city, start_date, end_date):
+    city, stations = load_utilization(selected_city, start_date, end_date)
+    if city.empty:
+        st.warning("No utilization data for the selected city and date range yet.")
+        return
+
+    city = city.assign(turnover=city["bikes_taken"] + city["bikes_returned"])
+    fig = px.line(city, x='window_start', y='avg_occupancy_ratio',
+                  title=f"Average Station Occupancy in {selected_city}",
+                  labels={'window_start': 'Time', 'avg_occupancy_ratio': 'Occupancy Ratio'})
+    fig.update_layout(yaxis=dict(range=[0, 1]), hovermode="x unified", height=400, plot_bgcolor="white")
+    st.plotly_chart(fig, use_container_width=True)
+
+    fig = px.bar(city, x='window_start', y='turnover',
+                 title=f"Bikes Taken and Returned in {selected_city}",
+                 labels={'window_start': 'Time', 'turnover': 'Bikes Taken + Returned'})
+    fig.update_layout(hovermode="x unified", height=400, plot_bgcolor="white")
+    st.plotly_chart(fig, use_container_width=True)
+
+    st.subheader("Busiest stations")
+    st.dataframe(
+        stations[['station_name', 'turnover', 'bikes_taken', 'bikes_returned', 'occupancy_ratio', 'empty_hours', 'full_hours']]
+        .round({'occupancy_ratio': 2, 'empty_hours': 1, 'full_hours': 1}),
+        hide_index=True,
+    )
+
+@st.fragment(run_every=DASHBOARD_REFRESH_SECONDS)
+def live_chart(selected_city, start_date, end_date):
+    # Reruns on its own every interval; the shared store only fetches the
+    # visible range and what changed since its last refresh
+    version = get_series_store().refresh(selected_city, start_date)
+    render_chart(load_live_data(selected_city, start_date, end_date, DASHBOARD_MAX_POINTS, version), selected_city)
 
 def main():
     st.set_page_config(layout="wide")
     st.title("🚲 CityBikes Free Bikes Evolution Dashboard")
 
-    if st.button("Refresh Data"):
-        st.cache_data.clear()  
+    force_refresh = st.button("Refresh Data")
+    if force_refresh:
+        if DASHBOARD_REFRESH == "incremental":
+            # Nothing is thrown away, the store fetches again from just before its high-water mark
+            load_cities.clear()
+        else:
+            st.cache_data.clear()
     
-    data = load_data()  
-
-    if not data.empty:
-        city_options = data['city_name'].unique()
-        selected_city = st.sidebar.selectbox("Select a city to filter by:", city_options, index=list(city_options).index("Bruxelles") if "Bruxelles" in city_options else 0)
-
-        data['datetime'] = pd.to_datetime(data['timestamp'])
-
-        filtered_data = data[data['city_name'] == selected_city].copy()
-
-        min_date = filtered_data['datetime'].min()
-        max_date = filtered_data['datetime'].max()
-        start_date, end_date = st.sidebar.date_input("Select Date Range:", [min_date, max_date], min_value=min_date, max_value=max_date)
-
-        filtered_data = filtered_data[(filtered_data['datetime'].dt.date >= start_date) & (filtered_data['datetime'].dt.date <= end_date)]
-
-        if not filtered_data.empty:
-            fig = px.line(filtered_data, x='datetime', y='total_free_bikes', markers=True,
-                          title=f"Evolution of Free Bikes in {selected_city} Over Time",
-                          labels={'datetime': 'Time', 'total_free_bikes': 'Number of Free Bikes'})
-
-            fig.update_traces(line=dict(width=4, color='blue'), marker=dict(size=8))
-            fig.update_layout(
-                title={'x': 0.5, 'xanchor': 'center', 'font': {'size': 24, 'color': 'black'}},
-                xaxis_title='Time',
-                yaxis_title='Number of Free Bikes',
-                xaxis=dict(showgrid=True, gridcolor='lightgray', gridwidth=0.5,
-                           tickfont=dict(size=14, color='black'),
-                           title_font=dict(size=18, color='black')),
-                yaxis=dict(showgrid=True, gridcolor='lightgray', gridwidth=0.5,
-                           tickfont=dict(size=14, color='black'),
-                           title_font=dict(size=18, color='black')),
-                margin=dict(l=0, r=0, t=40, b=40),
-                hovermode="x unified",
-                height=600,
-                plot_bgcolor="white",
-                paper_bgcolor="white",
-            )
-
-            st.plotly_chart(fig, use_container_width=True)
+    city_options = load_cities()
+
+    if city_options:
+        selected_city = select_city(city_options)
+
+        view = st.sidebar.radio("View:", ["Free bikes over time", "Station map", "Station utilization"])
+        if view == "Station map":
+            station_map(selected_city)
+            return
+
+        min_date, max_date = load_date_bounds(selected_city)
+        default_start = min_date
+        if DASHBOARD_REFRESH == "incremental":
+            # The bounds are cached, the store has seen the newest rows
+            _, newest = get_series_store().date_bounds(selected_city)
+            if newest is not None and (max_date is None or newest > max_date):
+                max_date = newest
+            # Only the last days are fetched up front, older ones once they are selected
+            if min_date is not None:
+                default_start = max(min_date, max_date - timedelta(days=DASHBOARD_INITIAL_DAYS - 1))
+        if min_date is None:
+            st.warning("No data available for the selected city.")
+            return
+        start_date, end_date = st.sidebar.date_input("Select Date Range:", [default_start, max_date], min_value=min_date, max_value=max_date)
+
+        if view == "Station utilization":
+            utilization_view(selected_city, start_date, end_date)
+            return
+
+        if DASHBOARD_REFRESH == "incremental":
+            if force_refresh:
+                get_series_store().refresh(selected_city, start_date, force=True)
+            live_chart(selected_city, start_date, end_date)
         else:
-            st.warning("No data available for the selected city and date range.")
+            # Only the selected city and range are read, reduced to the chart's point budget
+            render_chart(load_data(selected_city, start_date, end_date, DASHBOARD_MAX_POINTS), selected_city)
     else:
         st.warning("No data available for visualization.")
 
 if __name__ == "__main__":
-    main()
+    with metrics.stage("dashboard"):
+        main()
+    # Counters accumulate over the life of the server, every rerun refreshes the file
+    metrics.write_prometheus("dashboard")
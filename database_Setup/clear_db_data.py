@@ -1,13 +1,14 @@
-import psycopg2
+import os
+import sys
 
-# Connect to PostgreSQL database
-conn = psycopg2.connect(
-    dbname="citybikes_data", user="postgres", password="postgres", host="localhost", port="5432"
-)
-cur = conn.cursor()
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database_Setup.warehouse import connect
 
 # Function to truncate all tables
 def clear_database():
+    # Connect to the DB_NAME database
+    conn = connect()
+    cur = conn.cursor()
     try:
         # Disable foreign key checks temporarily to avoid issues with truncating tables with relationships
         cur.execute("SET session_replication_role = 'replica';")
@@ -16,6 +17,7 @@ def clear_database():
         cur.execute("TRUNCATE TABLE fact_bike_availability RESTART IDENTITY CASCADE;")
         cur.execute("TRUNCATE TABLE dim_time RESTART IDENTITY CASCADE;")
         cur.execute("TRUNCATE TABLE dim_station RESTART IDENTITY CASCADE;")
+        cur.execute("TRUNCATE TABLE dim_city RESTART IDENTITY CASCADE;")
 
         # Re-enable foreign key checks
         cur.execute("SET session_replication_role = 'origin';")
@@ -32,4 +34,5 @@ def clear_database():
         conn.close()
 
 # Run the clear database function
-clear_database()
+if __name__ == "__main__":
+    clear_database()
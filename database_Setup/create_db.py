@@ -1,24 +1,27 @@
-import psycopg2
+import os
+import sys
 from psycopg2 import sql, OperationalError
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database_Setup.warehouse import connect, connection_params
+
 def create_database():
+    conn = None
+    dbname = connection_params()["dbname"]
     try:
-        # Connect to the default Postgres database
-        conn = psycopg2.connect(
-            dbname="citybikes_data", user="postgres", password="postgres", host="localhost", port="5432"
-        )
-        conn.autocommit = True
+        # Connect to the default Postgres database, DB_NAME may not exist yet
+        conn = connect(dbname="postgres", autocommit=True)
         cur = conn.cursor()
 
-        # Check if 'citybikes_data' database exists
-        cur.execute("SELECT 1 FROM pg_database WHERE datname = 'citybikes_data'")
+        # Check if the DB_NAME database exists
+        cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (dbname,))
         exists = cur.fetchone()
 
         if not exists:
-            cur.execute(sql.SQL("CREATE DATABASE citybikes_data"))
-            print("Database 'citybikes_data' created.")
+            cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(dbname)))
+            print(f"Database '{dbname}' created.")
         else:
-            print("Database 'citybikes_data' already exists.")
+            print(f"Database '{dbname}' already exists.")
         
         cur.close()
         conn.close()
@@ -1,56 +1,294 @@
-import psycopg2
+import os
+import sys
 from psycopg2 import sql, OperationalError
 
-def create_tables():
-    try:
-        # Connect to the citybikes_data database on the Dockerized TimeScaleDB instance
-        conn = psycopg2.connect(
-            dbname="citybikes_data", user="postgres", password="postgres", host="localhost", port="5432"
-        )
-        cur = conn.cursor()
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database_Setup.warehouse import connect
+
+SCHEMA_MODE = os.getenv("SCHEMA_MODE", "star")
+CHUNK_INTERVAL = os.getenv("CHUNK_INTERVAL", "1 day")
+COMPRESS_AFTER = os.getenv("COMPRESS_AFTER", "7 days")
+RETENTION_PERIOD = os.getenv("RETENTION_PERIOD", "365 days")
+
+def is_hypertable(cur, table_name):
+    cur.execute("""
+        SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = %s
+    """, (table_name,))
+    return cur.fetchone() is not None
+
+def migrate_to_hypertable(cur):
+    # Moves the observation time onto the fact table and turns it into a
+    # hypertable; safe to run on an existing star schema and to run again
+    cur.execute("CREATE EXTENSION IF NOT EXISTS timescaledb")
 
-        # Create the station dimension table
+    if not is_hypertable(cur, "fact_bike_availability"):
+        cur.execute("ALTER TABLE fact_bike_availability ADD COLUMN IF NOT EXISTS observed_at TIMESTAMPTZ")
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS dim_station (
-                station_id VARCHAR PRIMARY KEY,
-                station_name VARCHAR NOT NULL,
-                latitude FLOAT NOT NULL,
-                longitude FLOAT NOT NULL,
-                city_name VARCHAR NOT NULL
-            )
+            UPDATE fact_bike_availability fb SET observed_at = dt.timestamp
+            FROM dim_time dt
+            WHERE fb.time_id = dt.time_id AND fb.observed_at IS NULL
         """)
+        cur.execute("ALTER TABLE fact_bike_availability ALTER COLUMN observed_at SET NOT NULL")
+
+        # Unique constraints on a hypertable have to include the time column
+        cur.execute("ALTER TABLE fact_bike_availability DROP CONSTRAINT IF EXISTS fact_bike_availability_pkey")
+        cur.execute("ALTER TABLE fact_bike_availability ADD PRIMARY KEY (station_key, observed_at)")
 
-        # Create the time dimension table
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS dim_time (
-                time_id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMPTZ NOT NULL,
-                day DATE NOT NULL,
-                hour INTEGER NOT NULL
+            SELECT create_hypertable('fact_bike_availability', 'observed_at',
+                                     chunk_time_interval => %s::INTERVAL, migrate_data => true)
+        """, (CHUNK_INTERVAL,))
+        print("fact_bike_availability converted to a hypertable.")
+    else:
+        cur.execute("SELECT set_chunk_time_interval('fact_bike_availability', %s::INTERVAL)", (CHUNK_INTERVAL,))
+
+    cur.execute("""
+        SELECT compression_enabled FROM timescaledb_information.hypertables
+        WHERE hypertable_name = 'fact_bike_availability'
+    """)
+    if not cur.fetchone()[0]:
+        # Compressed chunks keep one segment per station ordered by time
+        cur.execute("""
+            ALTER TABLE fact_bike_availability SET (
+                timescaledb.compress,
+                timescaledb.compress_segmentby = 'station_key',
+                timescaledb.compress_orderby = 'observed_at DESC'
             )
         """)
+    cur.execute("SELECT add_compression_policy('fact_bike_availability', %s::INTERVAL, if_not_exists => true)", (COMPRESS_AFTER,))
+    cur.execute("SELECT add_retention_policy('fact_bike_availability', %s::INTERVAL, if_not_exists => true)", (RETENTION_PERIOD,))
+    print(f"Compression after {COMPRESS_AFTER} and retention of {RETENTION_PERIOD} configured.")
+
+CONTINUOUS_AGGREGATES = [
+    # (view, query, refresh start offset, refresh end offset, schedule interval)
+    # Joining a regular table needs TimescaleDB 2.10+, stacking on a cagg 2.9+
+    ("agg_city_minute", """
+        SELECT ds.city_id,
+               time_bucket(INTERVAL '1 minute', fb.observed_at) AS bucket,
+               SUM(fb.free_bikes) AS total_free_bikes,
+               SUM(fb.empty_slots) AS total_empty_slots,
+               COUNT(*) AS observations
+        FROM fact_bike_availability fb
+        JOIN dim_station ds ON fb.station_key = ds.station_key
+        GROUP BY ds.city_id, time_bucket(INTERVAL '1 minute', fb.observed_at)
+    """, "2 hours", "1 minute", "1 minute"),
+    ("agg_city_hour", """
+        SELECT city_id,
+               time_bucket(INTERVAL '1 hour', bucket) AS bucket,
+               AVG(total_free_bikes) AS avg_free_bikes,
+               MIN(total_free_bikes) AS min_free_bikes,
+               MAX(total_free_bikes) AS max_free_bikes
+        FROM agg_city_minute
+        GROUP BY city_id, time_bucket(INTERVAL '1 hour', bucket)
+    """, "1 day", "1 hour", "30 minutes"),
+    ("agg_station_day", """
+        SELECT station_key,
+               time_bucket(INTERVAL '1 day', observed_at) AS bucket,
+               AVG(free_bikes) AS avg_free_bikes,
+               MIN(free_bikes) AS min_free_bikes,
+               MAX(free_bikes) AS max_free_bikes,
+               AVG(empty_slots) AS avg_empty_slots,
+               COUNT(*) AS observations
+        FROM fact_bike_availability
+        GROUP BY station_key, time_bucket(INTERVAL '1 day', observed_at)
+    """, "3 days", "1 day", "1 hour"),
+]
 
-        # Create the fact table for bike availability
+def create_continuous_aggregates(cur):
+    # Must run outside a transaction block (autocommit connection)
+    for view, query, start_offset, end_offset, schedule in CONTINUOUS_AGGREGATES:
+        cur.execute(f"""
+            CREATE MATERIALIZED VIEW IF NOT EXISTS {view}
+            WITH (timescaledb.continuous) AS {query}
+            WITH NO DATA
+        """)
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS fact_bike_availability (
-                station_id VARCHAR REFERENCES dim_station(station_id),
-                time_id INTEGER REFERENCES dim_time(time_id),
-                free_bikes INTEGER NOT NULL,
-                empty_slots INTEGER NOT NULL,
-                PRIMARY KEY (station_id, time_id)
-            )
+            SELECT add_continuous_aggregate_policy(%s,
+                start_offset => %s::INTERVAL, end_offset => %s::INTERVAL,
+                schedule_interval => %s::INTERVAL, if_not_exists => true)
+        """, (view, start_offset, end_offset, schedule))
+        print(f"Continuous aggregate {view} ready, refreshed every {schedule}.")
+
+# Facts only hold the observations that changed (CDC_MODE), so aggregations
+# read the series through this function: on a grid of step, every station's
+# last observation at or before the grid point, as long as it is younger than
+# horizon (older means the station stopped reporting). The grid is half-open,
+# [since, until), so consecutive incremental exports do not overlap.
+RECONSTRUCTION_FUNCTION = """
+    CREATE OR REPLACE FUNCTION reconstruct_bike_availability(
+        since TIMESTAMPTZ, until TIMESTAMPTZ, step INTERVAL, horizon INTERVAL
+    )
+    RETURNS TABLE (station_key INTEGER, observed_at TIMESTAMPTZ, free_bikes INTEGER, empty_slots INTEGER)
+    LANGUAGE sql STABLE AS $$
+        -- Each change holds until the next change of its station, for at most
+        -- horizon; only the grid points inside that interval are generated.
+        -- Grid points are aligned to 2000-01-01, the first one at or after a
+        -- moment is date_bin(moment - 1 microsecond) + step
+        WITH changes AS (
+            SELECT fb.station_key, {time} AS changed_at, fb.free_bikes, fb.empty_slots,
+                   lead({time}) OVER (PARTITION BY fb.station_key ORDER BY {time}) AS next_change
+            FROM {source}
+            WHERE {time} > since - horizon AND {time} < until
+        )
+        SELECT c.station_key, grid.point, c.free_bikes, c.empty_slots
+        FROM changes c
+        CROSS JOIN LATERAL generate_series(
+            date_bin(step, GREATEST(c.changed_at, since) - INTERVAL '1 microsecond', TIMESTAMPTZ '2000-01-01') + step,
+            LEAST(c.next_change, c.changed_at + horizon, until) - INTERVAL '1 microsecond',
+            step
+        ) AS grid(point)
+    $$
+"""
+
+def create_reconstruction_function(cur):
+    # Dropped first, CREATE OR REPLACE cannot change the returned columns
+    cur.execute("DROP FUNCTION IF EXISTS reconstruct_bike_availability(TIMESTAMPTZ, TIMESTAMPTZ, INTERVAL, INTERVAL)")
+    if SCHEMA_MODE == "hypertable":
+        cur.execute(RECONSTRUCTION_FUNCTION.format(source="fact_bike_availability fb", time="fb.observed_at"))
+    else:
+        cur.execute(RECONSTRUCTION_FUNCTION.format(
+            source="fact_bike_availability fb JOIN dim_time dt ON fb.time_id = dt.time_id", time="dt.timestamp"
+        ))
+    print("Function reconstruct_bike_availability created.")
+
+def column_exists(cur, table_name, column_name):
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s
+    """, (table_name, column_name))
+    return cur.fetchone() is not None
+
+def migrate_to_surrogate_keys(cur):
+    # Older databases carry the VARCHAR station id on every fact row and the
+    # city name on every station; both move to integer keys in place. Safe to
+    # run on a migrated or fresh schema.
+    station_names = column_exists(cur, "dim_station", "city_name")
+    fact_ids = column_exists(cur, "fact_bike_availability", "station_id")
+    if not station_names and not fact_ids:
+        return
+
+    # The aggregates reference the old columns, they are recreated afterwards
+    for view in ("agg_city_hour", "agg_city_minute", "agg_station_day"):
+        cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view} CASCADE")
+
+    if station_names:
+        cur.execute("INSERT INTO dim_city (city_name) SELECT DISTINCT city_name FROM dim_station ON CONFLICT (city_name) DO NOTHING")
+        cur.execute("ALTER TABLE dim_station ADD COLUMN IF NOT EXISTS city_id INTEGER REFERENCES dim_city(city_id)")
+        cur.execute("UPDATE dim_station ds SET city_id = dc.city_id FROM dim_city dc WHERE dc.city_name = ds.city_name")
+        cur.execute("ALTER TABLE dim_station ALTER COLUMN city_id SET NOT NULL")
+        cur.execute("ALTER TABLE dim_station DROP COLUMN city_name")
+    if not column_exists(cur, "dim_station", "station_key"):
+        cur.execute("ALTER TABLE dim_station ADD COLUMN station_key SERIAL UNIQUE")
+
+    if fact_ids:
+        hypertable = SCHEMA_MODE == "hypertable" and is_hypertable(cur, "fact_bike_availability")
+        if hypertable:
+            # Compressed chunks cannot be altered, compression is set up again on station_key
+            cur.execute("SELECT remove_compression_policy('fact_bike_availability', if_exists => true)")
+            cur.execute("SELECT decompress_chunk(c, if_not_compressed => true) FROM show_chunks('fact_bike_availability') c")
+            cur.execute("ALTER TABLE fact_bike_availability SET (timescaledb.compress = false)")
+
+        cur.execute("ALTER TABLE fact_bike_availability ADD COLUMN IF NOT EXISTS station_key INTEGER")
+        cur.execute("""
+            UPDATE fact_bike_availability fb SET station_key = ds.station_key
+            FROM dim_station ds
+            WHERE fb.station_id = ds.station_id
+        """)
+        cur.execute("ALTER TABLE fact_bike_availability ALTER COLUMN station_key SET NOT NULL")
+        cur.execute("ALTER TABLE fact_bike_availability DROP CONSTRAINT IF EXISTS fact_bike_availability_pkey")
+        cur.execute(f"ALTER TABLE fact_bike_availability ADD PRIMARY KEY (station_key, {'observed_at' if hypertable else 'time_id'})")
+        cur.execute("""
+            ALTER TABLE fact_bike_availability
+            ADD FOREIGN KEY (station_key) REFERENCES dim_station(station_key)
         """)
+        cur.execute("ALTER TABLE fact_bike_availability DROP COLUMN station_id")
+    print("Stations and cities migrated to integer surrogate keys.")
+
+def create_schema(conn):
+    cur = conn.cursor()
+
+    # Create the city dimension table
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS dim_city (
+            city_id SERIAL PRIMARY KEY,
+            city_name VARCHAR NOT NULL UNIQUE
+        )
+    """)
+
+    # Create the station dimension table; station_id is the key of the API,
+    # station_key the compact key the fact table uses
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS dim_station (
+            station_id VARCHAR PRIMARY KEY,
+            station_key SERIAL UNIQUE,
+            station_name VARCHAR NOT NULL,
+            latitude FLOAT NOT NULL,
+            longitude FLOAT NOT NULL,
+            city_id INTEGER NOT NULL REFERENCES dim_city(city_id)
+        )
+    """)
+
+    # Viewport and nearest-station lookups use this GiST index; queries have to
+    # repeat the point(longitude, latitude) expression to match it
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS dim_station_location_idx ON dim_station USING gist (point(longitude, latitude))
+    """)
+
+    # Create the time dimension table
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS dim_time (
+            time_id SERIAL PRIMARY KEY,
+            timestamp TIMESTAMPTZ NOT NULL,
+            day DATE NOT NULL,
+            hour INTEGER NOT NULL
+        )
+    """)
 
-        # Add a unique constraint to prevent duplicate station_id and time_id combinations
-        # cur.execute("""
-        #     ALTER TABLE fact_bike_availability
-        #     ADD CONSTRAINT unique_station_time UNIQUE (station_id, time_id);
-        # """)
+    # Timestamps are looked up and upserted by value, so they must be unique
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS dim_time_timestamp_idx ON dim_time (timestamp)
+    """)
 
+    # Create the fact table for bike availability
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS fact_bike_availability (
+            station_key INTEGER REFERENCES dim_station(station_key),
+            time_id INTEGER REFERENCES dim_time(time_id),
+            free_bikes INTEGER NOT NULL,
+            empty_slots INTEGER NOT NULL,
+            PRIMARY KEY (station_key, time_id)
+        )
+    """)
+
+    migrate_to_surrogate_keys(cur)
+
+    # Add a unique constraint to prevent duplicate station_id and time_id combinations
+    # cur.execute("""
+    #     ALTER TABLE fact_bike_availability
+    #     ADD CONSTRAINT unique_station_time UNIQUE (station_id, time_id);
+    # """)
+
+    conn.commit()
+    print("Tables created successfully and unique constraint added.")
+
+    if SCHEMA_MODE == "hypertable":
+        migrate_to_hypertable(cur)
         conn.commit()
-        print("Tables created successfully and unique constraint added.")
 
-        cur.close()
+    create_reconstruction_function(cur)
+    conn.commit()
+
+    if SCHEMA_MODE == "hypertable":
+        conn.autocommit = True
+        create_continuous_aggregates(cur)
+
+    cur.close()
+
+def create_tables():
+    conn = None
+    try:
+        # Connect to the DB_NAME database on the Dockerized TimeScaleDB instance
+        conn = connect()
+        create_schema(conn)
         conn.close()
 
     except OperationalError as e:
@@ -0,0 +1,148 @@
+import os
+import time
+import random
+import threading
+import weakref
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from data_Monitoring import metrics
+from data_Monitoring.metrics import MetricsConnection
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_RETRIES = int(os.getenv("DB_RETRIES", "3"))
+DB_RETRY_BACKOFF = float(os.getenv("DB_RETRY_BACKOFF", "0.5"))
+DB_COMMIT_ROWS = int(os.getenv("DB_COMMIT_ROWS", "1000"))
+DB_PAGE_SIZE = int(os.getenv("DB_PAGE_SIZE", "1000"))
+
+# Every stage reaches the warehouse through here. Connections come from one
+# pool per process and database, configured from the DB_* settings, so
+# concurrent stages and the dashboard reuse them instead of connecting per
+# call. Dropped connections, deadlocks and serialization failures are retried
+# on a fresh connection, and writes are committed in batches, not per row.
+
+# Connection losses, deadlocks and serialization failures are all
+# OperationalError subclasses
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+pools = {}
+pools_lock = threading.Lock()
+prepared_statements = weakref.WeakKeyDictionary()
+prepared_lock = threading.Lock()
+
+def connection_params(dbname=None):
+    # The defaults are the local TimescaleDB the setup scripts always assumed
+    return {
+        "dbname": dbname or os.getenv("DB_NAME", "citybikes_data"),
+        "user": os.getenv("DB_USER", "postgres"),
+        "password": os.getenv("DB_PASSWORD", "postgres"),
+        "host": os.getenv("DB_HOST", "localhost"),
+        "port": os.getenv("DB_PORT", "5432"),
+    }
+
+def retry_delay(attempt, backoff=DB_RETRY_BACKOFF):
+    return random.uniform(0, backoff * 2 ** attempt)
+
+def connect(dbname=None, autocommit=False, retries=DB_RETRIES):
+    # A connection of its own, for DDL and other work that should not hold a pool slot
+    for attempt in range(retries + 1):
+        try:
+            conn = psycopg2.connect(**connection_params(dbname), connection_factory=MetricsConnection)
+            conn.autocommit = autocommit
+            return conn
+        except psycopg2.OperationalError as err:
+            if attempt == retries:
+                raise
+            delay = retry_delay(attempt)
+            print(f"Connecting to the warehouse failed: {err}. Retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
+
+class ConnectionPool:
+    # ThreadedConnectionPool raises once every connection is handed out; here
+    # callers wait for a free one instead
+    def __init__(self, dbname=None, minconn=DB_POOL_MIN, maxconn=DB_POOL_SIZE):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, connection_factory=MetricsConnection, **connection_params(dbname))
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self):
+        self.slots.acquire()
+        try:
+            conn = self.pool.getconn()
+            if conn.closed:
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+            return conn
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            close = bool(conn.closed)
+            if not close:
+                try:
+                    # The next user always starts outside a transaction, in the default mode
+                    conn.rollback()
+                    conn.autocommit = False
+                except TRANSIENT_ERRORS:
+                    close = True
+            self.pool.putconn(conn, close=close)
+        finally:
+            self.slots.release()
+
+    def closeall(self):
+        self.pool.closeall()
+
+def get_pool(dbname=None):
+    dbname = connection_params(dbname)["dbname"]
+    with pools_lock:
+        if dbname not in pools:
+            pools[dbname] = ConnectionPool(dbname)
+        return pools[dbname]
+
+def close_pools():
+    with pools_lock:
+        for pool in pools.values():
+            pool.closeall()
+        pools.clear()
+
+@contextmanager
+def connection(dbname=None):
+    pool = get_pool(dbname)
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+def run_transaction(fn, *args, retries=DB_RETRIES, dbname=None, **kwargs):
+    # fn(conn, ...) runs as one transaction on a pooled connection; after a
+    # transient failure it is rolled back and run again from the start
+    for attempt in range(retries + 1):
+        with connection(dbname) as conn:
+            try:
+                result = fn(conn, *args, **kwargs)
+                conn.commit()
+                return result
+            except TRANSIENT_ERRORS as err:
+                if attempt == retries:
+                    raise
+                metrics.count("db_retries")
+                delay = retry_delay(attempt)
+                print(f"Warehouse transaction failed: {err}. Retrying in {delay:.1f} seconds...")
+        time.sleep(delay)
+
+def copy_rows(cur, table_name, columns, buffer, format="csv"):
+    cur.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT {format})", buffer)
+
+def execute_prepared(cur, name, sql, params):
+    # sql uses $1, $2, ... placeholders. It is parsed and planned once per
+    # connection; every later call only sends EXECUTE with the parameters
+    conn = cur.connection
+    with prepared_lock:
+        names = prepared_statements.setdefault(conn, set())
+    if name not in names:
+        cur.execute(f"PREPARE {name} AS {sql}")
+        names.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
@@ -1,6 +1,42 @@
 import os
 from prefect import flow, task
 import subprocess
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+import urllib3
+import pyarrow as pa
+import polars as pl
+from minio import Minio
+
+from data_Ingestion import fetch_networks
+from data_Ingestion.http_cache import HttpCache
+from data_Processing import processing
+from data_Loading import load
+from data_Transforming import transform
+from data_Analytics import analytics
+from data_Lake.lake import RAW_EXTENSION, read_table, to_table, write_partitioned
+from data_Lake.catalog import Catalog
+from data_Lake.schemas import BRONZE_SCHEMA, SILVER_SCHEMA
+from data_Lake.station_state import CDC_MODE, StationStateStore
+from data_Lake.station_records import BRONZE_FORMAT, parse_raw, write_raw_partitioned
+from database_Setup import warehouse
+from data_Monitoring import metrics
+from data_Monitoring.metrics import instrument_client
+
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "subprocess")
+CACHE_EXPIRATION = timedelta(hours=int(os.getenv("PIPELINE_CACHE_HOURS", "6")))
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "60"))
+POLL_MAX_COALESCE = int(os.getenv("POLL_MAX_COALESCE", "3"))
+
+# One worker so checkpoints land in order: a bronze run is always registered
+# in the catalog before the silver run built from it
+CHECKPOINT_WORKERS = 1
+
+resources = {}
+pending_checkpoints = []
+checkpoint_lock = threading.Lock()
 
 
 @task
@@ -23,14 +59,293 @@ def data_transforming():
     print("Starting data transformation...")
     subprocess.run(["citybikes_env/Scripts/python", "data_Transforming/transform.py"], check=True)
 
+@task
+def data_analytics():
+    print("Starting station analytics...")
+    subprocess.run(["citybikes_env/Scripts/python", "data_Analytics/analytics.py"], check=True)
+
 @task
 def data_visualization():
     print("Starting data visualization (Streamlit)...")
     # Streamlit run command
     subprocess.run(["streamlit", "run", "data_Visualization/visualize.py"], check=True)
 
+def shared_minio():
+    # One pooled client for every stage instead of a fresh one per module
+    if "minio" not in resources:
+        http_client = urllib3.PoolManager(
+            maxsize=16,
+            timeout=urllib3.Timeout(connect=5, read=120),
+            retries=urllib3.Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+        )
+        resources["minio"] = instrument_client(Minio(
+            "127.0.0.1:9000",
+            access_key=os.getenv("MINIO_ACCESS_KEY"),
+            secret_key=os.getenv("MINIO_SECRET_KEY"),
+            secure=False,
+            http_client=http_client,
+        ))
+        for module in (fetch_networks, processing, load, transform, analytics):
+            module.client = resources["minio"]
+    return resources["minio"]
+
+def shared_station_state():
+    if "station_state" not in resources:
+        resources["station_state"] = StationStateStore()
+    return resources["station_state"]
+
+def shared_catalog():
+    if "catalog" not in resources:
+        resources["catalog"] = Catalog()
+    return resources["catalog"]
+
+def checkpoint(fn, *args, **kwargs):
+    # MinIO writes are durability checkpoints, the next stage does not wait for them
+    with checkpoint_lock:
+        if "checkpoints" not in resources:
+            resources["checkpoints"] = ThreadPoolExecutor(max_workers=CHECKPOINT_WORKERS)
+        # Finished checkpoints are dropped so a long-running poll does not keep their tables alive
+        for future in [future for future in pending_checkpoints if future.done()]:
+            pending_checkpoints.remove(future)
+            if future.exception():
+                print(f"Checkpoint failed: {future.exception()}")
+        pending_checkpoints.append(resources["checkpoints"].submit(run_checkpoint, fn, *args, **kwargs))
+
+def run_checkpoint(fn, *args, **kwargs):
+    with metrics.stage("checkpoint"):
+        return fn(*args, **kwargs)
+
+def wait_for_checkpoints():
+    with checkpoint_lock:
+        futures = list(pending_checkpoints)
+        pending_checkpoints.clear()
+    for future in futures:
+        future.result()
+
+def source_cache_key(context, parameters):
+    # Results are cached on the identity of the input run, not on the table contents
+    return f"{context.task.name}-{parameters['source']}"
+
+def checkpoint_silver(silver, run_id, sources):
+    catalog = shared_catalog()
+    write_partitioned(shared_minio(), silver, SILVER_SCHEMA, processing.SILVER_BUCKET, "cleaned_stations", run_id, catalog=catalog, layer="silver", strict=True)
+    # The processing watermark moves to the newest of these runs once no older
+    # bronze run is still waiting; runs registered after them do not hold it back
+    newest = max(sources)
+    if all(run in sources for run in catalog.unprocessed_runs("processing", "bronze") if run <= newest):
+        catalog.set_watermark("processing", "bronze", newest)
+
+def reload_bronze(run_ids):
+    # Bronze snapshots a slot dropped, read back from their checkpoints
+    bronze_files = shared_catalog().objects_in_runs("bronze", run_ids)
+    raw_files = [object_name for object_name in bronze_files if object_name.endswith(RAW_EXTENSION)]
+    parquet_files = [object_name for object_name in bronze_files if object_name.endswith(".parquet")]
+    frames = [df for df in (
+        processing.load_raw_data(processing.BRONZE_BUCKET, raw_files) if raw_files else None,
+        processing.load_parquet_data(processing.BRONZE_BUCKET, parquet_files) if parquet_files else None,
+    ) if df is not None]
+    return pl.concat(frames, how="vertical_relaxed").to_arrow() if frames else None
+
+def reload_silver(run_ids):
+    return read_table(shared_minio(), processing.SILVER_BUCKET, shared_catalog().objects_in_runs("silver", run_ids))
+
+@task
+def ingest_in_process():
+    print("Starting data ingestion (in-process)...")
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    cache = HttpCache() if fetch_networks.HTTP_CACHE_ENABLED else None
+
+    with metrics.stage("ingestion"):
+        with fetch_networks.create_session() as session:
+            networks = fetch_networks.fetch_network_data(session, cache=cache)
+            if BRONZE_FORMAT == "ndjson":
+                responses = fetch_networks.capture_station_responses(networks, session=session, cache=cache)
+            else:
+                stations = fetch_networks.consolidate_station_data_concurrent(networks, session=session, cache=cache)
+
+        if BRONZE_FORMAT == "ndjson":
+            # The raw responses go to the lake, the next stage gets them parsed with the declared dtypes
+            bronze = to_table(parse_raw(b"".join(line for _, line in responses)), BRONZE_SCHEMA)
+        else:
+            bronze = to_table(fetch_networks.to_bronze_frame(stations), BRONZE_SCHEMA)
+        metrics.rows_out(bronze.num_rows)
+    if BRONZE_FORMAT == "ndjson":
+        date = datetime.now(timezone.utc).date().isoformat()
+        checkpoint(write_raw_partitioned, shared_minio(), responses, processing.BRONZE_BUCKET, "consolidated_stations", run_id, date, catalog=shared_catalog(), layer="bronze", strict=True)
+    else:
+        checkpoint(write_partitioned, shared_minio(), bronze, BRONZE_SCHEMA, processing.BRONZE_BUCKET, "consolidated_stations", run_id, catalog=shared_catalog(), layer="bronze", strict=True)
+    return run_id, bronze
+
+@task(cache_key_fn=source_cache_key, cache_expiration=CACHE_EXPIRATION, persist_result=True)
+def process_in_process(source, bronze):
+    print(f"Starting data processing (in-process) of bronze run {source}...")
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    with metrics.stage("processing"):
+        silver = processing.process_table(bronze)
+        if CDC_MODE == "processing":
+            # The state moves on right away, the next snapshot may be processed
+            # before this one's silver checkpoint has landed
+            cleaned, silver = silver, shared_station_state().changed("processing", silver)
+            shared_station_state().update("processing", cleaned)
+    checkpoint(checkpoint_silver, silver, run_id, source.split("+"))
+    return run_id, silver
+
+@task(cache_key_fn=source_cache_key, cache_expiration=CACHE_EXPIRATION, persist_result=True)
+def load_in_process(source, silver):
+    print(f"Starting data loading (in-process) of silver run {source}...")
+    # Connections come from the process-wide warehouse pool; a deadlock or a
+    # dropped connection reruns the load on a fresh one
+    with metrics.stage("loading"):
+        if CDC_MODE != "load":
+            result = warehouse.run_transaction(load.bulk_load, silver)
+        else:
+            result = warehouse.run_transaction(load.bulk_load, shared_station_state().changed("load", silver))
+            shared_station_state().update("load", silver)
+    # Compaction only merges the silver runs loading has moved past
+    shared_catalog().set_watermark("loading", "silver", max(source.split("+")))
+    return result
+
+@task
+def transform_in_process(mode=None):
+    print("Starting data transformation (in-process)...")
+    with warehouse.connection() as conn, metrics.stage("transform"):
+        if (mode or transform.TRANSFORM_MODE) == "incremental":
+            return transform.export_incremental(conn, shared_catalog())
+        return transform.export_full(conn, shared_catalog())
+
+@task
+def analytics_in_process():
+    # Reads silver from the lake, so it runs once the checkpoints have landed
+    print("Starting station analytics (in-process)...")
+    with metrics.stage("analytics"):
+        return analytics.run_analytics(shared_minio(), shared_catalog())
+
+class SnapshotSlot:
+    # Bounded hand-off between two pipelined stages. The producer never blocks:
+    # if the consumer has not taken the pending snapshots yet, the new one is
+    # coalesced with them (concatenated, the stages deduplicate), and beyond
+    # max_snapshots the oldest are dropped from memory. Only their run ids are
+    # kept; the consumer reads them back from their lake checkpoints with
+    # reload(run_ids), so a dropped snapshot is delayed, never lost.
+    def __init__(self, name, reload, max_snapshots=POLL_MAX_COALESCE):
+        self.name = name
+        self.reload = reload
+        self.max_snapshots = max_snapshots
+        self.items = []
+        self.dropped = []
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, run_id, table):
+        with self.condition:
+            self.items.append((run_id, table))
+            while len(self.items) > self.max_snapshots:
+                dropped_run, _ = self.items.pop(0)
+                self.dropped.append(dropped_run)
+                print(f"{self.name} is falling behind, dropped snapshot {dropped_run} from memory")
+            if len(self.items) > 1:
+                print(f"{self.name} is falling behind, coalescing {len(self.items)} snapshots")
+            self.condition.notify()
+
+    def take(self):
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return None
+            items, self.items = self.items, []
+            dropped, self.dropped = self.dropped, []
+        tables = [table for _, table in items]
+        if dropped:
+            # The checkpoints of dropped snapshots were queued before the ones
+            # still in memory, so they have landed once the queue is drained
+            try:
+                wait_for_checkpoints()
+                reloaded = self.reload(dropped)
+                if reloaded is not None:
+                    tables.insert(0, to_table(reloaded, tables[0].schema))
+            except Exception as e:
+                print(f"{self.name} could not reload dropped snapshots {dropped}: {e}")
+        run_ids = dropped + [run_id for run_id, _ in items]
+        return run_ids, pa.concat_tables(tables)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+def poll_ingestion(stop, to_processing, started, interval):
+    # Fixed cadence: ticks are planned from the start time, a slow fetch skips
+    # the ticks it overran instead of drifting
+    next_tick = time.monotonic()
+    while not stop.is_set():
+        tick = time.monotonic()
+        try:
+            run_id, bronze = ingest_in_process.fn()
+            started[run_id] = tick
+            to_processing.put(run_id, bronze)
+        except Exception as e:
+            print(f"Ingestion failed: {e}")
+
+        next_tick += interval
+        now = time.monotonic()
+        if next_tick < now:
+            next_tick += interval * ((now - next_tick) // interval + 1)
+        stop.wait(next_tick - now)
+    to_processing.close()
+
+def poll_processing(from_ingestion, to_loading, started):
+    while True:
+        batch = from_ingestion.take()
+        if batch is None:
+            break
+        sources, bronze = batch
+        ticks = [started.pop(run_id) for run_id in sources if run_id in started]
+        try:
+            silver_run, silver = process_in_process.fn("+".join(sources), bronze)
+            # Keyed by the silver run so a dropped snapshot can be reloaded;
+            # freshness is reported from the newest bronze run in it
+            if ticks:
+                started[silver_run] = max(ticks)
+            to_loading.put(silver_run, silver)
+        except Exception as e:
+            print(f"Processing of {sources} failed: {e}")
+    to_loading.close()
+
+def poll_loading(from_processing, started):
+    while True:
+        batch = from_processing.take()
+        if batch is None:
+            break
+        sources, silver = batch
+        newest = sources[-1]
+        try:
+            load_in_process.fn("+".join(sources), silver)
+        except Exception as e:
+            print(f"Loading of {sources} failed: {e}")
+        else:
+            try:
+                # Only what was loaded since the last export is exported, whatever TRANSFORM_MODE says
+                transform_in_process.fn("incremental")
+                freshness = time.monotonic() - started.get(newest, time.monotonic())
+                print(f"Snapshot {newest} loaded and exported {freshness:.1f}s after ingestion started")
+                metrics.gauge("freshness_seconds", freshness, stage="pipeline")
+                metrics.write_prometheus("pipeline")
+            except Exception as e:
+                # The snapshot is in the warehouse; the next export picks it up
+                print(f"Export after loading {sources} failed: {e}")
+        for run_id in sources:
+            started.pop(run_id, None)
+
+def publish_metrics(started_at):
+    # Every stage script writes its own report; in-process runs add this one
+    run_report = metrics.write_report("pipeline")
+    reports = metrics.reports_since(started_at)
+    metrics.attach_to_prefect(reports or [run_report])
+
 @flow(name="CityBikes Data Pipeline")
 def citybikes_pipeline():
+    started_at = time.time()
     data_ingestion()
     
     data_processing()
@@ -39,7 +354,70 @@ def citybikes_pipeline():
     
     data_transforming()
 
+    data_analytics()
+
+    metrics.attach_to_prefect(metrics.reports_since(started_at))
+
     data_visualization()
 
+@flow(name="CityBikes In-Process Pipeline")
+def citybikes_pipeline_in_process(visualize=True):
+    started_at = time.time()
+    shared_minio()
+
+    bronze_run, bronze = ingest_in_process()
+
+    silver_run, silver = process_in_process(bronze_run, bronze)
+
+    load_in_process(silver_run, silver)
+
+    transform_in_process()
+
+    wait_for_checkpoints()
+
+    analytics_in_process()
+
+    publish_metrics(started_at)
+
+    if visualize:
+        data_visualization()
+
+@flow(name="CityBikes Polling Pipeline")
+def citybikes_polling_pipeline(interval=POLL_INTERVAL):
+    # Ingestion, processing and loading run in their own threads so snapshot
+    # N+1 is fetched while snapshot N is still being processed and loaded
+    started_at = time.time()
+    shared_minio()
+    stop = threading.Event()
+    started = {}
+    to_processing = SnapshotSlot("Processing", reload_bronze)
+    to_loading = SnapshotSlot("Loading", reload_silver)
+
+    workers = [
+        threading.Thread(target=poll_ingestion, args=(stop, to_processing, started, interval), name="ingestion"),
+        threading.Thread(target=poll_processing, args=(to_processing, to_loading, started), name="processing"),
+        threading.Thread(target=poll_loading, args=(to_loading, started), name="loading"),
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        while any(worker.is_alive() for worker in workers):
+            workers[0].join(timeout=1)
+    except KeyboardInterrupt:
+        print("Stopping polling pipeline...")
+        stop.set()
+        for worker in workers:
+            worker.join()
+    finally:
+        wait_for_checkpoints()
+        publish_metrics(started_at)
+
 if __name__ == "__main__":
-    citybikes_pipeline()
+    # The stage scripts run as subprocesses unless in-process or polling runs are asked for
+    if PIPELINE_MODE == "inprocess":
+        citybikes_pipeline_in_process()
+    elif PIPELINE_MODE == "poll":
+        citybikes_polling_pipeline()
+    else:
+        citybikes_pipeline()
@@ -0,0 +1,90 @@
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+import psycopg2
+import pyarrow as pa
+import pytest
+
+# The repository root goes first so its packages win over installed ones
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from benchmarks.object_store import MemoryObjectStore
+from data_Lake.catalog import Catalog
+from data_Lake.schemas import BRONZE_SCHEMA
+
+LAKE_BUCKETS = ["citybikes-bronze-layer", "citybikes-silver-layer", "citybikes-gold-layer"]
+STARTED = datetime(2024, 9, 1, 8, 0, tzinfo=timezone.utc)
+
+# Warehouse tests need a PostgreSQL server (14+) and are skipped without one:
+#   TEST_DB_HOST=localhost TEST_DB_PORT=5432 python -m pytest tests
+TEST_DB_HOST = os.getenv("TEST_DB_HOST")
+TEST_DB_PARAMS = {
+    "host": TEST_DB_HOST,
+    "port": os.getenv("TEST_DB_PORT", "5432"),
+    "user": os.getenv("TEST_DB_USER", "postgres"),
+    "password": os.getenv("TEST_DB_PASSWORD", "postgres"),
+}
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    # Catalogs, station state and metrics default to paths under the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def object_store():
+    store = MemoryObjectStore()
+    for bucket_name in LAKE_BUCKETS:
+        store.make_bucket(bucket_name)
+    return store
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(str(tmp_path / "catalog.db"))
+    yield catalog
+    catalog.close()
+
+def observation(station_id, minutes, free_bikes, empty_slots=10, city_name="Gent"):
+    return {
+        "id": station_id,
+        "name": f"{city_name} station {station_id}",
+        "latitude": 51.05,
+        "longitude": 3.72,
+        "timestamp": STARTED + timedelta(minutes=minutes),
+        "free_bikes": free_bikes,
+        "empty_slots": empty_slots,
+        "extra": None,
+        "network_name": f"{city_name} Bikes",
+        "city_name": city_name,
+    }
+
+def bronze_table(observations):
+    return pa.Table.from_pylist(observations, schema=BRONZE_SCHEMA)
+
+@pytest.fixture
+def warehouse_db(monkeypatch):
+    # A fresh database with the pipeline's star schema, reached through the DB_* settings
+    if not TEST_DB_HOST:
+        pytest.skip("TEST_DB_HOST is not set")
+    from database_Setup import warehouse
+    from database_Setup.create_tables import create_schema
+
+    dbname = f"citybikes_test_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+    admin = psycopg2.connect(dbname="postgres", **TEST_DB_PARAMS)
+    admin.autocommit = True
+    admin.cursor().execute(f'CREATE DATABASE "{dbname}"')
+
+    monkeypatch.setenv("DB_NAME", dbname)
+    monkeypatch.setenv("DB_HOST", TEST_DB_PARAMS["host"])
+    monkeypatch.setenv("DB_PORT", TEST_DB_PARAMS["port"])
+    monkeypatch.setenv("DB_USER", TEST_DB_PARAMS["user"])
+    monkeypatch.setenv("DB_PASSWORD", TEST_DB_PARAMS["password"])
+    conn = warehouse.connect()
+    create_schema(conn)
+    conn.close()
+    try:
+        yield dbname
+    finally:
+        warehouse.close_pools()
+        admin.cursor().execute(f'DROP DATABASE IF EXISTS "{dbname}" WITH (FORCE)')
+        admin.close()
@@ -0,0 +1,46 @@
+from datetime import timedelta
+import polars as pl
+import pytest
+from conftest import STARTED, observation
+from data_Analytics.analytics import SILVER_COLUMNS, city_utilization, station_utilization
+
+MAX_GAP = timedelta(minutes=30)
+
+def silver(observations):
+    return pl.DataFrame(observations).select(SILVER_COLUMNS).lazy()
+
+def by_station(stations):
+    return {row["station_id"]: row for row in stations.collect().to_dicts()}
+
+# a empties at 08:15 and fills up at 08:45; b reports once and stands for MAX_GAP
+HISTORY = [
+    observation("a", 0, 5, 5), observation("a", 15, 0, 10), observation("a", 45, 10, 0),
+    observation("b", 0, 2, 2),
+]
+
+def test_observations_are_weighted_by_how_long_they_stood():
+    stations = by_station(station_utilization(silver(HISTORY), None, STARTED + timedelta(hours=1), "1h", MAX_GAP))
+    a, b = stations["a"], stations["b"]
+    assert a["window_start"] == STARTED
+    assert a["occupancy_ratio"] == pytest.approx((0.5 * 900 + 0 * 1800 + 1 * 900) / 3600)
+    assert (a["empty_seconds"], a["full_seconds"]) == (1800, 900)
+    assert (a["bikes_taken"], a["bikes_returned"], a["observations"]) == (5, 10, 3)
+    assert (b["occupancy_ratio"], b["empty_seconds"], b["bikes_taken"], b["observations"]) == (0.5, 0, 0, 1)
+
+def test_rows_before_the_watermark_only_provide_deltas():
+    later = HISTORY + [observation("a", 70, 4, 6), observation("a", 130, 3, 7)]
+    stations = station_utilization(silver(later), STARTED + timedelta(hours=1), STARTED + timedelta(hours=2), "1h", MAX_GAP).collect()
+    # The 08:45 row gives the 09:10 one its delta, the 10:10 row is past the window
+    assert stations.select("station_id", "window_start", "bikes_taken", "observations").rows() == [
+        ("a", STARTED + timedelta(hours=1), 6, 1),
+    ]
+
+def test_cities_aggregate_their_stations_per_window():
+    stations = station_utilization(silver(HISTORY), None, STARTED + timedelta(hours=1), "1h", MAX_GAP).collect()
+    cities = city_utilization(stations).to_dicts()
+    assert len(cities) == 1
+    gent = cities[0]
+    assert (gent["city_name"], gent["window_start"], gent["stations"]) == ("Gent", STARTED, 2)
+    assert gent["avg_occupancy_ratio"] == pytest.approx((0.375 + 0.5) / 2)
+    assert (gent["empty_station_hours"], gent["full_station_hours"]) == (0.5, 0.25)
+    assert (gent["bikes_taken"], gent["bikes_returned"]) == (5, 10)
@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import pytest
+from conftest import bronze_table, observation
+from data_Lake.lake import write_partitioned
+from data_Lake.schemas import SILVER_SCHEMA
+from data_Loading import backfill
+from database_Setup import warehouse
+
+@pytest.fixture
+def lake(object_store, monkeypatch):
+    # Days are loaded on threads, spawned workers would not see the fakes
+    monkeypatch.setattr(backfill, "client", object_store)
+    monkeypatch.setattr(backfill, "ProcessPoolExecutor", lambda max_workers, **kwargs: ThreadPoolExecutor(max_workers))
+    for day in range(3):
+        observations = [observation(station_id, day * 24 * 60, day + 1) for station_id in "ab"]
+        write_partitioned(object_store, bronze_table(observations), SILVER_SCHEMA, backfill.SILVER_BUCKET, "cleaned_stations", f"2024090{day + 1}120000")
+    return object_store
+
+def facts():
+    with warehouse.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM fact_bike_availability")
+        return cur.fetchone()[0]
+
+def test_interrupted_backfill_resumes_with_the_unfinished_days(lake, warehouse_db, catalog, monkeypatch):
+    bulk_load = backfill.bulk_load
+    loaded, failing = [], {"2024-09-02"}
+
+    def recording_load(conn, table):
+        day = table.column("timestamp")[0].as_py().date().isoformat()
+        if day in failing:
+            raise Exception("connection lost")
+        loaded.append(day)
+        return bulk_load(conn, table)
+
+    monkeypatch.setattr(backfill, "bulk_load", recording_load)
+    with pytest.raises(Exception, match="connection lost"):
+        backfill.backfill(catalog, "silver", date(2024, 9, 1), date(2024, 9, 3), workers=1, job="days")
+    finished = catalog.finished_partitions("days")
+    assert "2024-09-02" not in finished
+
+    # The next run only loads what was not checkpointed
+    loaded.clear()
+    failing.clear()
+    backfill.backfill(catalog, "silver", date(2024, 9, 1), date(2024, 9, 3), workers=1, job="days")
+    assert sorted(loaded) == sorted({"2024-09-01", "2024-09-02", "2024-09-03"} - set(finished))
+    assert set(catalog.finished_partitions("days")) == {"2024-09-01", "2024-09-02", "2024-09-03"}
+    assert facts() == 6
+
+    # A finished job loads nothing, a restarted one everything, without duplicates
+    loaded.clear()
+    assert backfill.backfill(catalog, "silver", date(2024, 9, 1), date(2024, 9, 3), workers=1, job="days") == (0, 0)
+    assert loaded == []
+    backfill.backfill(catalog, "silver", date(2024, 9, 1), date(2024, 9, 3), workers=2, job="days", restart=True)
+    assert sorted(loaded) == ["2024-09-01", "2024-09-02", "2024-09-03"]
+    assert facts() == 6
+
+def test_days_outside_the_range_are_not_planned(lake):
+    assert list(backfill.plan_partitions("silver", date(2024, 9, 2), date(2024, 9, 5))) == ["2024-09-02", "2024-09-03"]
@@ -0,0 +1,68 @@
+from conftest import bronze_table, observation
+from data_Lake.catalog import Catalog
+from data_Lake.lake import write_partitioned
+from data_Lake.schemas import BRONZE_SCHEMA
+
+BRONZE_BUCKET = "citybikes-bronze-layer"
+
+def write_bronze(object_store, catalog, run_id, observations):
+    return write_partitioned(object_store, bronze_table(observations), BRONZE_SCHEMA, BRONZE_BUCKET, "consolidated_stations", run_id, catalog=catalog, layer="bronze")
+
+def test_unprocessed_runs_follow_the_watermark(catalog):
+    for run_id in ["20240901080000", "20240901080500", "20240901081000"]:
+        catalog.register("bronze", BRONZE_BUCKET, f"consolidated_stations_{run_id}.csv", run_id)
+    assert catalog.latest_run("bronze") == "20240901081000"
+    assert catalog.unprocessed_runs("processing", "bronze") == ["20240901080000", "20240901080500", "20240901081000"]
+
+    catalog.set_watermark("processing", "bronze", "20240901080500")
+    assert catalog.unprocessed_runs("processing", "bronze") == ["20240901081000"]
+    # Each consumer keeps its own watermark
+    assert catalog.unprocessed_runs("backfill", "bronze") == ["20240901080000", "20240901080500", "20240901081000"]
+
+def test_watermarks_survive_a_restart(tmp_path):
+    path = str(tmp_path / "catalog.db")
+    catalog = Catalog(path)
+    catalog.set_watermark("transform", "agg_city_minute", "2024-09-01T08:10:00+00:00")
+    catalog.set_watermark("transform", "agg_city_minute", "2024-09-01T08:20:00+00:00")
+    catalog.close()
+
+    reopened = Catalog(path)
+    assert reopened.watermark("transform", "agg_city_minute") == "2024-09-01T08:20:00+00:00"
+    assert reopened.watermark("transform", "agg_city_hour") is None
+    reopened.close()
+
+def test_objects_are_registered_per_run_with_their_stats(object_store, catalog):
+    written = write_bronze(object_store, catalog, "20240901080000", [
+        observation("a", 0, 5), observation("b", 3, 2), observation("c", 1, 1, city_name="Namur"),
+    ])
+    assert catalog.objects("bronze", "20240901080000") == sorted(written)
+    gent = [info for info in catalog.object_info("bronze", "20240901080000") if "city_name=Gent" in info["object_name"]]
+    assert gent[0]["row_count"] == 2
+    assert gent[0]["min_timestamp"].startswith("2024-09-01 08:00:00")
+    assert gent[0]["max_timestamp"].startswith("2024-09-01 08:03:00")
+
+def test_latest_objects_bootstraps_from_the_bucket(object_store, catalog, tmp_path):
+    written = write_bronze(object_store, catalog, "20240901080000", [observation("a", 0, 5), observation("c", 0, 1, city_name="Namur")])
+    # A catalog that has never seen the layer finds the newest run by listing it
+    empty = Catalog(str(tmp_path / "empty.db"))
+    assert sorted(empty.latest_objects("bronze", object_store, BRONZE_BUCKET)) == sorted(written)
+    assert empty.latest_objects("bronze") == []
+    empty.close()
+
+def test_replace_objects_swaps_the_compacted_object_in(catalog):
+    for run_id in ["20240901080000", "20240901080500"]:
+        catalog.register("silver", "citybikes-silver-layer", f"cleaned_stations/city_name=Gent/date=2024-09-01/cleaned_stations_{run_id}.parquet", run_id)
+    originals = [object_name for object_name, _ in catalog.layer_objects("silver")]
+    target = "cleaned_stations/city_name=Gent/date=2024-09-01/cleaned_stations_20240901080500.compacted.parquet"
+
+    catalog.replace_objects("silver", "citybikes-silver-layer", originals, target, "20240901080500")
+    assert catalog.layer_objects("silver") == [(target, "20240901080500")]
+    assert catalog.objects("silver", "20240901080000") == []
+
+def test_backfill_partitions_are_checkpointed(catalog):
+    catalog.finish_partition("silver", "2024-09-01", 3, 120)
+    catalog.finish_partition("silver", "2024-09-02", 2, 80)
+    assert catalog.finished_partitions("silver") == {"2024-09-01", "2024-09-02"}
+    assert catalog.finished_partitions("bronze") == set()
+    catalog.reset_backfill("silver")
+    assert catalog.finished_partitions("silver") == set()
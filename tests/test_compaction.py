@@ -0,0 +1,118 @@
+import gzip
+import json
+from datetime import date, timedelta
+import pandas as pd
+import polars as pl
+from minio.commonconfig import ENABLED, Filter
+from minio.lifecycleconfig import Expiration, LifecycleConfig, Rule
+from conftest import STARTED, bronze_table, observation
+from data_Lake import compaction
+from data_Lake.lake import read_object, read_table, write_partitioned
+from data_Lake.schemas import BRONZE_SCHEMA, SILVER_SCHEMA
+from data_Lake.station_records import parse_raw, raw_line, write_raw_partitioned
+from data_Transforming import transform
+
+SILVER_BUCKET = "citybikes-silver-layer"
+BRONZE_BUCKET = "citybikes-bronze-layer"
+RUNS = ["20240901080000", "20240901080500", "20240901081000"]
+
+def write_runs(object_store, catalog, layer, bucket_name, dataset, schema):
+    for minutes, run_id in zip([10, 0, 5], RUNS):
+        table = bronze_table([observation("b", minutes, minutes), observation("a", minutes, minutes)])
+        write_partitioned(object_store, table, schema, bucket_name, dataset, run_id, catalog=catalog, layer=layer)
+
+def gold_rows(catalog, object_store, layer="gold_append"):
+    objects = [object_name for object_name, _ in catalog.layer_objects(layer)]
+    frame = pl.from_arrow(read_table(object_store, transform.GOLD_BUCKET, objects))
+    return [(row["timestamp"].strftime("%H:%M"), row["total_free_bikes"]) for row in frame.iter_rows(named=True)]
+
+def test_gold_append_compaction_keeps_the_newest_run_per_bucket(object_store, catalog, monkeypatch):
+    monkeypatch.setattr(transform, "client", object_store)
+    minutes = lambda *values: [STARTED + timedelta(minutes=value) for value in values]
+    runs = [
+        ("20240901081000", minutes(0, 1), [8, 8]),
+        # Re-exported 08:01 after a late fact
+        ("20240901082000", minutes(1, 2), [12, 13]),
+        # Newest run, never compacted
+        ("20240901083000", minutes(3), [14]),
+    ]
+    for run_id, timestamps, values in runs:
+        frame = pd.DataFrame({"city_name": ["Gent"] * len(values), "timestamp": timestamps, "total_free_bikes": values})
+        transform.upload_gold(frame, catalog, "gold_append", run_id)
+
+    compacted = compaction.compact(object_store, catalog, layers=["gold_append"], lifecycle="delete")
+
+    assert len(compacted) == 1 and compacted[0].endswith("aggregated_free_bikes_20240901082000.compacted.parquet")
+    assert gold_rows(catalog, object_store) == [("08:00", 8), ("08:01", 12), ("08:02", 13), ("08:03", 14)]
+
+def test_closed_partitions_are_merged_into_one_sorted_object(object_store, catalog):
+    write_runs(object_store, catalog, "silver", SILVER_BUCKET, "cleaned_stations", SILVER_SCHEMA)
+    catalog.set_watermark("loading", "silver", RUNS[-1])
+
+    compacted = compaction.compact(object_store, catalog, layers=["silver"], lifecycle="delete")
+
+    # The newest run is still read as the latest one and stays as it is
+    assert compacted == ["cleaned_stations/city_name=Gent/date=2024-09-01/cleaned_stations_20240901080500.compacted.parquet"]
+    assert [run_id for _, run_id in catalog.layer_objects("silver")] == ["20240901080500", "20240901081000"]
+    merged = pl.from_arrow(read_table(object_store, SILVER_BUCKET, compacted))
+    assert [(row["id"], row["timestamp"].minute) for row in merged.iter_rows(named=True)] == [("a", 0), ("a", 10), ("b", 0), ("b", 10)]
+    assert catalog.object_info("silver", "20240901080500")[0]["row_count"] == 4
+    # The originals are gone from the bucket, and their emptied runs from the catalog
+    assert len(object_store.list_objects(SILVER_BUCKET, recursive=True)) == 2
+    assert catalog.runs_after("silver") == ["20240901080500", "20240901081000"]
+
+def test_unloaded_silver_is_left_alone(object_store, catalog):
+    write_runs(object_store, catalog, "silver", SILVER_BUCKET, "cleaned_stations", SILVER_SCHEMA)
+    assert compaction.compact(object_store, catalog, layers=["silver"], lifecycle="delete") == []
+    catalog.set_watermark("loading", "silver", RUNS[0])
+    assert compaction.compact(object_store, catalog, layers=["silver"], lifecycle="delete") == []
+    catalog.set_watermark("loading", "silver", RUNS[1])
+    assert len(compaction.compact(object_store, catalog, layers=["silver"], lifecycle="delete")) == 1
+
+class LifecycleClient:
+    def __init__(self, config=None):
+        self.config = config
+
+    def get_bucket_lifecycle(self, bucket_name):
+        return self.config
+
+    def set_bucket_lifecycle(self, bucket_name, config):
+        self.config = config
+
+def test_archive_rule_is_merged_into_the_bucket_lifecycle():
+    other = Rule(ENABLED, rule_filter=Filter(prefix="tmp/"), rule_id="expire-tmp", expiration=Expiration(days=1))
+    client = LifecycleClient(LifecycleConfig([other]))
+    compaction.ensure_archive_lifecycle(client, SILVER_BUCKET, days=30)
+    compaction.ensure_archive_lifecycle(client, SILVER_BUCKET, days=7)
+    assert [(rule.rule_id, rule.expiration.days) for rule in client.config.rules] == [("expire-tmp", 1), ("expire-compacted-originals", 7)]
+
+    empty = LifecycleClient()
+    compaction.ensure_archive_lifecycle(empty, SILVER_BUCKET)
+    assert [rule.rule_id for rule in empty.config.rules] == ["expire-compacted-originals"]
+
+def test_open_days_and_unprocessed_bronze_are_left_alone(object_store, catalog):
+    write_runs(object_store, catalog, "bronze", BRONZE_BUCKET, "consolidated_stations", BRONZE_SCHEMA)
+    open_day = (date.today() - date(2024, 8, 31)).days
+    assert compaction.compact(object_store, catalog, layers=["silver", "bronze"], after_days=open_day, lifecycle="delete") == []
+    # Bronze runs are only compacted once processing has moved past them
+    assert compaction.compact(object_store, catalog, layers=["bronze"], lifecycle="delete") == []
+
+    catalog.set_watermark("processing", "bronze", RUNS[0])
+    assert compaction.compact(object_store, catalog, layers=["bronze"], lifecycle="delete") == []
+    catalog.set_watermark("processing", "bronze", RUNS[1])
+    assert len(compaction.compact(object_store, catalog, layers=["bronze"], lifecycle="delete")) == 1
+
+def test_raw_bronze_is_merged_without_decoding(object_store, catalog):
+    for minutes, run_id in zip([0, 5, 10], RUNS):
+        body = json.dumps({"network": {"stations": [{"id": "a", "name": "A", "latitude": 51.0, "longitude": 3.7, "free_bikes": minutes, "empty_slots": 1, "timestamp": f"2024-09-01T08:{minutes:02d}:00Z"}]}}).encode()
+        line = raw_line("Gent Bikes", "Gent", "2024-09-01T08:00:00+00:00", body)
+        write_raw_partitioned(object_store, [("Gent", line)], BRONZE_BUCKET, "consolidated_stations", run_id, "2024-09-01", catalog=catalog, layer="bronze")
+    catalog.set_watermark("processing", "bronze", RUNS[-1])
+    # Another parquet object on the same day is merged separately
+    write_partitioned(object_store, bronze_table([observation("b", 0, 1)]), BRONZE_SCHEMA, BRONZE_BUCKET, "consolidated_stations", RUNS[0], catalog=catalog, layer="bronze")
+
+    compacted = compaction.compact(object_store, catalog, layers=["bronze"], lifecycle="delete")
+
+    assert compacted == ["consolidated_stations/city_name=Gent/date=2024-09-01/consolidated_stations_20240901080500.compacted.ndjson.gz"]
+    stations = parse_raw(gzip.decompress(read_object(object_store, BRONZE_BUCKET, compacted[0])))
+    assert stations["free_bikes"].to_list() == [0, 5]
@@ -0,0 +1,84 @@
+from datetime import timedelta
+from conftest import STARTED, bronze_table, observation
+from data_Lake.lake import to_table
+from data_Lake.schemas import SILVER_SCHEMA
+from data_Loading import load
+from database_Setup import warehouse
+from database_Setup.create_tables import column_exists, create_schema
+
+def reconstructed(since, until, step="5 minutes", horizon="30 minutes"):
+    with warehouse.connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT ds.station_id, r.observed_at, r.free_bikes
+            FROM reconstruct_bike_availability(%s, %s, %s::INTERVAL, %s::INTERVAL) r
+            JOIN dim_station ds ON r.station_key = ds.station_key
+            ORDER BY ds.station_id, r.observed_at
+        """, (since, until, step, horizon))
+        return [(station_id, int((observed_at - STARTED).total_seconds() // 60), free_bikes) for station_id, observed_at, free_bikes in cur.fetchall()]
+
+def test_reconstruction_holds_each_change_until_the_next_one(warehouse_db):
+    changes = [observation("a", 0, 5), observation("a", 10, 6), observation("b", 0, 3), observation("c", 50, 1)]
+    warehouse.run_transaction(load.bulk_load, to_table(bronze_table(changes), SILVER_SCHEMA))
+
+    # a changes at 08:10; b is not heard from again and expires after the horizon;
+    # c only changes after the range
+    assert reconstructed(STARTED, STARTED + timedelta(minutes=40)) == (
+        [("a", minute, 5) for minute in (0, 5)]
+        + [("a", minute, 6) for minute in range(10, 40, 5)]
+        + [("b", minute, 3) for minute in range(0, 30, 5)]
+    )
+    # The grid stays aligned when the range is not
+    assert reconstructed(STARTED + timedelta(minutes=2), STARTED + timedelta(minutes=12)) == [("a", 5, 5), ("a", 10, 6), ("b", 5, 3), ("b", 10, 3)]
+
+def test_old_schema_is_migrated_to_surrogate_keys_in_place(warehouse_db):
+    with warehouse.connection() as conn:
+        with conn.cursor() as cur:
+            # The schema as it was before dim_city and station_key
+            cur.execute("DROP TABLE fact_bike_availability, dim_station, dim_city")
+            cur.execute("""
+                CREATE TABLE dim_station (
+                    station_id VARCHAR PRIMARY KEY, station_name VARCHAR NOT NULL,
+                    latitude FLOAT NOT NULL, longitude FLOAT NOT NULL, city_name VARCHAR NOT NULL
+                )
+            """)
+            cur.execute("""
+                CREATE TABLE fact_bike_availability (
+                    station_id VARCHAR REFERENCES dim_station(station_id),
+                    time_id INTEGER REFERENCES dim_time(time_id),
+                    free_bikes INTEGER NOT NULL, empty_slots INTEGER NOT NULL,
+                    PRIMARY KEY (station_id, time_id)
+                )
+            """)
+            cur.execute("""
+                INSERT INTO dim_station VALUES
+                    ('a', 'Gent station a', 51.05, 3.72, 'Gent'),
+                    ('b', 'Gent station b', 51.05, 3.72, 'Gent'),
+                    ('c', 'Namur station c', 50.46, 4.87, 'Namur')
+            """)
+            cur.execute("INSERT INTO dim_time (timestamp, day, hour) VALUES (%s, %s, %s)", (STARTED, STARTED.date(), STARTED.hour))
+            cur.execute("INSERT INTO fact_bike_availability SELECT station_id, 1, 5, 10 FROM dim_station")
+        conn.commit()
+
+        # Running it again on the migrated schema changes nothing
+        create_schema(conn)
+        create_schema(conn)
+
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT ds.station_id, dc.city_name, fb.free_bikes
+                FROM fact_bike_availability fb
+                JOIN dim_station ds ON fb.station_key = ds.station_key
+                JOIN dim_city dc ON ds.city_id = dc.city_id
+                ORDER BY ds.station_id
+            """)
+            assert cur.fetchall() == [("a", "Gent", 5), ("b", "Gent", 5), ("c", "Namur", 5)]
+            cur.execute("SELECT count(*) FROM dim_city")
+            assert cur.fetchone() == (2,)
+            assert not column_exists(cur, "fact_bike_availability", "station_id")
+            assert not column_exists(cur, "dim_station", "city_name")
+
+    # New stations get their keys from the loader as usual
+    warehouse.run_transaction(load.bulk_load, to_table(bronze_table([observation("d", 5, 2)]), SILVER_SCHEMA))
+    with warehouse.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT count(DISTINCT station_key) FROM fact_bike_availability")
+        assert cur.fetchone() == (4,)
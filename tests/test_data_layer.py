@@ -0,0 +1,96 @@
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from conftest import STARTED
+from data_Visualization import data_layer
+
+class Source:
+    # The series as the lake or warehouse would return it, and every fetch made
+    def __init__(self, values):
+        self.values = dict(values)
+        self.fetches = []
+
+    def frame(self, keep):
+        rows = sorted((moment, value) for moment, value in self.values.items() if keep(moment))
+        return pd.DataFrame(rows, columns=["datetime", "total_free_bikes"])
+
+    def fetch_since(self, city_name, since):
+        self.fetches.append(("since", since))
+        return self.frame(lambda moment: moment >= since)
+
+    def fetch_range(self, city_name, start_date, end_date):
+        self.fetches.append(("range", start_date, end_date))
+        start, end = data_layer.range_bounds(start_date, end_date)
+        return self.frame(lambda moment: start <= moment < end)
+
+def at(days=0, minutes=0):
+    return pd.Timestamp(STARTED + timedelta(days=days, minutes=minutes))
+
+def values(series):
+    return series["total_free_bikes"].tolist()
+
+def test_series_store_fetches_the_visible_range_first():
+    source = Source({at(-2): 1, at(-1): 2, at(0): 3, at(0, 1): 4})
+    store = data_layer.SeriesStore(source.fetch_since, source.fetch_range, min_interval=0)
+
+    store.refresh("Gent", STARTED.date())
+    assert source.fetches == [("since", at(0, -8 * 60))]
+    assert values(store.series("Gent", STARTED.date(), STARTED.date())) == [3, 4]
+
+    # Older days are fetched once they become visible, and only them
+    older = (STARTED - timedelta(days=2)).date()
+    store.refresh("Gent", older)
+    assert source.fetches[1] == ("range", older, (STARTED - timedelta(days=1)).date())
+    assert values(store.series("Gent", older, STARTED.date())) == [1, 2, 3, 4]
+    assert store.date_bounds("Gent") == (older, STARTED.date())
+
+def test_series_store_replaces_the_trailing_buckets():
+    source = Source({at(0): 3, at(0, 5): 4})
+    store = data_layer.SeriesStore(source.fetch_since, source.fetch_range, min_interval=0, lateness=timedelta(minutes=15))
+    first = store.refresh("Gent", STARTED.date())
+
+    # The last bucket filled up and a late bucket arrived before it
+    source.values.update({at(0, 5): 6, at(0, 2): 5, at(0, 10): 7})
+    second = store.refresh("Gent", STARTED.date())
+
+    assert second != first
+    assert source.fetches[-1] == ("since", at(0, -10))
+    series = store.series("Gent", STARTED.date(), STARTED.date())
+    assert values(series) == [3, 5, 6, 7]
+    assert series["datetime"].is_unique
+    assert len(store.frames) == 1
+
+def test_lttb_keeps_the_ends_and_the_spikes():
+    x = np.arange(100, dtype=np.float64)
+    y = np.zeros(100)
+    y[37], y[71] = 50, -50
+    selected = data_layer.lttb_indices(x, y, 10)
+    assert len(selected) == 10 and selected[0] == 0 and selected[-1] == 99
+    assert {37, 71} <= set(selected)
+    assert (np.diff(selected) > 0).all()
+
+def test_lttb_and_minmax_leave_short_series_alone():
+    x, y = np.arange(5, dtype=np.float64), np.arange(5, dtype=np.float64)
+    assert data_layer.lttb_indices(x, y, 5).tolist() == [0, 1, 2, 3, 4]
+    # Fewer than three points cannot form a triangle
+    assert data_layer.lttb_indices(x, y, 2).tolist() == [0, 1, 2, 3, 4]
+    assert data_layer.minmax_indices(y, 8).tolist() == [0, 1, 2, 3, 4]
+    assert data_layer.minmax_indices(y, 1).tolist() == [0, 1, 2, 3, 4]
+
+def test_minmax_keeps_both_extremes_of_every_bucket():
+    y = np.array([5, 1, 9, 5, 5, 5, 0, 7, 3, 3], dtype=np.float64)
+    assert data_layer.minmax_indices(y, 4).tolist() == [1, 2, 6, 7]
+    # A flat bucket contributes a single point
+    assert data_layer.minmax_indices(np.full(10, 3.0), 4).tolist() == [0, 5]
+
+def test_downsample_fits_the_point_budget():
+    series = pd.DataFrame({"datetime": [at(minutes=minute) for minute in range(1000)], "total_free_bikes": np.sin(np.arange(1000) / 50) * 100})
+    short = series.head(100)
+    assert data_layer.downsample(short, max_points=100) is short
+    lttb = data_layer.downsample(series, max_points=100, method="lttb")
+    assert len(lttb) == 100 and lttb["datetime"].is_monotonic_increasing
+    assert lttb["datetime"].iloc[[0, -1]].tolist() == [at(), at(minutes=999)]
+    minmax = data_layer.downsample(series, max_points=100, method="minmax")
+    assert len(minmax) <= 100
+    assert minmax["total_free_bikes"].max() == series["total_free_bikes"].max()
+    assert minmax["total_free_bikes"].min() == series["total_free_bikes"].min()
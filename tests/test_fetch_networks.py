@@ -0,0 +1,66 @@
+import os
+import pytest
+import requests
+from data_Ingestion import fetch_networks
+from data_Ingestion.http_cache import HttpCache
+
+class ScriptedSession:
+    # Answers every GET with the next scripted status (or raises it), and keeps
+    # the headers each request was sent with
+    def __init__(self, *script):
+        self.script = list(script)
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append(dict(headers or {}))
+        step = self.script.pop(0)
+        if isinstance(step, Exception):
+            raise step
+        status, body = step if isinstance(step, tuple) else (step, b"")
+        response = requests.Response()
+        response.status_code = status
+        response.url = url
+        response._content = body
+        response.headers["ETag"] = '"v1"'
+        return response
+
+NETWORK = b'{"network": {"stations": [{"id": "a", "free_bikes": 3}]}}'
+
+def fetch(session, **kwargs):
+    return fetch_networks.fetch_station_data("velo", "Velo", "Antwerpen", backoff_time=0, session=session, **kwargs)
+
+def test_server_errors_and_dropped_connections_are_retried():
+    session = ScriptedSession(503, requests.ConnectionError("reset"), 429, (200, NETWORK))
+    stations = fetch(session)
+    assert stations == [{"id": "a", "free_bikes": 3, "network_name": "Velo", "city_name": "Antwerpen"}]
+    assert len(session.requests) == 4
+
+def test_retries_give_up_with_an_http_error():
+    with pytest.raises(requests.HTTPError) as error:
+        fetch(ScriptedSession(500, 502, 503), max_retries=2)
+    assert error.value.response.status_code == 503
+
+def test_client_errors_are_not_retried():
+    session = ScriptedSession(404)
+    with pytest.raises(requests.HTTPError):
+        fetch(session)
+    assert len(session.requests) == 1
+
+def test_not_modified_reuses_the_cached_payload(tmp_path):
+    cache = HttpCache(str(tmp_path / "cache"))
+    first = fetch(ScriptedSession((200, NETWORK)), cache=cache)
+    session = ScriptedSession(304)
+    assert fetch(session, cache=cache) == first
+    assert session.requests == [{"If-None-Match": '"v1"'}]
+
+def test_not_modified_without_payload_fetches_again_unconditionally(tmp_path):
+    cache = HttpCache(str(tmp_path / "cache"))
+    fetch(ScriptedSession((200, NETWORK)), cache=cache)
+    # The validators are still known, the payload is gone
+    cache.memory.clear()
+    os.remove(cache._payload_path(f"{fetch_networks.CITYBIKES_API}/v2/networks/velo"))
+
+    # The refetch does not use up the only retry
+    session = ScriptedSession(304, 503, (200, NETWORK))
+    assert fetch(session, cache=cache, max_retries=1)[0]["id"] == "a"
+    assert session.requests == [{"If-None-Match": '"v1"'}, {}, {}]
@@ -0,0 +1,80 @@
+import json
+import os
+import requests
+from data_Ingestion import fetch_networks
+from data_Ingestion.http_cache import HttpCache
+
+def response(status, body=b"", **headers):
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    response.headers.update(headers)
+    return response
+
+class RecordingSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append(dict(headers or {}))
+        return self.responses.pop(0)
+
+NETWORKS = json.dumps({"networks": [
+    {"id": "velo", "name": "Velo", "location": {"city": "Antwerpen"}},
+    {"id": "velib", "name": "Velib", "location": {"city": "Paris"}},
+]}).encode()
+
+def test_validators_and_payloads_survive_a_restart(tmp_path):
+    directory = str(tmp_path / "cache")
+    cache = HttpCache(directory)
+    cache.store("http://api/a", response(200, ETag='"a1"', **{"Last-Modified": "Sun, 01 Sep 2024 08:00:00 GMT"}), [{"id": "a"}])
+
+    reopened = HttpCache(directory)
+    assert reopened.conditional_headers("http://api/a") == {"If-None-Match": '"a1"', "If-Modified-Since": "Sun, 01 Sep 2024 08:00:00 GMT"}
+    assert reopened.load("http://api/a") == [{"id": "a"}]
+    assert reopened.conditional_headers("http://api/b") == {}
+
+def test_revalidation_keeps_the_payload_and_takes_new_validators(tmp_path):
+    cache = HttpCache(str(tmp_path / "cache"))
+    cache.store("http://api/a", response(200, ETag='"a1"'), [{"id": "a"}])
+    cache.index["http://api/a"]["fetched_at"] -= 600
+    assert cache.fresh("http://api/a", 300) is None
+
+    cache.revalidate("http://api/a", response(304, ETag='"a2"'))
+    assert cache.fresh("http://api/a", 300) == [{"id": "a"}]
+    assert cache.conditional_headers("http://api/a") == {"If-None-Match": '"a2"'}
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = HttpCache(str(tmp_path / "cache"), max_entries=2)
+    for name in ("a", "b"):
+        cache.store(f"http://api/{name}", response(200, ETag=f'"{name}"'), name)
+    cache.index["http://api/a"]["used_at"] += 60
+    cache.store("http://api/c", response(200, ETag='"c"'), "c")
+    assert sorted(cache.index) == ["http://api/a", "http://api/c"]
+    assert not os.path.exists(cache._payload_path("http://api/b"))
+
+def test_unreadable_payloads_are_dropped(tmp_path):
+    cache = HttpCache(str(tmp_path / "cache"))
+    cache.store("http://api/a", response(200, ETag='"a1"'), [{"id": "a"}])
+    cache.memory.clear()
+    with open(cache._payload_path("http://api/a"), "wb") as f:
+        f.write(b"not a pickle")
+    assert cache.load("http://api/a") is None
+    assert cache.conditional_headers("http://api/a") == {}
+
+def test_network_list_is_reused_within_its_ttl_then_revalidated(tmp_path):
+    cache = HttpCache(str(tmp_path / "cache"))
+    session = RecordingSession(response(200, NETWORKS, ETag='"n1"'), response(304, ETag='"n1"'))
+
+    first = fetch_networks.fetch_network_data(session, cache=cache, ttl=3600)
+    assert [network["id"] for network in first] == ["velo"]
+    # Within the TTL no request is made at all
+    assert fetch_networks.fetch_network_data(session, cache=cache, ttl=3600) == first
+    assert len(session.requests) == 1
+
+    # Afterwards the list is revalidated, and a 304 reuses it
+    for entry in cache.index.values():
+        entry["fetched_at"] -= 7200
+    assert fetch_networks.fetch_network_data(session, cache=cache, ttl=3600) == first
+    assert session.requests == [{}, {"If-None-Match": '"n1"'}]
@@ -0,0 +1,60 @@
+from io import BytesIO
+import pandas as pd
+import polars as pl
+from conftest import STARTED, bronze_table, observation
+from data_Lake.lake import list_partition_objects, read_table, to_table, write_partitioned, write_partitioned_lazy
+from data_Lake.schemas import NAME_TYPE, SILVER_SCHEMA
+
+SILVER_BUCKET = "citybikes-silver-layer"
+
+def test_to_table_casts_to_the_schema_and_fills_missing_columns():
+    df = pd.DataFrame({
+        "city_name": ["Gent", "Gent"],
+        "id": ["a", "b"],
+        "free_bikes": [3.0, None],
+        "timestamp": pd.to_datetime(["2024-09-01T10:00:00+02:00", "2024-09-01T08:01:00Z"], format="ISO8601", utc=True),
+    })
+    table = to_table(df, SILVER_SCHEMA)
+    assert table.schema == SILVER_SCHEMA
+    assert table.column("free_bikes").to_pylist() == [3, None]
+    assert table.column("name").null_count == 2
+    assert table.column("city_name").type == NAME_TYPE
+    assert table.column("timestamp").to_pylist()[0] == STARTED
+
+def test_partitions_are_written_per_city_and_day(object_store, catalog):
+    table = bronze_table([
+        observation("a", 0, 5), observation("b", 60 * 16 + 5, 2),
+        observation("c", 0, 1, city_name="Le Mans"),
+    ])
+    written = write_partitioned(object_store, table, SILVER_SCHEMA, SILVER_BUCKET, "cleaned_stations", "20240902000500", catalog=catalog, layer="silver")
+    assert sorted(written) == [
+        "cleaned_stations/city_name=Gent/date=2024-09-01/cleaned_stations_20240902000500.parquet",
+        "cleaned_stations/city_name=Gent/date=2024-09-02/cleaned_stations_20240902000500.parquet",
+        "cleaned_stations/city_name=Le%20Mans/date=2024-09-01/cleaned_stations_20240902000500.parquet",
+    ]
+    assert catalog.objects("silver", "20240902000500") == sorted(written)
+    assert read_table(object_store, SILVER_BUCKET, sorted(written), columns=["id"]).column("id").to_pylist() == ["a", "b", "c"]
+
+def test_partition_listing_prunes_on_the_keys_alone(object_store):
+    for minutes, city_name in [(0, "Gent"), (60 * 24, "Gent"), (60 * 48, "Gent"), (60 * 24, "Le Mans")]:
+        write_partitioned(object_store, bronze_table([observation("a", minutes, 1, city_name=city_name)]), SILVER_SCHEMA, SILVER_BUCKET, "cleaned_stations", "20240904000000")
+    # Archived originals are never listed
+    object_store.put_object(SILVER_BUCKET, "archive/cleaned_stations/city_name=Gent/date=2024-09-02/cleaned_stations_20240902000000.parquet", data=BytesIO(b""), length=0)
+
+    listed = list_partition_objects(object_store, SILVER_BUCKET, "cleaned_stations", cities=["Gent"], start_date="2024-09-02", end_date="2024-09-02")
+    assert listed == ["cleaned_stations/city_name=Gent/date=2024-09-02/cleaned_stations_20240904000000.parquet"]
+    assert len(list_partition_objects(object_store, SILVER_BUCKET, "cleaned_stations", start_date="2024-09-02")) == 3
+    assert list_partition_objects(object_store, SILVER_BUCKET, "cleaned_stations", cities=["Le Mans"]) == [
+        "cleaned_stations/city_name=Le%20Mans/date=2024-09-02/cleaned_stations_20240904000000.parquet",
+    ]
+    assert object_store.bytes_read == 0
+
+def test_eager_and_lazy_writes_date_partitions_in_utc(object_store):
+    # 23:30 UTC is already the next day in Brussels
+    late = pl.from_arrow(bronze_table([observation("a", 930, 5)])).with_columns(
+        pl.col("timestamp").dt.convert_time_zone("Europe/Brussels")
+    )
+    eager = write_partitioned(object_store, late, SILVER_SCHEMA, SILVER_BUCKET, "cleaned_stations", "20240901233000")
+    lazy = write_partitioned_lazy(object_store, late.lazy(), SILVER_SCHEMA, SILVER_BUCKET, "cleaned_stations", "20240901233500")
+    assert eager == ["cleaned_stations/city_name=Gent/date=2024-09-01/cleaned_stations_20240901233000.parquet"]
+    assert lazy == ["cleaned_stations/city_name=Gent/date=2024-09-01/cleaned_stations_20240901233500.parquet"]
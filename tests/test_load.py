@@ -0,0 +1,60 @@
+from datetime import date
+import pytest
+from conftest import bronze_table, observation
+from data_Lake.lake import to_table
+from data_Lake.schemas import SILVER_SCHEMA
+from data_Loading import load
+from data_Loading.dim_cache import DimensionCache
+from database_Setup import warehouse
+
+def silver(observations):
+    return to_table(bronze_table(observations), SILVER_SCHEMA)
+
+@pytest.fixture
+def brussels_session(warehouse_db, monkeypatch):
+    # A session time zone other than UTC must not move the day or the hour
+    monkeypatch.setattr(load, "dimension_cache", DimensionCache())
+    conn = warehouse.connect()
+    conn.cursor().execute("SET TIME ZONE 'Europe/Brussels'")
+    conn.commit()
+    yield conn
+    conn.close()
+
+def time_rows(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_char(timestamp AT TIME ZONE 'UTC', 'HH24:MI'), day, hour FROM dim_time ORDER BY timestamp")
+        return cur.fetchall()
+
+def test_both_load_paths_date_dim_time_in_utc(brussels_session):
+    # 23:30 and 23:31 UTC are already the next day in Brussels
+    load.bulk_load(brussels_session, silver([observation("a", 930, 5)]))
+    load.load_rows(brussels_session, silver([observation("a", 931, 4)]).to_pandas())
+    assert time_rows(brussels_session) == [("23:30", date(2024, 9, 1), 23), ("23:31", date(2024, 9, 1), 23)]
+
+def test_incomplete_rows_are_skipped_without_failing_the_batch(warehouse_db):
+    known = observation("a", 0, 5)
+    warehouse.run_transaction(load.bulk_load, silver([known]))
+
+    rows = [
+        observation("a", 5, 4) | {"latitude": None},
+        observation("b", 5, 3) | {"name": None},
+        observation("c", 5, 2) | {"longitude": None},
+        observation("d", 5, None),
+        observation("e", 5, 1),
+    ]
+    assert warehouse.run_transaction(load.bulk_load, silver(rows)) == (2, 3)
+    with warehouse.connection() as conn, conn.cursor() as cur:
+        # A known station still gets its fact, an unknown one without a location does not
+        cur.execute("SELECT station_id FROM dim_station ORDER BY station_id")
+        assert cur.fetchall() == [("a",), ("e",)]
+        cur.execute("SELECT count(*) FROM fact_bike_availability")
+        assert cur.fetchone() == (3,)
+
+def test_row_load_with_more_stations_than_the_cache_holds(warehouse_db, monkeypatch):
+    monkeypatch.setattr(load, "dimension_cache", DimensionCache(max_stations=2))
+    with warehouse.connection() as conn:
+        load.load_rows(conn, silver([observation(station_id, 0, 1) for station_id in "abcde"]).to_pandas())
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM fact_bike_availability")
+            assert cur.fetchone() == (5,)
+    assert len(load.dimension_cache.stations) == 2
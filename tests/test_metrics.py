@@ -0,0 +1,14 @@
+from data_Monitoring import metrics
+
+def test_gauges_keep_the_last_reading(monkeypatch):
+    monkeypatch.setattr(metrics, "registry", metrics.MetricsRegistry())
+    metrics.gauge("freshness_seconds", 12.5, stage="pipeline")
+    metrics.gauge("freshness_seconds", 3.0, stage="pipeline")
+    metrics.count("rows_in", 10, stage="pipeline")
+    metrics.count("rows_in", 5, stage="pipeline")
+
+    text = metrics.prometheus_text()
+    assert "# TYPE citybikes_freshness_seconds gauge" in text
+    assert 'citybikes_freshness_seconds{stage="pipeline"} 3.0' in text
+    assert 'citybikes_rows_in_total{stage="pipeline"} 15' in text
+    assert metrics.report()["stages"]["pipeline"]["freshness_seconds"] == 3.0
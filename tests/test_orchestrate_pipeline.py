@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+import polars as pl
+import pytest
+from conftest import bronze_table, observation
+from data_Lake.lake import write_partitioned
+from data_Lake.schemas import BRONZE_SCHEMA
+from data_Processing import processing
+
+orchestrate_pipeline = pytest.importorskip("orchestrate_pipeline")
+
+@pytest.fixture
+def shared(object_store, catalog, monkeypatch):
+    # The stages share this lake and catalog, as they would share the pooled ones
+    monkeypatch.setitem(orchestrate_pipeline.resources, "minio", object_store)
+    monkeypatch.setitem(orchestrate_pipeline.resources, "catalog", catalog)
+    monkeypatch.setattr(processing, "client", object_store)
+    yield object_store, catalog
+    orchestrate_pipeline.wait_for_checkpoints()
+
+def write_bronze(object_store, catalog, run_id, observations):
+    table = bronze_table(observations)
+    write_partitioned(object_store, table, BRONZE_SCHEMA, processing.BRONZE_BUCKET, "consolidated_stations", run_id, catalog=catalog, layer="bronze")
+    return table
+
+def station_minutes(table):
+    return sorted((row["id"], row["timestamp"].minute) for row in pl.from_arrow(table).iter_rows(named=True))
+
+def test_snapshot_slot_reloads_dropped_snapshots():
+    reloaded = []
+    def reload(run_ids):
+        reloaded.append(run_ids)
+        return bronze_table([observation(run_id, 0, 1) for run_id in run_ids])
+
+    slot = orchestrate_pipeline.SnapshotSlot("Processing", reload, max_snapshots=1)
+    for run_id in ["r1", "r2", "r3"]:
+        slot.put(run_id, bronze_table([observation(run_id, 0, 1)]))
+    run_ids, table = slot.take()
+    assert reloaded == [["r1", "r2"]]
+    assert run_ids == ["r1", "r2", "r3"]
+    assert table.column("id").to_pylist() == ["r1", "r2", "r3"]
+
+def test_checkpoint_silver_waits_for_older_runs_only(shared):
+    object_store, catalog = shared
+    for run_id in ["20240901080000", "20240901080500", "20240901081000"]:
+        write_bronze(object_store, catalog, run_id, [observation("a", 0, 1)])
+    silver = processing.process_table(bronze_table([observation("a", 0, 1)]))
+
+    # Newer bronze runs registered meanwhile do not hold the watermark back
+    orchestrate_pipeline.checkpoint_silver(silver, "20240901090000", ["20240901080000"])
+    assert catalog.watermark("processing", "bronze") == "20240901080000"
+    # 08:05 is still waiting
+    orchestrate_pipeline.checkpoint_silver(silver, "20240901090100", ["20240901081000"])
+    assert catalog.watermark("processing", "bronze") == "20240901080000"
+    orchestrate_pipeline.checkpoint_silver(silver, "20240901090200", ["20240901080500", "20240901081000"])
+    assert catalog.watermark("processing", "bronze") == "20240901081000"
+
+def test_polling_processes_dropped_snapshots_from_the_lake(shared):
+    object_store, catalog = shared
+    to_processing = orchestrate_pipeline.SnapshotSlot("Processing", orchestrate_pipeline.reload_bronze, max_snapshots=1)
+    to_loading = orchestrate_pipeline.SnapshotSlot("Loading", orchestrate_pipeline.reload_silver)
+    runs = ["20240901080000", "20240901080500", "20240901081000"]
+    for minutes, run_id in zip([0, 5, 10], runs):
+        to_processing.put(run_id, write_bronze(object_store, catalog, run_id, [observation("a", minutes, minutes)]))
+    to_processing.close()
+
+    orchestrate_pipeline.poll_processing(to_processing, to_loading, {})
+    orchestrate_pipeline.wait_for_checkpoints()
+
+    _, silver = to_loading.take()
+    assert station_minutes(silver) == [("a", 0), ("a", 5), ("a", 10)]
+    assert catalog.watermark("processing", "bronze") == runs[-1]
+
+def test_export_failures_are_reported_apart_from_load_failures(monkeypatch, capsys):
+    exported, gauges = [], []
+    def load(run_id, silver):
+        if run_id == "r1":
+            raise Exception("connection refused")
+    def export(mode):
+        exported.append(mode)
+        raise Exception("statement timeout")
+    monkeypatch.setattr(orchestrate_pipeline, "load_in_process", SimpleNamespace(fn=load))
+    monkeypatch.setattr(orchestrate_pipeline, "transform_in_process", SimpleNamespace(fn=export))
+    monkeypatch.setattr(orchestrate_pipeline.metrics, "gauge", lambda *args, **kwargs: gauges.append(args))
+
+    batches = [(["r1"], None), (["r2"], None), None]
+    started = {"r1": 0.0, "r2": 0.0}
+    orchestrate_pipeline.poll_loading(SimpleNamespace(take=lambda: batches.pop(0)), started)
+
+    output = capsys.readouterr().out
+    assert "Loading of ['r1'] failed: connection refused" in output
+    # Only the snapshot that was loaded is exported
+    assert exported == ["incremental"]
+    assert "Export after loading ['r2'] failed: statement timeout" in output
+    assert "Loading of ['r2']" not in output
+    assert gauges == [] and started == {}
@@ -0,0 +1,9 @@
+from data_Processing import processing
+
+def test_partitioned_processing_skips_runs_without_objects(catalog):
+    # A run that is known to the catalog but whose objects are gone
+    catalog.conn.execute("INSERT INTO runs (layer, run_id, bucket, created_at) VALUES ('bronze', '20240901080000', ?, '')", (processing.BRONZE_BUCKET,))
+    assert catalog.unprocessed_runs("processing", "bronze") == ["20240901080000"]
+
+    assert processing.process_partitioned(catalog, workers=2) == []
+    assert catalog.unprocessed_runs("processing", "bronze") == []
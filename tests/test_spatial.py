@@ -0,0 +1,22 @@
+from conftest import bronze_table, observation
+from data_Lake.lake import write_partitioned
+from data_Lake.schemas import SILVER_SCHEMA
+from data_Visualization import spatial
+
+def write_silver(object_store, catalog, run_id, observations):
+    write_partitioned(object_store, bronze_table(observations), SILVER_SCHEMA, spatial.SILVER_BUCKET, "cleaned_stations", run_id, catalog=catalog, layer="silver")
+
+def test_cdc_silver_runs_of_the_heartbeat_window_hold_every_station(object_store, catalog, monkeypatch):
+    monkeypatch.setattr(spatial, "CDC_MODE", "processing")
+    monkeypatch.setattr(spatial, "CDC_HEARTBEAT_MINUTES", 15)
+    # c stopped reporting well before the last two heartbeat windows
+    write_silver(object_store, catalog, "20240901073000", [observation("c", -30, 1)])
+    write_silver(object_store, catalog, "20240901080000", [observation("a", 0, 5), observation("b", 0, 3)])
+    # Only a changed in the newest run
+    write_silver(object_store, catalog, "20240901080500", [observation("a", 5, 4)])
+
+    stations = spatial.lake_stations(catalog, object_store)
+    assert sorted(zip(stations["station_id"], stations["free_bikes"])) == [("a", 4), ("b", 3)]
+
+    monkeypatch.setattr(spatial, "CDC_MODE", "off")
+    assert spatial.lake_stations(catalog, object_store)["station_id"].tolist() == ["a"]
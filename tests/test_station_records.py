@@ -0,0 +1,80 @@
+import gzip
+import json
+from datetime import datetime, timezone
+import pytest
+from data_Lake import station_records
+from data_Lake.station_records import parse_csv, parse_raw, raw_line, read_station_file
+
+def station(**fields):
+    values = {"id": "a", "name": "A", "latitude": 51.05, "longitude": 3.72, "free_bikes": 3, "empty_slots": 7, "timestamp": "2024-09-01T08:00:00.123000Z"}
+    values.update(fields)
+    return {name: value for name, value in values.items() if value is not None}
+
+def raw(*stations, indent=None):
+    body = json.dumps({"network": {"stations": list(stations)}}, indent=indent).encode()
+    return raw_line("Gent Bikes", "Gent", "2024-09-01T08:00:05+00:00", body)
+
+@pytest.fixture
+def drift(monkeypatch):
+    monkeypatch.setattr(station_records, "SCHEMA_DRIFT", "warn")
+    reports = []
+    monkeypatch.setattr(station_records, "report_drift", lambda message, values=1: reports.append(message))
+    return reports
+
+def test_raw_responses_parse_with_the_declared_types(drift):
+    df = parse_raw(raw(station(), station(id="b", timestamp="2024-09-01T10:00:00+02:00", extra={"uid": 1})) + raw(station(id="c"), indent=2))
+    assert df.columns == ["id", "name", "latitude", "longitude", "timestamp", "free_bikes", "empty_slots", "network_name", "city_name"]
+    assert df["id"].to_list() == ["a", "b", "c"]
+    assert df["free_bikes"].to_list() == [3, 3, 3]
+    # "Z" and offset timestamps are both read as UTC instants
+    assert df["timestamp"].to_list()[:2] == [
+        datetime(2024, 9, 1, 8, 0, 0, 123000, tzinfo=timezone.utc),
+        datetime(2024, 9, 1, 8, 0, tzinfo=timezone.utc),
+    ]
+    assert df["city_name"].unique().to_list() == ["Gent"]
+    assert drift == []
+
+def test_values_that_do_not_fit_are_reported(drift):
+    df = parse_raw(raw(station(), station(id="b", free_bikes="many"), station(id="c", free_bikes=2.5)))
+    assert df["free_bikes"].to_list() == [3, None, None]
+    assert len(drift) == 1 and "2 free_bikes values" in drift[0]
+
+def test_missing_declared_fields_are_reported(drift):
+    df = parse_raw(raw(station(empty_slots=None)))
+    assert df["empty_slots"].to_list() == [None]
+    assert any("['empty_slots'] are missing" in message for message in drift)
+
+def test_fields_missing_after_the_first_station_are_reported(drift):
+    # Only the stations of a later network dropped the field
+    parse_raw(raw(station(), station(id="b")) + raw(station(id="c", latitude=None), station(id="d", latitude=None)))
+    assert drift == ["raw bronze: declared station fields ['latitude'] are missing, in {'latitude': 2} of 4 stations"]
+
+def test_drift_fails_the_parse_when_asked_to(monkeypatch):
+    monkeypatch.setattr(station_records, "SCHEMA_DRIFT", "fail")
+    with pytest.raises(Exception, match="Schema drift"):
+        parse_raw(raw(station(free_bikes="many")))
+    # A scalar that turned into an object cannot be read at all
+    monkeypatch.setattr(station_records, "SCHEMA_DRIFT", "warn")
+    with pytest.raises(Exception, match="Schema drift"):
+        parse_raw(raw(station(latitude={"deg": 51})))
+
+def test_csv_runs_read_as_text_then_typed(tmp_path, drift):
+    path = tmp_path / "consolidated_stations_20240901080000.csv"
+    path.write_text(
+        "id,name,latitude,longitude,timestamp,free_bikes,empty_slots,extra,network_name,city_name\n"
+        "a,A,51.05,3.72,2024-09-01T08:00:00Z,3.0,7,\"{}\",Gent Bikes,Gent\n"
+    )
+    df = read_station_file(str(path))
+    assert df.row(0, named=True)["free_bikes"] == 3
+    assert df.row(0, named=True)["timestamp"] == datetime(2024, 9, 1, 8, tzinfo=timezone.utc)
+    assert drift == []
+
+def test_raw_files_are_read_from_gzip(tmp_path, drift):
+    path = tmp_path / "consolidated_stations_20240901080000.ndjson.gz"
+    path.write_bytes(gzip.compress(raw(station())))
+    assert read_station_file(str(path))["id"].to_list() == ["a"]
+
+def test_csv_without_declared_columns_is_reported(drift):
+    df = parse_csv(b"id,free_bikes\na,3\n")
+    assert df.row(0, named=True)["empty_slots"] is None
+    assert any("are missing" in message for message in drift)
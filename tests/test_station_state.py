@@ -0,0 +1,65 @@
+import polars as pl
+import pytest
+from conftest import bronze_table, observation
+from data_Lake.lake import read_table, write_partitioned
+from data_Lake.schemas import BRONZE_SCHEMA
+from data_Lake.station_state import StationStateStore
+from data_Processing import processing
+
+@pytest.fixture
+def store(tmp_path):
+    store = StationStateStore(str(tmp_path / "state.db"), heartbeat_minutes=15)
+    yield store
+    store.close()
+
+def frame(observations):
+    return pl.from_arrow(bronze_table(observations)).drop("extra")
+
+def emitted_rows(df):
+    return sorted((row["id"], row["timestamp"].minute, row["free_bikes"]) for row in df.iter_rows(named=True))
+
+def test_changed_emits_first_observation_changes_and_heartbeats(store):
+    batch = frame([
+        observation("a", 0, 5),
+        observation("a", 5, 5),   # unchanged
+        observation("a", 10, 6),  # changed
+        observation("a", 16, 6),  # unchanged, but the first one of a new heartbeat window
+        observation("b", 0, 3),
+    ])
+    assert emitted_rows(store.changed("processing", batch)) == [("a", 0, 5), ("a", 10, 6), ("a", 16, 6), ("b", 0, 3)]
+
+def test_changed_compares_with_the_stored_state(store):
+    store.update("processing", frame([observation("a", 0, 5), observation("b", 0, 3)]))
+    batch = frame([
+        observation("a", 0, 5),  # replay of an observation the store has seen
+        observation("a", 5, 5),
+        observation("b", 5, 4),
+    ])
+    assert emitted_rows(store.changed("processing", batch)) == [("b", 5, 4)]
+
+def test_changed_keeps_the_input_type(store):
+    batch = frame([observation("a", 0, 5)])
+    assert isinstance(store.changed("processing", batch.lazy()), pl.LazyFrame)
+    assert isinstance(store.changed("processing", batch.to_arrow()), type(batch.to_arrow()))
+
+def silver_rows(object_store, objects):
+    table = read_table(object_store, processing.SILVER_BUCKET, objects)
+    return emitted_rows(pl.from_arrow(table)) if table is not None else []
+
+def write_bronze(object_store, catalog, run_id, observations):
+    write_partitioned(object_store, bronze_table(observations), BRONZE_SCHEMA, processing.BRONZE_BUCKET, "consolidated_stations", run_id, catalog=catalog, layer="bronze")
+
+def test_process_incremental_with_cdc(object_store, catalog, monkeypatch):
+    monkeypatch.setattr(processing, "client", object_store)
+    monkeypatch.setattr(processing, "CDC_MODE", "processing")
+
+    write_bronze(object_store, catalog, "20240901080000", [observation("a", 0, 5), observation("b", 0, 3), observation("c", 0, 1, city_name="Namur")])
+    write_bronze(object_store, catalog, "20240901080500", [observation("a", 5, 5), observation("b", 5, 4), observation("c", 5, 1, city_name="Namur")])
+    written = processing.process_incremental(catalog)
+    assert silver_rows(object_store, written) == [("a", 0, 5), ("b", 0, 3), ("b", 5, 4), ("c", 0, 1)]
+    assert catalog.watermark("processing", "bronze") == "20240901080500"
+
+    # The next batch is compared with the state the first one left behind
+    write_bronze(object_store, catalog, "20240901081000", [observation("a", 10, 7), observation("b", 10, 4), observation("c", 10, 1, city_name="Namur")])
+    written = processing.process_incremental(catalog)
+    assert silver_rows(object_store, written) == [("a", 10, 7)]
@@ -0,0 +1,71 @@
+from datetime import timedelta
+from io import BytesIO
+import pyarrow.parquet as pq
+from conftest import STARTED
+from data_Lake.lake import read_object
+from data_Lake.schemas import GOLD_SCHEMA
+from data_Lake.streaming import ChunkStream, stream_csv, stream_partitioned
+
+GOLD_BUCKET = "citybikes-gold-layer"
+
+class Cursor:
+    # Hands rows out in fetchmany batches, as a named cursor would
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.fetches = 0
+
+    def fetchmany(self, size):
+        self.fetches += 1
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+def gold_rows(city_name, minutes):
+    return [(city_name, STARTED + timedelta(minutes=minute), minute) for minute in minutes]
+
+def test_chunk_stream_reads_across_chunk_boundaries():
+    stream = ChunkStream([b"abc", b"", b"defg", b"h"])
+    assert stream.read(2) == b"ab"
+    assert stream.read(4) == b"cdef"
+    assert stream.read() == b"gh"
+    assert stream.read(1) == b""
+
+def test_ordered_rows_are_streamed_into_one_object_per_city_and_day(object_store, catalog):
+    # 16 hours past 08:00 is the next day; rows arrive ordered by city and time
+    rows = gold_rows("Gent", [0, 1, 2, 16 * 60]) + gold_rows("Namur", [0, 5])
+    cur = Cursor(rows)
+    written = stream_partitioned(object_store, cur, GOLD_SCHEMA, GOLD_BUCKET, "aggregated_free_bikes", "20240902000000", batch_rows=2, catalog=catalog, layer="gold")
+
+    assert written == [
+        "aggregated_free_bikes/city_name=Gent/date=2024-09-01/aggregated_free_bikes_20240902000000.parquet",
+        "aggregated_free_bikes/city_name=Gent/date=2024-09-02/aggregated_free_bikes_20240902000000.parquet",
+        "aggregated_free_bikes/city_name=Namur/date=2024-09-01/aggregated_free_bikes_20240902000000.parquet",
+    ]
+    assert cur.fetches == 4
+    first = pq.read_table(BytesIO(read_object(object_store, GOLD_BUCKET, written[0])))
+    assert first.schema == GOLD_SCHEMA
+    assert first.column("total_free_bikes").to_pylist() == [0, 1, 2]
+    # One row group per batch, so the writer never holds more than one
+    assert pq.ParquetFile(BytesIO(read_object(object_store, GOLD_BUCKET, written[0]))).num_row_groups == 2
+
+    info = {entry["object_name"]: entry for entry in catalog.object_info("gold", "20240902000000")}
+    assert info[written[0]]["row_count"] == 3
+    assert info[written[0]]["min_timestamp"].startswith("2024-09-01 08:00:00")
+    assert info[written[0]]["max_timestamp"].startswith("2024-09-01 08:02:00")
+
+def test_csv_export_streams_every_batch_after_one_header(object_store, catalog):
+    written = stream_csv(object_store, Cursor(gold_rows("Gent", [0, 1, 2])), GOLD_SCHEMA, GOLD_BUCKET, "aggregated_free_bikes_20240902000000.csv", batch_rows=2, catalog=catalog, layer="gold", run_id="20240902000000")
+
+    assert written == ["aggregated_free_bikes_20240902000000.csv"]
+    lines = read_object(object_store, GOLD_BUCKET, written[0]).decode().splitlines()
+    assert lines == [
+        "city_name,timestamp,total_free_bikes",
+        "Gent,2024-09-01 08:00:00+00:00,0",
+        "Gent,2024-09-01 08:01:00+00:00,1",
+        "Gent,2024-09-01 08:02:00+00:00,2",
+    ]
+    assert catalog.object_info("gold", "20240902000000")[0]["row_count"] == 3
+
+def test_empty_results_write_nothing(object_store, catalog):
+    assert stream_csv(object_store, Cursor([]), GOLD_SCHEMA, GOLD_BUCKET, "empty.csv", batch_rows=2) == []
+    assert stream_partitioned(object_store, Cursor([]), GOLD_SCHEMA, GOLD_BUCKET, "aggregated_free_bikes", "20240902000000", batch_rows=2) == []
+    assert object_store.list_objects(GOLD_BUCKET, recursive=True) == []
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+import pytest
+from conftest import STARTED, bronze_table, observation
+from data_Lake.lake import to_table
+from data_Lake.schemas import SILVER_SCHEMA
+from data_Loading import load
+from data_Transforming import transform
+from data_Visualization import data_layer
+from database_Setup import warehouse
+
+def test_export_window_follows_load_progress():
+    loaded = datetime(2024, 9, 1, 8, 10, tzinfo=timezone.utc)
+    assert transform.export_window(None, loaded) == (None, loaded)
+    # Every run goes back over the lateness window
+    since = datetime(2024, 9, 1, 8, 5, tzinfo=timezone.utc)
+    assert transform.export_window(since, loaded, timedelta(minutes=15)) == (since - timedelta(minutes=15), loaded)
+    # The watermark never moves back, even when nothing new was loaded
+    assert transform.export_window(loaded, since, timedelta(minutes=15)) == (loaded - timedelta(minutes=15), loaded)
+    assert transform.export_window(since, None) == (None, None)
+
+class Clock(datetime):
+    # Every export gets its own run id, even within the same second
+    ticks = [datetime(2024, 9, 2, 0, 0, 0)]
+
+    @classmethod
+    def now(cls, tz=None):
+        cls.ticks.append(cls.ticks[-1] + timedelta(seconds=1))
+        return cls.ticks[-1]
+
+def load_observations(observations):
+    warehouse.run_transaction(load.bulk_load, to_table(bronze_table(observations), SILVER_SCHEMA))
+
+def gold_series(object_store, catalog):
+    series = data_layer.lake_series(catalog, object_store, "Gent", STARTED.date(), STARTED.date())
+    return {row.datetime.strftime("%H:%M"): row.total_free_bikes for row in series.itertuples()}
+
+@pytest.mark.parametrize("export_mode", ["stream", "batch"])
+def test_late_fact_reaches_gold(warehouse_db, object_store, catalog, monkeypatch, export_mode):
+    # Star schema on plain PostgreSQL: the CDC export rebuilds the series from
+    # the facts and needs no continuous aggregate
+    monkeypatch.setattr(transform, "client", object_store)
+    monkeypatch.setattr(transform, "CDC_MODE", "load")
+    monkeypatch.setattr(transform, "EXPORT_MODE", export_mode)
+    monkeypatch.setattr(transform, "datetime", Clock)
+
+    load_observations([observation("a", 0, 5), observation("b", 0, 3), observation("a", 10, 6)])
+    with warehouse.connection() as conn:
+        transform.export_incremental(conn, catalog)
+    # Buckets up to the newest loaded minute (08:10) are exported
+    assert gold_series(object_store, catalog) == {"08:00": 8, "08:05": 8}
+    assert catalog.watermark("transform", "agg_city_minute") == "2024-09-01T08:10:00+00:00"
+
+    # b changed at 08:04 but that fact is only loaded after the export
+    load_observations([observation("b", 4, 7), observation("a", 20, 6)])
+    with warehouse.connection() as conn:
+        transform.export_incremental(conn, catalog)
+    assert gold_series(object_store, catalog) == {"08:00": 8, "08:05": 12, "08:10": 13, "08:15": 13}
+
+def test_gold_readers_keep_the_newest_run_of_a_bucket(object_store, catalog, monkeypatch):
+    monkeypatch.setattr(transform, "client", object_store)
+    first = pd.DataFrame({"city_name": ["Gent", "Gent"], "timestamp": [STARTED, STARTED + timedelta(minutes=1)], "total_free_bikes": [8, 8]})
+    second = pd.DataFrame({"city_name": ["Gent", "Gent"], "timestamp": [STARTED + timedelta(minutes=1), STARTED + timedelta(minutes=2)], "total_free_bikes": [12, 13]})
+    transform.upload_gold(first, catalog, "gold_append", "20240901081000")
+    transform.upload_gold(second, catalog, "gold_append", "20240901082000")
+
+    assert gold_series(object_store, catalog) == {"08:00": 8, "08:01": 12, "08:02": 13}
+    since = pd.Timestamp(STARTED + timedelta(minutes=1))
+    assert data_layer.lake_series_since(catalog, object_store, "Gent", since)["total_free_bikes"].tolist() == [12, 13]
+
+@pytest.mark.parametrize("export_mode", ["stream", "batch"])
+def test_star_schema_exports_incrementally_from_the_facts(warehouse_db, object_store, catalog, monkeypatch, export_mode):
+    # Without CDC or continuous aggregates the minute buckets come from the facts
+    monkeypatch.setattr(transform, "client", object_store)
+    monkeypatch.setattr(transform, "CDC_MODE", "off")
+    monkeypatch.setattr(transform, "SCHEMA_MODE", "star")
+    monkeypatch.setattr(transform, "EXPORT_MODE", export_mode)
+    monkeypatch.setattr(transform, "datetime", Clock)
+
+    load_observations([observation("a", 0, 5), observation("b", 0, 3), observation("a", 10, 6)])
+    with warehouse.connection() as conn:
+        transform.export_incremental(conn, catalog)
+    assert gold_series(object_store, catalog) == {"08:00": 8}
+
+    # The late fact for 08:04 falls inside the lateness window of the next run
+    load_observations([observation("b", 4, 7), observation("a", 20, 6)])
+    with warehouse.connection() as conn:
+        transform.export_incremental(conn, catalog)
+    assert gold_series(object_store, catalog) == {"08:00": 8, "08:04": 7, "08:10": 6}
+    assert catalog.watermark("transform", "agg_city_minute") == "2024-09-01T08:20:00+00:00"
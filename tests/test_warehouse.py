@@ -0,0 +1,97 @@
+import threading
+import time
+import psycopg2
+import pytest
+from database_Setup import warehouse
+
+@pytest.fixture
+def counters(warehouse_db):
+    with warehouse.connection() as conn, conn.cursor() as cur:
+        cur.execute("CREATE TABLE counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.commit()
+
+def counter_values():
+    with warehouse.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT name, value FROM counters ORDER BY name")
+        return cur.fetchall()
+
+def terminate(conn):
+    # Kills the backend from another session, as a server restart would
+    admin = warehouse.connect(autocommit=True)
+    admin.cursor().execute("SELECT pg_terminate_backend(%s)", (conn.get_backend_pid(),))
+    admin.close()
+
+def test_transactions_rerun_after_a_dropped_connection(counters, monkeypatch):
+    monkeypatch.setattr(warehouse, "retry_delay", lambda attempt: 0)
+    attempts = []
+
+    def insert(conn, name):
+        attempts.append(conn.get_backend_pid())
+        with conn.cursor() as cur:
+            cur.execute("INSERT INTO counters VALUES (%s, 1)", (name,))
+            if len(attempts) == 1:
+                terminate(conn)
+                cur.execute("SELECT 1")
+        return name
+
+    assert warehouse.run_transaction(insert, "a") == "a"
+    assert len(attempts) == 2 and attempts[0] != attempts[1]
+    assert counter_values() == [("a", 1)]
+
+def test_other_errors_are_not_retried_and_roll_back(counters):
+    attempts = []
+
+    def insert_twice(conn):
+        attempts.append(1)
+        with conn.cursor() as cur:
+            cur.execute("INSERT INTO counters VALUES ('a', 1)")
+            cur.execute("INSERT INTO counters VALUES ('a', 1)")
+
+    with pytest.raises(psycopg2.IntegrityError):
+        warehouse.run_transaction(insert_twice)
+    assert len(attempts) == 1
+    assert counter_values() == []
+
+def test_transactions_give_up_after_the_retries(counters, monkeypatch):
+    monkeypatch.setattr(warehouse, "retry_delay", lambda attempt: 0)
+    attempts = []
+
+    def always_dropped(conn):
+        attempts.append(1)
+        terminate(conn)
+        conn.cursor().execute("SELECT 1")
+
+    with pytest.raises(warehouse.TRANSIENT_ERRORS):
+        warehouse.run_transaction(always_dropped, retries=2)
+    assert len(attempts) == 3
+
+def test_pool_callers_wait_for_a_free_connection(warehouse_db):
+    pool = warehouse.ConnectionPool(minconn=1, maxconn=1)
+    first = pool.getconn()
+    first.autocommit = True
+    waited = []
+
+    def borrow():
+        started = time.monotonic()
+        conn = pool.getconn()
+        waited.append(time.monotonic() - started)
+        # Returned connections are reset to the default mode
+        waited.append(conn.autocommit)
+        pool.putconn(conn)
+
+    thread = threading.Thread(target=borrow)
+    thread.start()
+    time.sleep(0.2)
+    assert waited == []
+    pool.putconn(first)
+    thread.join(timeout=5)
+    assert waited[0] >= 0.2 and waited[1] is False
+    pool.closeall()
+
+def test_statements_are_prepared_once_per_connection(warehouse_db):
+    with warehouse.connection() as conn, conn.cursor() as cur:
+        for value in (1, 2, 3):
+            warehouse.execute_prepared(cur, "double_it", "SELECT $1::INTEGER * 2", (value,))
+            assert cur.fetchone() == (value * 2,)
+        cur.execute("SELECT count(*) FROM pg_prepared_statements WHERE name = 'double_it'")
+        assert cur.fetchone() == (1,)